@@ -13,6 +13,15 @@ from astropy.io import fits
 from functions.hxmt_funcs import *
 from functions.my_funcs import *
 from functions.my_logging import *
+from functions.product_funcs import *
+from functions.timing_funcs import *
+from functions.cube_funcs import *
+from functions.spectral_funcs import *
+from functions.pulsar_funcs import *
+from functions.bary_funcs import *
+from functions.archive_funcs import *
+from functions.staging_funcs import *
+from functions.fits_funcs import queue_header_keys, apply_header_updates
 
 args = sys.argv
 
@@ -118,6 +127,72 @@ comp_lc = True
 comp_spec = True
 if 'onlyspec' in arg_dict.keys(): comp_lc = False
 if 'onlylc' in arg_dict.keys(): comp_spec = False
+
+# Native screening (the HEASoft screening tools are not called)
+native_screen = False
+if 'nativescreen' in arg_dict.keys(): native_screen = True
+
+# sidecar (with nativescreen) stores the screened events as row indices
+# of the calibrated event files instead of copying them. Only the native
+# stages can read them: HEASoft lightcurves and spectra are not computed
+sidecar = False
+if 'sidecar' in arg_dict.keys():
+    if native_screen:
+        sidecar = True
+        comp_lc,comp_spec = False,False
+    else:
+        logging.warning('sidecar requires nativescreen, ignored')
+
+# Number of parallel processes for target-wide stages
+n_workers = None
+if 'nproc' in arg_dict.keys(): n_workers = int(arg_dict['nproc'])
+instruments = [inst for inst in ['HE','ME','LE'] if inst in arg_dict.keys()]
+
+# Timing products settings
+tseg = 128.
+if 'tseg' in arg_dict.keys(): tseg = float(arg_dict['tseg'])
+pds_norm = 'leahy'
+if 'pdsnorm' in arg_dict.keys(): pds_norm = arg_dict['pdsnorm']
+crosstimeres = 1/128.
+if 'crosstimeres' in arg_dict.keys(): crosstimeres = eval(arg_dict['crosstimeres'])
+twin = 64.
+if 'twin' in arg_dict.keys(): twin = float(arg_dict['twin'])
+cube_timeres = CUBE_TIMEDEL
+if 'cubetimeres' in arg_dict.keys(): cube_timeres = eval(arg_dict['cubetimeres'])
+cube_group = CUBE_GROUP
+if 'cubegroup' in arg_dict.keys(): cube_group = int(arg_dict['cubegroup'])
+
+# Time-resolved spectra: gti (one spectrum per GTI), slice length [s],
+# or text file with slice start and stop times
+tspec = None
+if 'tspec' in arg_dict.keys():
+    tspec = arg_dict['tspec']
+    if tspec != 'gti' and not os.path.isfile(tspec): tspec = float(tspec)
+
+# Epoch folding: central frequency and derivative, number of trial
+# frequencies, and number of phase bins
+fold_f0 = None
+if 'fold' in arg_dict.keys(): fold_f0 = float(arg_dict['fold'])
+fold_fdot = 0.
+if 'foldfdot' in arg_dict.keys(): fold_fdot = float(arg_dict['foldfdot'])
+fold_nfreq = 1
+if 'foldnfreq' in arg_dict.keys(): fold_nfreq = int(arg_dict['foldnfreq'])
+fold_bins = 32
+if 'foldbins' in arg_dict.keys(): fold_bins = int(arg_dict['foldbins'])
+
+# Barycentering: source coordinates [deg] default to RA_OBJ and DEC_OBJ
+# of the event files. If bary is specified, folding uses barycentric times
+bary_ra,bary_dec = None,None
+if 'ra' in arg_dict.keys(): bary_ra = float(arg_dict['ra'])
+if 'dec' in arg_dict.keys(): bary_dec = float(arg_dict['dec'])
+
+# Spectral grouping: counts (minimum counts per group), snr (minimum
+# signal to noise ratio), or optimal (Kaastra & Bleeker 2016)
+group_scheme = None
+if 'group' in arg_dict.keys():
+    group_scheme = 'counts' if arg_dict['group'] is True else arg_dict['group']
+group_min = 25.
+if 'groupmin' in arg_dict.keys(): group_min = float(arg_dict['groupmin'])
 # --------------------------------------------------------------------
 
 # Printing settings
@@ -127,6 +202,8 @@ logging.info('Settings')
 logging.info('-'*72)
 logging.info('Data directory: {}'.format(df))
 logging.info('Destination directory: {}'.format(rdf))
+logging.info('Native screening: {}'.format(native_screen))
+if sidecar: logging.info('Screened events stored as row indices (native products only)')
 if 'HE' in arg_dict.keys():
     logging.info('HE Time resolution [s]: {}'.format(hetimeres))
     logging.info('HE energy channels {}-{}'.format(heminch,hemaxch))
@@ -141,12 +218,65 @@ logging.info('-'*72+'\n')
 
 # Extracting data from zip archives
 # --------------------------------------------------------------------
+# extract extracts all the files of the selected instruments (all the
+# instruments if none is selected), extract=<file> only the instrument
+# files matching the patterns listed in file (one per line, ex. *HE-Evt*).
+# Archives are extracted in the background and the observations of each
+# archive are reduced as soon as it is complete
+extracted = None
 if 'extract' in arg_dict.keys():
     logging.info('Extracting (taz) files...')
-    data_list = glob.glob('{}/*.taz'.format(df))
-    for data in data_list:
-        cmd = f'tar xvf {data} -C {rdf}'
-        os.system(cmd)   
+    file_types = None
+    if arg_dict['extract'] is not True:
+        with open(arg_dict['extract'],'r') as infile:
+            file_types = [line.strip() for line in infile if line.strip()]
+    extracted = extract_iter(df,rdf,instruments=instruments,
+        file_types=file_types,n_workers=n_workers,override=override)
+    logging.info('')
+# --------------------------------------------------------------------
+
+# Archive-backed view
+# --------------------------------------------------------------------
+# lazy indexes the archives without extracting them: the raw files read
+# by the stages of an exposure are extracted when the exposure starts
+# (one pass per archive) and removed when the exposure has been
+# processed (unless keepraw)
+view = None
+if 'lazy' in arg_dict.keys():
+    logging.info('Indexing (taz) files...')
+    view = archive_view(df,rdf,n_workers=n_workers,override=override)
+    logging.info('')
+keep_raw = 'keepraw' in arg_dict.keys()
+# Stages whose raw files are extracted when an exposure starts
+raw_stages = [stage for stage in RAW_INPUTS if stage.split('_')[0].upper() in instruments]
+if 'bary' in arg_dict.keys(): raw_stages += ['bary_stage']
+# --------------------------------------------------------------------
+
+# Local scratch staging
+# --------------------------------------------------------------------
+# scratch=<dir> runs the stages of each exposure on a copy in a local
+# folder (ex. on SSD), publishing the products to the destination with
+# atomic renames
+# prefetch[=K] stages the next K exposures in the background (2 by
+# default), using prefetchproc threads (2 by default) and keeping the
+# scratch folder below scratchgb GB
+scratch_dir = None
+staged = None
+completed = False
+prefetcher = None
+if 'scratch' in arg_dict.keys():
+    scratch_dir = pathlib.Path(arg_dict['scratch'])
+    if not scratch_dir.is_dir(): os.makedirs(scratch_dir)
+    logging.info('Staging exposures in {}\n'.format(scratch_dir))
+    if 'prefetch' in arg_dict.keys():
+        lookahead = PREFETCH
+        if arg_dict['prefetch'] is not True: lookahead = int(arg_dict['prefetch'])
+        prefetch_proc = 2
+        if 'prefetchproc' in arg_dict.keys(): prefetch_proc = int(arg_dict['prefetchproc'])
+        max_bytes = None
+        if 'scratchgb' in arg_dict.keys(): max_bytes = int(float(arg_dict['scratchgb'])*1024**3)
+        prefetcher = make_prefetcher(rdf,scratch_dir,lookahead=lookahead,
+            n_workers=prefetch_proc,max_bytes=max_bytes)
 # --------------------------------------------------------------------
     
     
@@ -155,19 +285,43 @@ if 'extract' in arg_dict.keys():
 
 # At this point data should be organized in proposal-observation-exposure folders inside rdf
 # Listing proposal folders (Level1)
-proposals = list_items(rdf,exclude_or=['logs','analysis'])
-if type(proposals) != list: proposals = [proposals]
+if extracted is None:
+    proposals = list_items(rdf,exclude_or=['logs','analysis'])
+    if type(proposals) != list: proposals = [proposals]
+    batches = [(proposal,None) for proposal in proposals]
+    n_batches = len(batches)
+    if prefetcher:
+        for proposal in proposals:
+            observations = list_items(proposal)
+            if type(observations) != list: observations = [observations]
+            schedule_exposures(prefetcher,list_exposures(observations))
+else:
+    # Proposals (and their extracted exposures, per observation) in
+    # order of extraction
+    batches = extracted
+    n_batches = len(list_archives(df))
+
+# Header keywords of the products (ex. RESPFILE and BACKFILE of the
+# energy spectra) are queued and applied in a single batch (one open per
+# file) at the end of the spectral block of each instrument
+header_updates = {}
 
 # Start Proposal LOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOP
-for i,proposal in enumerate(proposals):
+for i,(proposal,extracted_exposures) in enumerate(batches):
     
     proposal_name = str(proposal.name)
-    logging.info(f'Processing proposal {proposal_name} ({i+1}/{len(proposals)})')
+    logging.info(f'Processing proposal {proposal_name} ({i+1}/{n_batches})')
     logging.info('='*80)
     
     # Listing observation folders (Level2)
-    observations = list_items(proposal)
-    if type(observations) != list: observations = [observations]
+    if extracted_exposures is None:
+        observations = list_items(proposal)
+        if type(observations) != list: observations = [observations]
+    else:
+        observations = list(extracted_exposures.keys())
+        if prefetcher:
+            schedule_exposures(prefetcher,[e for o in observations if (o/'AUX').is_dir()
+                for e in extracted_exposures[o]])
     
     logging.info(f'There are {len(observations)} observations.\n')
     
@@ -178,9 +332,13 @@ for i,proposal in enumerate(proposals):
         logging.info(f'Processing observation {observation_name} ({j+1}/{len(observations)})')
         logging.info('-'*80)
 
-        # Listing exposure folders (Level3)
-        exposures = list_items(observation,exclude_or=['ACS','AUX'])
-        if type(exposures) != list: exposures = [exposures]
+        # Listing exposure folders (Level3), only the ones extracted
+        # from the archive if extracting
+        if extracted_exposures is None:
+            exposures = list_items(observation,exclude_or=['ACS','AUX'])
+            if type(exposures) != list: exposures = [exposures]
+        else:
+            exposures = extracted_exposures[observation]
 
         # Checking ACS and AUX folders
         # --------------------------------------------------------------------
@@ -200,6 +358,14 @@ for i,proposal in enumerate(proposals):
         # Start Exposure LOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOP
         for exposure in exposures:
 
+            # Removing raw files and publishing products of the
+            # previous exposure (only if all its stages completed)
+            if view and not keep_raw: release_raw_inputs(view)
+            if staged:
+                if completed: publish_exposure(staged)
+                else: discard_exposure(staged)
+                staged = None
+
             # The Exposure folder name is in the format 
             # proposal-obs-exposure
             # I define this as the obs ID as the exposure, as each 
@@ -208,8 +374,17 @@ for i,proposal in enumerate(proposals):
 
             logging.info(f'Processing exposure {obs_ID}')
             logging.info('*'*80)
-            # Definition of the working folder
-            wf = exposure
+            # Definition of the working folder (and output folder).
+            # If staging on local scratch, all the stages run there and
+            # products are published when the exposure is complete
+            staged,wf,exp_out = working_folders(exposure,rdf,
+                scratch_dir=scratch_dir,prefetcher=prefetcher)
+            # Set at the end of the exposure loop, any stage skipping
+            # the exposure leaves it False
+            completed = False
+
+            # Raw files of all the stages, one pass per archive
+            if view: fetch_raw_inputs(view,wf,raw_stages,out_dir=exp_out)
             
             # HE data reduction
             # ---------------------------------------------------------
@@ -219,7 +394,8 @@ for i,proposal in enumerate(proposals):
                 
                 # Data reduction:
                 # 1) Calibration
-                hecal = he_cal(wf, override=override, out_dir=rdf)
+                if view: fetch_raw_inputs(view,wf,'he_cal',out_dir=exp_out)
+                hecal = he_cal(wf, override=override, out_dir=exp_out)
                 if hecal:
                     logging.info('1) HE calibration successfully perfomed')
                 else:
@@ -228,7 +404,8 @@ for i,proposal in enumerate(proposals):
                     continue
 
                 # 2) GTI computation
-                hegti = he_gti(wf, override=override, out_dir=rdf)
+                if view: fetch_raw_inputs(view,wf,'he_gti',out_dir=exp_out)
+                hegti = he_gti(wf, override=override, out_dir=exp_out)
                 if hegti:
                     logging.info('2) HE GTI successfully computed')
                 else:
@@ -237,7 +414,8 @@ for i,proposal in enumerate(proposals):
                     continue
                              
                 # 3) Data screening
-                hescreen = he_screen(wf,override=override, out_dir=rdf)
+                hescreen = he_screen(wf,override=override, out_dir=exp_out,
+                    native=native_screen,sidecar=sidecar)
                 if hescreen:
                     logging.info('3) HE Screening successfully performed')
                 else:
@@ -247,8 +425,9 @@ for i,proposal in enumerate(proposals):
 
                 # 4) Computing lightcurve
                 if comp_lc:
+                    if view: fetch_raw_inputs(view,wf,'he_lc',out_dir=exp_out)
                     helc = he_lc(wf,binsize=hetimeres,minpi=heminch,maxpi=hemaxch, 
-                        override=override, out_dir=rdf)
+                        override=override, out_dir=exp_out)
                     if helc:
                         logging.info('4) Lightcurve successfully computed')
                     else:
@@ -256,7 +435,8 @@ for i,proposal in enumerate(proposals):
 
                     # 4b) Computing lightcurve background
                     if helc:
-                        helc_bkg = he_bkg(wf,helc,override=override, out_dir=rdf)
+                        if view: fetch_raw_inputs(view,wf,'he_bkg',out_dir=exp_out)
+                        helc_bkg = he_bkg(wf,helc,override=override, out_dir=exp_out)
                         print(helc_bkg)
                         if helc_bkg:
                             logging.info('4b) Lightcurve background successfully computed')
@@ -266,7 +446,8 @@ for i,proposal in enumerate(proposals):
                 # 5) Computing energy spectrum
                 if comp_spec and flag_acs:
 
-                    hespectrum = he_spec(wf, override=override, out_dir=rdf)
+                    if view: fetch_raw_inputs(view,wf,'he_spec',out_dir=exp_out)
+                    hespectrum = he_spec(wf, override=override, out_dir=exp_out)
                     if hespectrum:
                         logging.info('5) Energy spectrum successfully computed')
 
@@ -276,30 +457,35 @@ for i,proposal in enumerate(proposals):
                     # 5b) Computing energy spectra response
                     if hespectrum:
 
-                        hersp = he_rsp(wf,hespectrum, override=override, out_dir=rdf)
+                        if view: fetch_raw_inputs(view,wf,'he_rsp',out_dir=exp_out)
+                        hersp = he_rsp(wf,hespectrum, override=override, out_dir=exp_out)
                         if hersp:
                             logging.info('5b) Response file sucessfully computed')
                         
-                            # Updating energy spectra RESPFILE keyword
-                            with fits.open(hespectrum,'update') as hdu_list:
-                                for hdu in hdu_list:
-                                    hdu.header['RESPFILE']=str(hersp.name)
+                            # Updating energy spectra RESPFILE keyword (see
+                            # apply_header_updates)
+                            queue_header_keys(header_updates,hespectrum,
+                                {'RESPFILE':str(hersp.name)})
                         else:
                             logging.info('5b) Response file not computed')
 
                     # 5c) Computing energy spectra background
                     if hespectrum:
 
-                        hespec_bkg = he_bkg(wf,hespectrum,override=override, out_dir=rdf)
+                        if view: fetch_raw_inputs(view,wf,'he_bkg',out_dir=exp_out)
+                        hespec_bkg = he_bkg(wf,hespectrum,override=override, out_dir=exp_out)
                         if hespec_bkg:
                             logging.info('5c) Energy spectrum background successfully computed')
 
-                            # Updating energy spectra BACKFILE keyword
-                            with fits.open(hespectrum,'update') as hdu_list:
-                                for hdu in hdu_list:
-                                    hdu.header['BACKFILE']=str(hespec_bkg.name)
+                            # Updating energy spectra BACKFILE keyword (see
+                            # apply_header_updates)
+                            queue_header_keys(header_updates,hespectrum,
+                                {'BACKFILE':str(hespec_bkg.name)})
                     else:
                         logging.info('5c) Energy spectrum background not computed')
+
+                    # RESPFILE and BACKFILE of the energy spectrum
+                    apply_header_updates(header_updates)
             # ---------------------------------------------------------
                              
 
@@ -311,7 +497,8 @@ for i,proposal in enumerate(proposals):
                 
                 # Data reduction:
                 # 1) Calibration
-                mecal = me_cal(wf, override=override, out_dir=rdf)
+                if view: fetch_raw_inputs(view,wf,'me_cal',out_dir=exp_out)
+                mecal = me_cal(wf, override=override, out_dir=exp_out)
                 if mecal:
                     logging.info('1) ME calibration successfully perfomed')
                 else:
@@ -321,7 +508,7 @@ for i,proposal in enumerate(proposals):
 
                 # 2) Grading events
                 megrade,medead = me_grade(wf, binsize=metimeres, 
-                    override=override, out_dir=rdf)
+                    override=override, out_dir=exp_out)
                 if megrade and medead:
                     logging.info('2) ME grading successfully perfomed')
                 else:
@@ -331,7 +518,7 @@ for i,proposal in enumerate(proposals):
 
                 if metimeres != 1:
                 # 2b) Creating deadtime for energy spectrum
-                    megrade1,medead1 = me_grade(wf, override=override, out_dir=rdf)
+                    megrade1,medead1 = me_grade(wf, override=override, out_dir=exp_out)
                     if megrade and medead:
                         logging.info('2b) ME second grading successfully perfomed')
                     else:
@@ -340,7 +527,8 @@ for i,proposal in enumerate(proposals):
                         continue
 
                 # 3) GTI computation
-                megti_pre = me_gti(wf, override=override, out_dir=rdf)
+                if view: fetch_raw_inputs(view,wf,'me_gti',out_dir=exp_out)
+                megti_pre = me_gti(wf, override=override, out_dir=exp_out)
                 if megti_pre:
                     logging.info('3) ME first GTI successfully computed')
                 else:
@@ -349,7 +537,7 @@ for i,proposal in enumerate(proposals):
                     continue
 
                 # 4) GTI correction
-                megti,mebad_det = me_gticorr(wf, override=override, out_dir=rdf)
+                megti,mebad_det = me_gticorr(wf, override=override, out_dir=exp_out)
                 if megti and mebad_det:
                     logging.info('4) ME GTI successfully computed')
                 else:
@@ -358,7 +546,8 @@ for i,proposal in enumerate(proposals):
                     continue
                              
                 # 5) Data screening
-                mescreen = me_screen(wf,override=override, out_dir=rdf)
+                mescreen = me_screen(wf,override=override, out_dir=exp_out,
+                    native=native_screen,sidecar=sidecar)
                 if mescreen:
                     logging.info('5) ME screening successfully performed')
                 else:
@@ -368,8 +557,9 @@ for i,proposal in enumerate(proposals):
 
                 # 6) Computing lightcurve
                 if comp_lc:
+                    if view: fetch_raw_inputs(view,wf,'me_lc',out_dir=exp_out)
                     melc = me_lc(wf,binsize=metimeres,minpi=meminch,maxpi=memaxch, 
-                        override=override, out_dir=rdf)
+                        override=override, out_dir=exp_out)
                     if melc:
                         logging.info('6) Lightcurve successfully computed')
                     else:
@@ -377,7 +567,8 @@ for i,proposal in enumerate(proposals):
 
                     # 6b) Computing lightcurve background
                     if melc:
-                        melc_bkg = me_bkg(wf,melc,override=override, out_dir=rdf)
+                        if view: fetch_raw_inputs(view,wf,'me_bkg',out_dir=exp_out)
+                        melc_bkg = me_bkg(wf,melc,override=override, out_dir=exp_out)
                         if melc_bkg:
                             logging.info('6b) Lightcurve background successfully computed')
                         else:
@@ -386,7 +577,8 @@ for i,proposal in enumerate(proposals):
                 # 7) Computing energy spectrum
                 if comp_spec and flag_acs:
 
-                    mespectrum = me_spec(wf, binsize=1, override=override, out_dir=rdf)
+                    if view: fetch_raw_inputs(view,wf,'me_spec',out_dir=exp_out)
+                    mespectrum = me_spec(wf, binsize=1, override=override, out_dir=exp_out)
                     if mespectrum:
                         logging.info('7) Energy spectrum successfully computed')
                     else:
@@ -395,30 +587,35 @@ for i,proposal in enumerate(proposals):
                     # 7b) Computing energy spectra response
                     if mespectrum:
 
-                        mersp = me_rsp(wf,mespectrum, override=override, out_dir=rdf)
+                        if view: fetch_raw_inputs(view,wf,'me_rsp',out_dir=exp_out)
+                        mersp = me_rsp(wf,mespectrum, override=override, out_dir=exp_out)
                         if mersp:
                             logging.info('7b) Response file sucessfully computed')
                         
-                            # Updating energy spectra RESPFILE keyword
-                            with fits.open(mespectrum,'update') as hdu_list:
-                                for hdu in hdu_list:
-                                    hdu.header['RESPFILE']=str(mersp.name)
+                            # Updating energy spectra RESPFILE keyword (see
+                            # apply_header_updates)
+                            queue_header_keys(header_updates,mespectrum,
+                                {'RESPFILE':str(mersp.name)})
                         else:
                             logging.info('7b) Response file not computed')
 
                     # 7c) Computing energy spectra background
                     if mespectrum:
 
-                        mespec_bkg = me_bkg(wf,mespectrum,override=override, out_dir=rdf)
+                        if view: fetch_raw_inputs(view,wf,'me_bkg',out_dir=exp_out)
+                        mespec_bkg = me_bkg(wf,mespectrum,override=override, out_dir=exp_out)
                         if mespec_bkg:
                             logging.info('7c) Energy spectrum background successfully computed')
 
-                            # Updating energy spectra BACKFILE keyword
-                            with fits.open(mespectrum,'update') as hdu_list:
-                                for hdu in hdu_list:
-                                    hdu.header['BACKFILE']=str(mespec_bkg.name)
+                            # Updating energy spectra BACKFILE keyword (see
+                            # apply_header_updates)
+                            queue_header_keys(header_updates,mespectrum,
+                                {'BACKFILE':str(mespec_bkg.name)})
                     else:
                         logging.info('7c) Energy spectrum background not computed')
+
+                    # RESPFILE and BACKFILE of the energy spectrum
+                    apply_header_updates(header_updates)
             # ---------------------------------------------------------
 
             # LE data reduction
@@ -429,7 +626,8 @@ for i,proposal in enumerate(proposals):
                 
                 # Data reduction:
                 # 1) Calibration
-                lecal = le_cal(wf, override=override, out_dir=rdf)
+                if view: fetch_raw_inputs(view,wf,'le_cal',out_dir=exp_out)
+                lecal = le_cal(wf, override=override, out_dir=exp_out)
                 if lecal:
                     logging.info('1) LE calibration successfully perfomed')
                 else:
@@ -437,7 +635,8 @@ for i,proposal in enumerate(proposals):
                     logging.info('-'*80+'\n')
                     continue
 
-                lerecon = le_recon(wf, override=override, out_dir=rdf)
+                if view: fetch_raw_inputs(view,wf,'le_recon',out_dir=exp_out)
+                lerecon = le_recon(wf, override=override, out_dir=exp_out)
                 if lerecon:
                     logging.info('2) LE reconstruction successfully perfomed')
                 else:
@@ -446,7 +645,8 @@ for i,proposal in enumerate(proposals):
                     continue                
 
                 # 3) GTI computation
-                legti_pre = le_gti(wf, override=override, out_dir=rdf)
+                if view: fetch_raw_inputs(view,wf,'le_gti',out_dir=exp_out)
+                legti_pre = le_gti(wf, override=override, out_dir=exp_out)
                 if legti_pre:
                     logging.info('3) LE first GTI successfully computed')
                 else:
@@ -455,7 +655,7 @@ for i,proposal in enumerate(proposals):
                     continue
 
                 # 4) GTI correction
-                legti = le_gticorr(wf, override=override, out_dir=rdf)
+                legti = le_gticorr(wf, override=override, out_dir=exp_out)
                 if legti:
                     logging.info('4) LE GTI successfully computed')
                 else:
@@ -464,7 +664,8 @@ for i,proposal in enumerate(proposals):
                     continue
                              
                 # 5) Data screening
-                lescreen = le_screen(wf,override=override, out_dir=rdf)
+                lescreen = le_screen(wf,override=override, out_dir=exp_out,
+                    native=native_screen,sidecar=sidecar)
                 if lescreen:
                     logging.info('5) LE screening successfully performed')
                 else:
@@ -474,8 +675,9 @@ for i,proposal in enumerate(proposals):
 
                 # 6) Computing lightcurve
                 if comp_lc:
+                    if view: fetch_raw_inputs(view,wf,'le_lc',out_dir=exp_out)
                     lelc = le_lc(wf,binsize=letimeres,minpi=meminch,maxpi=memaxch, 
-                        override=override, out_dir=rdf)
+                        override=override, out_dir=exp_out)
                     if lelc:
                         logging.info('6) Lightcurve successfully computed')
                     else:
@@ -483,7 +685,8 @@ for i,proposal in enumerate(proposals):
 
                     # 6b) Computing lightcurve background
                     if lelc:
-                        lelc_bkg = le_bkg(wf,lelc,override=override, out_dir=rdf)
+                        if view: fetch_raw_inputs(view,wf,'le_bkg',out_dir=exp_out)
+                        lelc_bkg = le_bkg(wf,lelc,override=override, out_dir=exp_out)
                         if lelc_bkg:
                             logging.info('6b) Lightcurve background successfully computed')
                         else:
@@ -492,7 +695,8 @@ for i,proposal in enumerate(proposals):
                 # 7) Computing energy spectrum
                 if comp_spec and flag_acs:
 
-                    lespectrum = le_spec(wf, override=override, out_dir=rdf)
+                    if view: fetch_raw_inputs(view,wf,'le_spec',out_dir=exp_out)
+                    lespectrum = le_spec(wf, override=override, out_dir=exp_out)
                     if lespectrum:
                         logging.info('7) Energy spectrum successfully computed')
 
@@ -502,33 +706,204 @@ for i,proposal in enumerate(proposals):
                     # 7b) Computing energy spectra response
                     if lespectrum:
 
-                        lersp = le_rsp(wf,lespectrum, override=override, out_dir=rdf)
+                        if view: fetch_raw_inputs(view,wf,'le_rsp',out_dir=exp_out)
+                        lersp = le_rsp(wf,lespectrum, override=override, out_dir=exp_out)
                         if lersp:
                             logging.info('7b) Response file sucessfully computed')
                         
-                            # Updating energy spectra RESPFILE keyword
-                            with fits.open(lespectrum,'update') as hdu_list:
-                                for hdu in hdu_list:
-                                    hdu.header['RESPFILE']=str(lersp.name)
+                            # Updating energy spectra RESPFILE keyword (see
+                            # apply_header_updates)
+                            queue_header_keys(header_updates,lespectrum,
+                                {'RESPFILE':str(lersp.name)})
                         else:
                             logging.info('7b) Response file not computed')
 
                     # 7c) Computing energy spectra background
                     if lespectrum:
 
-                        lespec_bkg = le_bkg(wf,lespectrum,override=override, out_dir=rdf)
+                        if view: fetch_raw_inputs(view,wf,'le_bkg',out_dir=exp_out)
+                        lespec_bkg = le_bkg(wf,lespectrum,override=override, out_dir=exp_out)
                         if lespec_bkg:
                             logging.info('7c) Energy spectrum background successfully computed')
 
-                            # Updating energy spectra BACKFILE keyword
-                            with fits.open(lespectrum,'update') as hdu_list:
-                                for hdu in hdu_list:
-                                    hdu.header['BACKFILE']=str(lespec_bkg.name)
+                            # Updating energy spectra BACKFILE keyword (see
+                            # apply_header_updates)
+                            queue_header_keys(header_updates,lespectrum,
+                                {'BACKFILE':str(lespec_bkg.name)})
                     else:
                         logging.info('7c) Energy spectrum background not computed')
+
+                    # RESPFILE and BACKFILE of the energy spectrum
+                    apply_header_updates(header_updates)
+            # ---------------------------------------------------------
+
+            # Columnar event cache, read by the native stages
+            # ---------------------------------------------------------
+            if 'colcache' in arg_dict.keys():
+                for inst in instruments:
+                    cache = event_cache_stage(wf,inst,out_dir=exp_out,override=override)
+                    if cache:
+                        logging.info('{} event cache successfully written'.format(inst))
+                    else:
+                        logging.info('{} event cache not written'.format(inst))
+            # ---------------------------------------------------------
+
+            # Cross spectra and time lags between instruments
+            # ---------------------------------------------------------
+            if 'cross' in arg_dict.keys() and len(instruments) > 1:
+                bands = [('HE',heminch,hemaxch),('ME',meminch,memaxch),
+                    ('LE',leminch,lemaxch)]
+                bands = [b for b in bands if b[0] in instruments]
+                cross = cross_stage(wf,bands=bands,timedel=crosstimeres,
+                    tseg=tseg,out_dir=exp_out,override=override)
+                if cross:
+                    logging.info('Cross spectra successfully computed')
+                else:
+                    logging.info('Cross spectra not computed')
+            # ---------------------------------------------------------
+
+            # Dynamic power spectra
+            # ---------------------------------------------------------
+            if 'spectrogram' in arg_dict.keys():
+                bands = {'HE':(heminch,hemaxch),'ME':(meminch,memaxch),
+                    'LE':(leminch,lemaxch)}
+                for inst in instruments:
+                    spgram = spectrogram_stage(wf,inst,twin=twin,
+                        timedel=crosstimeres,minpi=bands[inst][0],
+                        maxpi=bands[inst][1],out_dir=exp_out,override=override)
+                    if spgram:
+                        logging.info('{} spectrogram successfully computed'.format(inst))
+                    else:
+                        logging.info('{} spectrogram not computed'.format(inst))
+            # ---------------------------------------------------------
+
+            # Time x channel count cubes
+            # ---------------------------------------------------------
+            if 'cube' in arg_dict.keys():
+                for inst in instruments:
+                    cube = count_cube_stage(wf,inst,timedel=cube_timeres,
+                        group=cube_group,out_dir=exp_out,override=override)
+                    if cube:
+                        logging.info('{} count cube successfully computed'.format(inst))
+                    else:
+                        logging.info('{} count cube not computed'.format(inst))
             # ---------------------------------------------------------
 
+            # Time-resolved energy spectra
+            # ---------------------------------------------------------
+            if not tspec is None:
+                for inst in instruments:
+                    tspec_files = time_resolved_stage(wf,inst,intervals=tspec,
+                        out_dir=exp_out,override=override)
+                    if tspec_files:
+                        logging.info('{} {} time-resolved spectra successfully computed'.\
+                            format(len(tspec_files),inst))
+                    else:
+                        logging.info('{} time-resolved spectra not computed'.format(inst))
+            # ---------------------------------------------------------
+
+            # Barycentered event times and lightcurves
+            # ---------------------------------------------------------
+            if 'bary' in arg_dict.keys():
+                for inst in instruments:
+                    if view: fetch_raw_inputs(view,wf,'bary_stage',out_dir=exp_out)
+                    bary_file = bary_stage(wf,inst,ra=bary_ra,dec=bary_dec,
+                        out_dir=exp_out,override=override)
+                    if bary_file:
+                        logging.info('{} times successfully barycentred'.format(inst))
+                    else:
+                        logging.info('{} times not barycentred'.format(inst))
+            # ---------------------------------------------------------
+
+            # Epoch folding and pulse profiles
+            # ---------------------------------------------------------
+            if not fold_f0 is None:
+                for inst in instruments:
+                    fold = fold_stage(wf,inst,fold_f0,fdot=fold_fdot,
+                        n_freq=fold_nfreq,n_bins=fold_bins,
+                        bary='bary' in arg_dict.keys(),out_dir=exp_out,
+                        override=override)
+                    if fold:
+                        logging.info('{} pulse profile successfully computed'.format(inst))
+                    else:
+                        logging.info('{} pulse profile not computed'.format(inst))
+            # ---------------------------------------------------------
+
+            completed = True
             logging.info('*'*80+'\n')
         logging.info('-'*80+'\n')
     logging.info('='*80+'\n')
+if view and not keep_raw: release_raw_inputs(view)
+if staged:
+    if completed: publish_exposure(staged)
+    else: discard_exposure(staged)
+    staged = None
+if prefetcher: close_prefetcher(prefetcher)
+
+# Target-wide stages
+# =====================================================================
+
+# Background subtracted lightcurves
+# --------------------------------------------------------------------
+if 'netlc' in arg_dict.keys():
+    logging.info('Computing background subtracted lightcurves...')
+    net_lcs = net_lc_stage(rdf,instruments=instruments,n_workers=n_workers,
+        override=override)
+    logging.info('{} background subtracted lightcurves computed\n'.format(len(net_lcs)))
+# --------------------------------------------------------------------
 
+# Power density spectra
+# --------------------------------------------------------------------
+if 'pds' in arg_dict.keys():
+    logging.info('Computing power density spectra...')
+    lc_kind = 'net' if 'netlc' in arg_dict.keys() else 'src'
+    pds_files = pds_stage(rdf,instruments=instruments,tseg=tseg,norm=pds_norm,
+        kind=lc_kind,n_workers=n_workers,override=override)
+    logging.info('{} target averaged PDS computed\n'.format(len(pds_files)))
+# --------------------------------------------------------------------
+
+# Long-term lightcurves
+# --------------------------------------------------------------------
+if 'longterm' in arg_dict.keys():
+    logging.info('Updating long-term lightcurves...')
+    lc_kind = 'net' if 'netlc' in arg_dict.keys() else 'src'
+    lt_files = longterm_stage(rdf,instruments=instruments,kind=lc_kind,
+        n_workers=n_workers,override=override)
+    logging.info('{} long-term lightcurves updated\n'.format(len(lt_files)))
+# --------------------------------------------------------------------
+
+# Co-added energy spectra
+# --------------------------------------------------------------------
+# coadd co-adds all the exposures, coadd=<file> only the exposure IDs
+# listed in file (one per line)
+if 'coadd' in arg_dict.keys():
+    logging.info('Co-adding energy spectra...')
+    coadd_exp = None
+    if arg_dict['coadd'] is not True:
+        with open(arg_dict['coadd'],'r') as infile:
+            coadd_exp = [line.strip() for line in infile if line.strip()]
+    sum_spectra = coadd_stage(rdf,instruments=instruments,exp_IDs=coadd_exp,
+        override=override)
+    logging.info('{} co-added spectra computed\n'.format(len(sum_spectra)))
+# --------------------------------------------------------------------
+
+# Spectral grouping
+# --------------------------------------------------------------------
+if not group_scheme is None:
+    logging.info('Grouping energy spectra...')
+    grouped = group_stage(rdf,scheme=group_scheme,value=group_min,
+        instruments=instruments,override=override)
+    logging.info('{} spectra grouped\n'.format(len(grouped)))
+# --------------------------------------------------------------------
+
+# Hardness ratios and colours
+# --------------------------------------------------------------------
+if 'colours' in arg_dict.keys():
+    logging.info('Computing colours...')
+    colour_file = colour_stage(rdf,instruments=instruments,n_workers=n_workers,
+        override=override)
+    if colour_file:
+        logging.info('Colours successfully computed\n')
+    else:
+        logging.info('Colours not computed\n')
+# --------------------------------------------------------------------
@@ -0,0 +1,616 @@
+import os
+import json
+import shutil
+import fnmatch
+import pathlib
+import tarfile
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Folders of instrument files inside the archives. Any other file
+# (ex. ACS and AUX folders) is needed by all the instruments
+ARCHIVE_INSTRUMENTS = ['HE','ME','LE']
+
+# Archive extensions
+ARCHIVE_EXT = ['*.taz','*.tar','*.tar.gz','*.tgz']
+
+def list_archives(data_dir):
+    '''
+    Returns the archives (see ARCHIVE_EXT) inside a folder, sorted
+    '''
+
+    data_dir = pathlib.Path(data_dir)
+    return sorted(set(a for ext in ARCHIVE_EXT for a in data_dir.glob(ext)))
+
+def member_instrument(name):
+    '''
+    Returns the instrument (HE, ME, or LE) of an archive member, None if
+    the member is not inside an instrument folder
+    '''
+
+    for part in pathlib.PurePosixPath(name).parts[:-1]:
+        if part in ARCHIVE_INSTRUMENTS: return part
+    return None
+
+def select_member(member,instruments=None,file_types=None):
+    '''
+    Returns True if an archive member has to be extracted
+
+    PARAMETERS
+    ----------
+    member: tarfile.TarInfo
+        Archive member
+    instruments: list or None, optional
+        Instruments to extract. If None, all of them
+    file_types: list or None, optional
+        Shell-style patterns (ex. '*HE-Evt*') of the instrument files to
+        extract. If None, all the files of the selected instruments.
+        Files outside the instrument folders are always extracted
+
+    RETURNS
+    -------
+    selected: boolean
+    '''
+
+    if not member.isfile(): return False
+
+    # Unsafe paths are never extracted
+    path = pathlib.PurePosixPath(member.name)
+    if path.is_absolute() or '..' in path.parts: return False
+
+    inst = member_instrument(member.name)
+    if inst is None: return True
+    if not instruments is None and not inst in instruments: return False
+    if file_types is None: return True
+    return any(fnmatch.fnmatch(path.name,pattern) for pattern in file_types)
+
+def manifest_name(archive,destination):
+    '''
+    Returns the name of the extraction manifest of an archive
+    '''
+
+    return pathlib.Path(destination)/'logs'/'{}.extract.json'.\
+        format(pathlib.Path(archive).name)
+
+def _archive_stamp(archive):
+    info = os.stat(archive)
+    return [info.st_size,info.st_mtime_ns]
+
+def is_extracted(archive,destination,instruments=None,file_types=None):
+    '''
+    Returns True if the selected contents of an archive are already
+    extracted
+
+    DESCRIPTION
+    -----------
+    The manifest written after extraction (see extract_archive) lists
+    the extracted members and their size. The archive does not need to
+    be read: it is considered extracted if it has not changed since the
+    manifest was written, the manifest covers the requested selection,
+    and every listed file exists with the right size.
+    '''
+
+    manifest_file = manifest_name(archive,destination)
+    if not manifest_file.is_file(): return False
+    with open(manifest_file,'r') as infile:
+        manifest = json.load(infile)
+
+    if manifest['archive'] != _archive_stamp(archive): return False
+    if not manifest['instruments'] is None:
+        if instruments is None or \
+            any(not inst in manifest['instruments'] for inst in instruments):
+            return False
+    if not manifest['file_types'] is None and manifest['file_types'] != file_types:
+        return False
+
+    destination = pathlib.Path(destination)
+    for name,size in manifest['members'].items():
+        target = destination/name
+        if not target.is_file() or target.stat().st_size != size: return False
+
+    return True
+
+def extract_archive(archive,destination,instruments=None,file_types=None,
+    override=False):
+    '''
+    Extracts the selected members of an archive
+
+    DESCRIPTION
+    -----------
+    The archive is read as a stream (tarfile "r|*" mode, compression
+    detected automatically), so it is decompressed once, sequentially.
+    Members not selected (see select_member) are skipped without being
+    written; members already present with the same size are skipped
+    unless override is True. Each file is written under a temporary
+    name and renamed when complete, so an interrupted extraction never
+    leaves truncated files. A manifest of the extracted members is
+    written at the end (see is_extracted).
+
+    PARAMETERS
+    ----------
+    archive: string or pathlib.Path
+        Archive (.taz, .tar, .tar.gz, .tgz)
+    destination: string or pathlib.Path
+        Destination folder
+    instruments, file_types: list or None, optional
+        Member selection, see select_member
+    override: boolean, optional
+        If True, the archive is extracted even if already extracted
+
+    RETURNS
+    -------
+    result: dictionary
+        archive, status ('skipped', 'extracted', or 'failed'),
+        n_files (extracted files), n_present (files already present),
+        error (failed only)
+    '''
+
+    archive = pathlib.Path(archive)
+    destination = pathlib.Path(destination)
+    result = {'archive':str(archive),'status':'skipped','n_files':0,'n_present':0}
+
+    if not override and is_extracted(archive,destination,instruments,file_types):
+        return result
+
+    members = {}
+    try:
+        with tarfile.open(archive,mode='r|*') as tar:
+            for member in tar:
+                if not select_member(member,instruments,file_types): continue
+                members[member.name] = member.size
+
+                target = destination/member.name
+                if not override and target.is_file() and \
+                    target.stat().st_size == member.size:
+                    result['n_present'] += 1
+                    continue
+
+                os.makedirs(target.parent,exist_ok=True)
+                # Archives of the same observation share the ACS and AUX
+                # files: the temporary name is unique to the process
+                tmp_file = target.with_name('{}.{}.tmp'.format(target.name,os.getpid()))
+                with tar.extractfile(member) as source, open(tmp_file,'wb') as out:
+                    shutil.copyfileobj(source,out,1024*1024)
+                os.utime(tmp_file,(member.mtime,member.mtime))
+                os.replace(tmp_file,target)
+                result['n_files'] += 1
+    except (tarfile.TarError,OSError) as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+        return result
+
+    # Selections of previous extractions of the same archive are merged
+    manifest_file = manifest_name(archive,destination)
+    manifest = {'archive':_archive_stamp(archive),'instruments':instruments,
+        'file_types':file_types,'members':members}
+    if manifest_file.is_file():
+        with open(manifest_file,'r') as infile:
+            previous = json.load(infile)
+        if previous['archive'] == manifest['archive'] and \
+            previous['file_types'] == file_types:
+            if previous['instruments'] is None or instruments is None:
+                manifest['instruments'] = None
+            else:
+                manifest['instruments'] = sorted(set(previous['instruments']+instruments))
+            manifest['members'] = {**previous['members'],**members}
+    if not manifest_file.parent.is_dir(): os.makedirs(manifest_file.parent)
+    with open(manifest_file,'w') as outfile:
+        json.dump(manifest,outfile)
+
+    result['status'] = 'extracted'
+    return result
+
+def _extract_archive(args):
+    return extract_archive(*args)
+
+def extract_stage(data_dir,destination,instruments=None,file_types=None,
+    n_workers=None,override=False):
+    '''
+    Extracts the archives of a target, in parallel
+
+    DESCRIPTION
+    -----------
+    Each archive (see ARCHIVE_EXT) in data_dir is extracted by a
+    separate process (see extract_archive), keeping only the files of
+    the requested instruments (and file types). Archives already
+    extracted are skipped without being read.
+
+    PARAMETERS
+    ----------
+    data_dir: string or pathlib.Path
+        Folder containing the archives
+    destination: string or pathlib.Path
+        Destination folder
+    instruments: list or None, optional
+        Instruments to extract (ex. ['HE']). If None or empty, all the
+        instruments
+    file_types: list or None, optional
+        Shell-style patterns of the instrument files to extract. If
+        None, all the files
+    n_workers: integer or None, optional
+        Number of parallel processes. If None, the number of CPUs
+    override: boolean, optional
+        If True, archives are extracted again
+
+    RETURNS
+    -------
+    results: list
+        Result of each archive (see extract_archive)
+    '''
+
+    logging.info('===>>> Running extract_stage <<<===')
+
+    data_dir = pathlib.Path(data_dir)
+    archives = list_archives(data_dir)
+    if len(archives) == 0:
+        logging.info('No archive found in {}'.format(data_dir))
+        return []
+    if not instruments: instruments = None
+    logging.info('Extracting {} archives ({})'.format(len(archives),
+        'all instruments' if instruments is None else ', '.join(instruments)))
+
+    args = [(a,destination,instruments,file_types,override) for a in archives]
+    if n_workers == 1:
+        results = [_extract_archive(arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_extract_archive,args))
+
+    for result in results: _log_extraction(result)
+
+    return results
+
+def _log_extraction(result):
+    name = pathlib.Path(result['archive']).name
+    if result['status'] == 'failed':
+        logging.error('Could not extract {} ({})'.format(name,result['error']))
+    elif result['status'] == 'skipped':
+        logging.info('{} already extracted'.format(name))
+    else:
+        logging.info('{}: {} files extracted, {} already present'.format(
+            name,result['n_files'],result['n_present']))
+
+def archive_exposures(archive,destination):
+    '''
+    Returns the exposure folders extracted from an archive, grouped by
+    proposal and observation folder, according to its manifest (see
+    extract_archive)
+
+    RETURNS
+    -------
+    exposures: dictionary
+        Proposal folder: dictionary of observation folder: sorted list
+        of exposure folders
+    '''
+
+    manifest_file = manifest_name(archive,destination)
+    if not manifest_file.is_file(): return {}
+    with open(manifest_file,'r') as infile:
+        manifest = json.load(infile)
+
+    destination = pathlib.Path(destination)
+    exposures = {}
+    for name in manifest['members']:
+        parts = pathlib.PurePosixPath(name).parts
+        if len(parts) < 4 or parts[2] in ['ACS','AUX']: continue
+        observations = exposures.setdefault(destination/parts[0],{})
+        exposure = destination/parts[0]/parts[1]/parts[2]
+        if not exposure in observations.setdefault(exposure.parent,[]):
+            observations[exposure.parent] += [exposure]
+
+    return {p:{o:sorted(e) for o,e in sorted(obs.items())}
+        for p,obs in exposures.items()}
+
+def extract_iter(data_dir,destination,instruments=None,file_types=None,
+    n_workers=None,override=False):
+    '''
+    Extracts the archives of a target in the background, yielding the
+    extracted exposures as soon as each archive is complete
+
+    DESCRIPTION
+    -----------
+    All the archives are submitted at once to a pool of processes (see
+    extract_archive), so extraction goes on while the caller reduces
+    the exposures already yielded. Only the exposures listed in the
+    manifest of each archive are yielded (see archive_exposures), so an
+    observation split over several archives is yielded once per
+    archive, each time with the exposures of that archive. Exposures of
+    archives that could not be extracted are not yielded.
+
+    PARAMETERS
+    ----------
+    See extract_stage
+
+    YIELDS
+    ------
+    proposal: pathlib.Path
+        Proposal folder
+    exposures: dictionary
+        Observation folder: list of exposure folders of the proposal
+        extracted from the archive
+    '''
+
+    logging.info('===>>> Running extract_iter <<<===')
+
+    archives = list_archives(data_dir)
+    if len(archives) == 0:
+        logging.info('No archive found in {}'.format(data_dir))
+        return
+    if not instruments: instruments = None
+    logging.info('Extracting {} archives ({}) in the background'.format(len(archives),
+        'all instruments' if instruments is None else ', '.join(instruments)))
+
+    args = [(a,destination,instruments,file_types,override) for a in archives]
+    n_failed = 0
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_extract_archive,arg) for arg in args]
+        for future in as_completed(futures):
+            result = future.result()
+            _log_extraction(result)
+            if result['status'] == 'failed':
+                n_failed += 1
+                continue
+            ready = archive_exposures(result['archive'],destination)
+            for proposal,exposures in ready.items():
+                yield proposal,exposures
+    logging.info('{} archives processed, {} failed'.format(len(archives),n_failed))
+
+# Raw files read by each reduction stage, as shell-style patterns of
+# <folder>/<file name>, where folder is inside the exposure folder (or
+# the ACS and AUX folders of the observation)
+RAW_INPUTS = {
+    'he_cal':['HE/*HE-Evt*'],
+    'he_gti':['HE/*HE-HV*','HE/*HE-TH*','HE/*HE-PM*','AUX/*_EHK_*'],
+    'he_lc':['HE/*HE-DTime*'],
+    'he_spec':['HE/*HE-DTime*'],
+    'he_rsp':['ACS/*Att*'],
+    'he_bkg':['HE/*HE-DTime*','AUX/*_EHK_*'],
+    'me_cal':['ME/*ME-Evt*','ME/*ME-TH*'],
+    'me_gti':['ME/*ME-TH*','AUX/*_EHK_*'],
+    'me_rsp':['ACS/*Att*'],
+    'me_bkg':['ME/*ME-TH*','AUX/*_EHK_*'],
+    'le_cal':['LE/*LE-Evt*','LE/*LE-TH*'],
+    'le_recon':['LE/*LE-InsStat*'],
+    'le_gti':['LE/*LE-InsStat*','LE/*LE-TH*','AUX/*_EHK_*'],
+    'le_rsp':['ACS/*Att*','LE/*LE-TH*'],
+    'bary_stage':['ACS/*_Orbit_*','AUX/*_Orbit_*']
+    }
+
+# Leading bytes of compressed archives (gzip, bzip2, xz)
+COMPRESSED_MAGIC = [b'\x1f\x8b',b'BZh',b'\xfd7zXZ']
+
+def index_name(archive,destination):
+    '''
+    Returns the name of the member index of an archive
+    '''
+
+    return pathlib.Path(destination)/'logs'/'{}.index.json'.\
+        format(pathlib.Path(archive).name)
+
+def index_archive(archive,destination,override=False):
+    '''
+    Indexes the members of an archive
+
+    DESCRIPTION
+    -----------
+    The archive is read once as a stream; name, size, data offset, and
+    modification time of each regular file are saved in a JSON index
+    (<destination>/logs/<archive name>.index.json), reused until the
+    archive changes.
+
+    RETURNS
+    -------
+    index: dictionary
+        archive (path), stamp, compressed (boolean), members (list of
+        [name, size, offset, mtime])
+    '''
+
+    archive = pathlib.Path(archive)
+    index_file = index_name(archive,destination)
+    if index_file.is_file() and not override:
+        with open(index_file,'r') as infile:
+            index = json.load(infile)
+        if index['stamp'] == _archive_stamp(archive): return index
+
+    with open(archive,'rb') as infile:
+        head = infile.read(8)
+    compressed = any(head.startswith(magic) for magic in COMPRESSED_MAGIC)
+
+    members = []
+    with tarfile.open(archive,mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile(): continue
+            path = pathlib.PurePosixPath(member.name)
+            if path.is_absolute() or '..' in path.parts: continue
+            members += [[member.name,member.size,member.offset_data,member.mtime]]
+
+    index = {'archive':str(archive.resolve()),'stamp':_archive_stamp(archive),
+        'compressed':compressed,'members':members}
+    if not index_file.parent.is_dir(): os.makedirs(index_file.parent)
+    with open(index_file,'w') as outfile:
+        json.dump(index,outfile)
+
+    return index
+
+def _index_archive(args):
+    return index_archive(*args)
+
+def archive_view(data_dir,destination,n_workers=None,override=False):
+    '''
+    Archive-backed view of the exposures of a target
+
+    DESCRIPTION
+    -----------
+    Archives are indexed (see index_archive) in parallel and only the
+    folder tree (proposal/observation/exposure/instrument) is created
+    in the destination folder, so the exposures can be listed and
+    processed as if the archives were extracted. Raw files are then
+    extracted on demand, right before the stage that reads them (see
+    fetch_raw_inputs), and can be removed when the exposure has been
+    processed (see release_raw_inputs).
+
+    PARAMETERS
+    ----------
+    data_dir: string or pathlib.Path
+        Folder containing the archives
+    destination: string or pathlib.Path
+        Destination folder
+    n_workers: integer or None, optional
+        Number of parallel processes used for indexing
+    override: boolean, optional
+        If True, archives are indexed again
+
+    RETURNS
+    -------
+    view: dictionary
+        destination, indexes (list of archive indexes), fetched
+        (dictionary exposure name: list of extracted files)
+    '''
+
+    logging.info('===>>> Running archive_view <<<===')
+
+    destination = pathlib.Path(destination)
+    archives = list_archives(data_dir)
+
+    args = [(a,destination,override) for a in archives]
+    if n_workers == 1 or len(archives) < 2:
+        indexes = [_index_archive(arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            indexes = list(executor.map(_index_archive,args))
+
+    n_members = 0
+    for index in indexes:
+        for name,_,_,_ in index['members']:
+            folder = destination/pathlib.PurePosixPath(name).parent
+            if not folder.is_dir(): os.makedirs(folder)
+        n_members += len(index['members'])
+    logging.info('{} archives indexed ({} files)'.format(len(indexes),n_members))
+
+    return {'destination':destination,'indexes':indexes,'fetched':{}}
+
+def exposure_member(name,full_exp_dir):
+    '''
+    Returns the path of an archive member relative to an exposure
+    folder (<folder>/<file name>), None if the member does not belong
+    to the exposure or to the ACS and AUX folders of its observation
+    '''
+
+    parts = pathlib.PurePosixPath(name).parts
+    exp_name = pathlib.Path(full_exp_dir).name
+    obs_name = pathlib.Path(full_exp_dir).parent.name
+
+    if exp_name in parts[:-1]:
+        return '/'.join(parts[parts.index(exp_name)+1:])
+    if len(parts) > 2 and parts[-2] in ['ACS','AUX'] and parts[-3] == obs_name:
+        return '/'.join(parts[-2:])
+    return None
+
+def _copy_member(source,target,size,mtime):
+    '''
+    Copies an archive member to a temporary file, then renames it
+    '''
+
+    os.makedirs(target.parent,exist_ok=True)
+    tmp_file = target.with_name('{}.{}.tmp'.format(target.name,os.getpid()))
+    with open(tmp_file,'wb') as out:
+        remaining = size
+        while remaining > 0:
+            block = source.read(min(remaining,1024*1024))
+            if not block: raise OSError('Unexpected end of archive')
+            out.write(block)
+            remaining -= len(block)
+    os.utime(tmp_file,(mtime,mtime))
+    os.replace(tmp_file,target)
+
+def fetch_raw_inputs(view,full_exp_dir,stage,out_dir=None):
+    '''
+    Extracts the raw files read by one or more stages for an exposure,
+    if missing
+
+    DESCRIPTION
+    -----------
+    Members are selected with the patterns of the stages (see
+    RAW_INPUTS). Uncompressed archives are read at the member offsets
+    saved in the index; compressed archives are streamed once, only up
+    to the last needed member. Passing all the stages of an exposure at
+    once extracts all its raw files in a single pass per archive, later
+    calls for single stages then find the files already extracted.
+
+    PARAMETERS
+    ----------
+    view: dictionary
+        Archive view (see archive_view)
+    full_exp_dir: string or pathlib.Path
+        Full path of the exposure folder
+    stage: string or list
+        Stage name(s) (keys of RAW_INPUTS)
+    out_dir: string, pathlib.Path, or None, optional
+        Folder where the files are extracted (ex. a scratch copy of the
+        destination folder, see staging_funcs). If None, the destination
+        folder of the view
+
+    RETURNS
+    -------
+    files: list
+        Raw files of the stages (already present or just extracted)
+    '''
+
+    stages = [stage] if isinstance(stage,str) else list(stage)
+    patterns = [p for s in stages if s in RAW_INPUTS for p in RAW_INPUTS[s]]
+    if len(patterns) == 0: return []
+    destination = view['destination'] if out_dir is None else pathlib.Path(out_dir)
+    exp_name = pathlib.Path(full_exp_dir).name
+
+    files = []
+    for index in view['indexes']:
+        wanted = {}
+        for name,size,offset,mtime in index['members']:
+            relative = exposure_member(name,full_exp_dir)
+            if relative is None: continue
+            if not any(fnmatch.fnmatch(relative,p) for p in patterns): continue
+            target = destination/name
+            files += [target]
+            if target.is_file() and target.stat().st_size == size: continue
+            wanted[name] = (target,size,offset,mtime)
+        if len(wanted) == 0: continue
+
+        logging.info('Extracting {} raw files for {} from {}'.format(len(wanted),
+            ', '.join(stages),pathlib.Path(index['archive']).name))
+        if not index['compressed']:
+            with open(index['archive'],'rb') as source:
+                for target,size,offset,mtime in wanted.values():
+                    source.seek(offset)
+                    _copy_member(source,target,size,mtime)
+        else:
+            remaining = set(wanted)
+            with tarfile.open(index['archive'],mode='r|*') as tar:
+                for member in tar:
+                    if not member.name in remaining: continue
+                    target,size,_,mtime = wanted[member.name]
+                    with tar.extractfile(member) as source:
+                        _copy_member(source,target,size,mtime)
+                    remaining.remove(member.name)
+                    if len(remaining) == 0: break
+        view['fetched'].setdefault(exp_name,[]).extend(
+            target for target,_,_,_ in wanted.values())
+
+    return files
+
+def release_raw_inputs(view,full_exp_dir=None):
+    '''
+    Removes the raw files extracted on demand for an exposure (all the
+    exposures if full_exp_dir is None)
+    '''
+
+    if full_exp_dir is None:
+        exp_names = list(view['fetched'])
+    else:
+        exp_names = [pathlib.Path(full_exp_dir).name]
+
+    for exp_name in exp_names:
+        fetched = view['fetched'].pop(exp_name,[])
+        for target in fetched:
+            if target.is_file(): os.remove(target)
+        if len(fetched) > 0:
+            logging.info('{} raw files of {} removed'.format(len(fetched),exp_name))
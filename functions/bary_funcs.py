@@ -0,0 +1,330 @@
+import os
+import pathlib
+import logging
+
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+from astropy.coordinates import get_body_barycentric
+
+from .my_funcs import list_items
+from .fits_funcs import open_table, hdu_columns, read_columns
+from .hxmt_funcs import check_exp_format
+from .native_funcs import exposure_products, read_gti, iter_event_chunks, \
+    screened_header, write_hdu_stream
+
+# Speed of light [m/s] and GM_sun/c^3 [s]
+C_LIGHT = 299792458.
+T_SUN = 4.925490947e-6
+
+# Step [s] of the time grid where the barycentric correction is computed.
+# Linear interpolation of the orbital Roemer delay (~23 ms amplitude,
+# ~95 min period) on a 10 s grid is accurate to better than 1 us
+BARY_STEP = 10.
+
+# Sub-folder of analysis/<exp_ID>/<INST> with the barycentred products,
+# so that they are not picked up by the lookups of the instrument
+# products (ex. *.lc files)
+BARY_FOLDER = 'bary'
+
+def find_orbit_file(full_exp_dir):
+    '''
+    Returns the orbit file of an exposure (ACS or AUX folder) or None
+    '''
+
+    full_exp_dir = pathlib.Path(full_exp_dir)
+    for folder in ['ACS','AUX']:
+        if not (full_exp_dir/folder).is_dir(): continue
+        orbit = list_items(full_exp_dir/folder,itype='file',
+            include_or='_Orbit_',ext='FITS')
+        if type(orbit) != list: return orbit
+        if len(orbit) > 1:
+            logging.error('There is more than one orbit file')
+            return
+        if len(orbit) == 1: return orbit[0]
+
+    logging.error('I did not find an orbit file')
+    return
+
+def read_orbit(orbit_file):
+    '''
+    Reads the spacecraft position from an orbit file
+
+    RETURNS
+    -------
+    time: numpy.ndarray
+        Mission elapsed time [s]
+    position: numpy.ndarray
+        Geocentric J2000 position [m] (n_times, 3)
+    '''
+
+    with open_table(orbit_file,1) as hdu:
+        names = {name.upper():name for name in hdu.columns.names}
+        data = hdu_columns(hdu,[names[col] for col in ['TIME','X','Y','Z']])
+        time = data[names['TIME']].astype(np.float64)
+        position = np.vstack([data[names[axis]].astype(np.float64)
+            for axis in ['X','Y','Z']]).T
+        unit = hdu.columns[names['X']].unit
+
+    # Positions in km are converted in m
+    if (unit or '').strip().lower() == 'km' or \
+        (not unit and np.median(np.linalg.norm(position,axis=1)) < 1e5):
+        position *= 1000.
+
+    order = np.argsort(time,kind='mergesort')
+    return time[order],position[order]
+
+def bary_correction(time,orbit_time,orbit_position,ra,dec,mjdref):
+    '''
+    Barycentric correction of spacecraft (TT) times
+
+    DESCRIPTION
+    -----------
+    The correction is the sum of the Roemer delay (observer position
+    projected on the source direction), the Einstein delay (TDB-TT),
+    and the solar Shapiro delay. The Earth and the Sun positions are
+    computed with the astropy builtin ephemeris, so no ephemeris file
+    (or network access) is needed; the spacecraft position is linearly
+    interpolated from the orbit file.
+
+    PARAMETERS
+    ----------
+    time: numpy.ndarray
+        Mission elapsed time [s]
+    orbit_time, orbit_position: numpy.ndarray
+        Spacecraft geocentric position (see read_orbit)
+    ra, dec: float
+        Source coordinates [deg], ICRS
+    mjdref: float
+        MJD (TT) of the mission time reference
+
+    RETURNS
+    -------
+    correction: numpy.ndarray
+        Barycentric time (TDB) minus spacecraft time (TT) [s]
+    '''
+
+    time = np.asarray(time,dtype=np.float64)
+    epoch = Time(mjdref,time/86400.,format='mjd',scale='tt')
+
+    earth = get_body_barycentric('earth',epoch,ephemeris='builtin').\
+        get_xyz().to_value('m').T
+    sun = get_body_barycentric('sun',epoch,ephemeris='builtin').\
+        get_xyz().to_value('m').T
+    spacecraft = np.vstack([np.interp(time,orbit_time,orbit_position[:,k])
+        for k in range(3)]).T
+    observer = earth+spacecraft
+
+    ra,dec = np.radians(ra),np.radians(dec)
+    source = np.array([np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)])
+
+    roemer = observer@source/C_LIGHT
+    tdb = epoch.tdb
+    einstein = ((tdb.jd1-epoch.jd1)+(tdb.jd2-epoch.jd2))*86400.
+    from_sun = observer-sun
+    cos_angle = from_sun@source/np.linalg.norm(from_sun,axis=1)
+    shapiro = 2.*T_SUN*np.log(1.+cos_angle)
+
+    return roemer+einstein+shapiro
+
+def barycentre(time,grid,correction):
+    '''
+    Barycentric times, interpolating a correction computed on a grid
+    '''
+
+    return time+np.interp(time,grid,correction)
+
+def read_bary(bary_file):
+    '''
+    Reads the correction grid (TIME, CORR) of a barycentering file
+    '''
+
+    data = read_columns(bary_file,['TIME','CORR'],ext='BARYCORR')
+    return data['TIME'],data['CORR']
+
+def bary_name(exp_dir,exp_ID,inst):
+    '''
+    Returns the name of the barycentering file of an exposure and
+    instrument
+    '''
+
+    return pathlib.Path(exp_dir)/inst/BARY_FOLDER/'{}_{}_bary.fits'.\
+        format(exp_ID,inst)
+
+def barycentre_lightcurve(lc_file,grid,correction,outfile,history=[]):
+    '''
+    Writes a copy of a lightcurve with barycentric TIME and GTIs
+    '''
+
+    with fits.open(lc_file) as hdu_list:
+        for hdu in hdu_list[1:]:
+            if not isinstance(hdu,fits.BinTableHDU): continue
+            for col in ['TIME','START','STOP']:
+                if col in hdu.columns.names:
+                    hdu.data[col] = barycentre(np.array(hdu.data[col],
+                        dtype=np.float64),grid,correction)
+            for key in ['TSTART','TSTOP']:
+                if key in hdu.header:
+                    hdu.header[key] = float(barycentre(hdu.header[key],
+                        grid,correction))
+        for hdu in hdu_list:
+            if 'TIMESYS' in hdu.header or hdu is hdu_list[0]:
+                hdu.header['TIMESYS'] = 'TDB'
+            hdu.header['TIMEREF'] = 'SOLARSYSTEM'
+            for line in history: hdu.header['HISTORY'] = line
+        hdu_list.writeto(outfile,overwrite=True)
+
+def bary_stage(full_exp_dir,inst,ra=None,dec=None,step=BARY_STEP,events=True,
+    lightcurves=True,out_dir=pathlib.Path.cwd(),override=False):
+    '''
+    Barycentres the screened events and the lightcurves of an exposure
+
+    DESCRIPTION
+    -----------
+    The barycentric correction (see bary_correction) is computed on a
+    time grid of step seconds covering the exposure GTIs and written
+    into the BARYCORR extension (TIME, CORR) of the barycentering file.
+    The correction is then interpolated to the event times:
+    - if events is True, barycentric event times are streamed into the
+      BARYTIME extension (one row per screened event, same order),
+      without copying the event file;
+    - if lightcurves is True, each lightcurve of the exposure is
+      copied with barycentric TIME and GTIs (<lc name>_bary.lc in the
+      BARY_FOLDER sub-folder).
+    Stages reading events can also apply the correction on the fly
+    (see read_bary and barycentre).
+
+    PARAMETERS
+    ----------
+    full_exp_dir: string or pathlib.Path
+        Full path of the esposure folder
+    inst: string
+        Instrument (HE, ME, or LE)
+    ra, dec: float or None, optional
+        Source coordinates [deg]. If None, RA_OBJ and DEC_OBJ of the
+        screened event file are used
+    step: float, optional
+        Step [s] of the correction grid (default is BARY_STEP)
+    events: boolean, optional
+        If True (default), the BARYTIME extension is written
+    lightcurves: boolean, optional
+        If True (default), barycentred lightcurves are written
+    out_dir: string or pathlib.Path(), optional
+        Name of the output products folder (containing the analysis
+        folder). Default is current working directory.
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    outfile: pathlib.Path or None
+        Barycentering file, in the form:
+        <out_dir>/analysis/<exp_ID>/<INST>/bary/<exp_ID>_<INST>_bary.fits
+    '''
+
+    logging.info('===>>> Running bary_stage <<<===')
+
+    if type(full_exp_dir) == str: full_exp_dir = pathlib.Path(full_exp_dir)
+    if type(out_dir) == str: out_dir = pathlib.Path(out_dir)
+
+    # Checking exposure folder format
+    if not check_exp_format(full_exp_dir):
+        logging.info('Something is wrong in the exposure folder name, check:')
+        logging.info(full_exp_dir)
+        return
+
+    exp_ID = str(full_exp_dir.name)
+    exp_dir = out_dir/'analysis'/exp_ID
+
+    outfile = bary_name(exp_dir,exp_ID,inst)
+    if not outfile.parent.is_dir(): os.makedirs(outfile.parent)
+    if outfile.is_file() and not override:
+        logging.info('Barycentering file already exists')
+        return outfile
+
+    screen_file,gti_file = exposure_products(exp_dir,exp_ID,inst)
+    if screen_file is None or gti_file is None:
+        logging.error('{} screened event file or GTI missing'.format(inst))
+        return
+    gti_start,gti_stop = read_gti(gti_file)
+    if len(gti_start) == 0:
+        logging.error('Empty GTI')
+        return
+
+    orbit_file = find_orbit_file(full_exp_dir)
+    if orbit_file is None: return
+
+    header = screened_header(screen_file)
+    if ra is None or dec is None:
+        if not ('RA_OBJ' in header and 'DEC_OBJ' in header):
+            logging.error('Source coordinates not specified and not in the event file')
+            return
+        ra,dec = header['RA_OBJ'],header['DEC_OBJ']
+    mjdref = header.get('MJDREFI',0)+header.get('MJDREFF',0.)
+    if 'MJDREF' in header: mjdref = header['MJDREF']
+    if header.get('TIMESYS','TT').strip().upper() != 'TT':
+        logging.error('Event times are not TT ({})'.format(header['TIMESYS']))
+        return
+
+    # Correction grid
+    # -----------------------------------------------------------------
+    orbit_time,orbit_position = read_orbit(orbit_file)
+    grid = np.arange(gti_start[0]-2*step,gti_stop[-1]+3*step,step)
+    if grid[0] < orbit_time[0]-step or grid[-1] > orbit_time[-1]+step:
+        logging.warning('The orbit file does not cover the full exposure')
+    correction = bary_correction(grid,orbit_time,orbit_position,ra,dec,mjdref)
+    logging.info('Barycentric correction between {:.3f} and {:.3f} s'.format(
+        correction.min(),correction.max()))
+
+    bary_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='TIME',format='D',unit='s',array=grid),
+        fits.Column(name='CORR',format='D',unit='s',array=correction)],
+        name='BARYCORR')
+    for key in ['OBJECT','TELESCOP','INSTRUME','OBS_ID','MJDREFI','MJDREFF','MJDREF']:
+        if key in header: bary_hdu.header[key] = header[key]
+    bary_hdu.header['RA_OBJ'] = (ra,'Source right ascension [deg]')
+    bary_hdu.header['DEC_OBJ'] = (dec,'Source declination [deg]')
+    bary_hdu.header['TIMESYS'] = ('TT','Time system of TIME')
+    bary_hdu.header['ORBFILE'] = (orbit_file.name,'Orbit file')
+    bary_hdu.header['EPHEM'] = ('builtin','Solar system ephemeris (astropy)')
+    # -----------------------------------------------------------------
+
+    tmp_file = outfile.with_name(outfile.name+'.tmp')
+    fits.HDUList([fits.PrimaryHDU(),bary_hdu]).writeto(tmp_file,overwrite=True)
+
+    # Barycentric event times, streamed in screened event order
+    # -----------------------------------------------------------------
+    if events:
+        blocks = (barycentre(data['TIME'],grid,correction).astype('>f8')
+            for data in iter_event_chunks(screen_file,['TIME']))
+        if pathlib.Path(screen_file).suffix == '.npy':
+            n_events = len(np.load(screen_file,mmap_mode='r'))
+        else:
+            n_events = header['NAXIS2']
+
+        time_header = fits.BinTableHDU.from_columns([fits.Column(name='BARYTIME',
+            format='D',unit='s',array=np.zeros(0))],name='BARYTIME').header
+        time_header['NAXIS2'] = n_events
+        time_header['TIMESYS'] = ('TDB','Time system of BARYTIME')
+        time_header['TIMEREF'] = ('SOLARSYSTEM','Times refer to the solar system barycentre')
+        time_header['HISTORY'] = 'Rows of {}'.format(pathlib.Path(screen_file).name)
+        with open(tmp_file,'ab') as out:
+            n_bytes = write_hdu_stream(out,time_header,blocks)
+        if n_bytes != 8*n_events:
+            logging.error('Inconsistent number of barycentred events')
+            os.remove(tmp_file)
+            return
+        logging.info('{} event times barycentred'.format(n_events))
+    # -----------------------------------------------------------------
+
+    os.replace(tmp_file,outfile)
+
+    if lightcurves:
+        lc_files = sorted((exp_dir/inst).glob('{}_{}_*.lc'.format(exp_ID,inst)))
+        for lc_file in lc_files:
+            barycentre_lightcurve(lc_file,grid,correction,
+                outfile.parent/(lc_file.stem+'_bary.lc'),
+                history=['Barycentred with {}'.format(outfile.name)])
+        logging.info('{} lightcurves barycentred'.format(len(lc_files)))
+
+    return outfile
@@ -0,0 +1,348 @@
+import os
+import pathlib
+import logging
+
+import numpy as np
+from astropy.io import fits
+
+from .hxmt_funcs import check_exp_format
+from .native_funcs import INSTRUMENTS, read_gti, det_mask, \
+    exposure_products, iter_event_windows, write_hdu_stream
+from .fits_funcs import hdu_columns, raw_records
+from .product_funcs import write_lightcurve
+from .deadtime_funcs import live_fraction, dead_time_correct
+
+# Maximum number of cube cells (time bins x channel groups) kept in
+# memory while building or reading a cube
+CUBE_CHUNK_CELLS = 2**22
+
+# Default time resolution [s] and channel group width of count cubes
+CUBE_TIMEDEL = 1/16.
+CUBE_GROUP = 8
+
+def channel_groups(minpi,maxpi,group=1):
+    '''
+    Channel boundaries of the energy groups of a count cube
+
+    PARAMETERS
+    ----------
+    minpi, maxpi: integer
+        Energy channel range (boundaries included)
+    group: integer or list, optional
+        Width (number of channels) of each group (default is 1), or
+        sorted list of the first channel of each group (the last group
+        ends at maxpi)
+
+    RETURNS
+    -------
+    pi_lo, pi_hi: numpy.ndarray
+        First and last channel of each group
+    '''
+
+    if np.isscalar(group):
+        if group < 1: raise ValueError('Group width must be positive')
+        pi_lo = np.arange(minpi,maxpi+1,group)
+    else:
+        pi_lo = np.asarray(group,dtype=np.int64)
+        if (pi_lo[0] != minpi) or (pi_lo[-1] > maxpi) or \
+            np.any(np.diff(pi_lo) <= 0):
+            raise ValueError('Invalid channel groups {}'.format(group))
+    pi_hi = np.append(pi_lo[1:]-1,maxpi)
+
+    return pi_lo,pi_hi
+
+def cube_name(exp_dir,exp_ID,inst,minpi,maxpi,n_groups,timedel):
+    '''
+    Returns the name of the count cube of an exposure and instrument
+    '''
+
+    return pathlib.Path(exp_dir)/inst/'{}_{}_cube_ch{}-{}_{}grp_{}s.fits'.\
+        format(exp_ID,inst,minpi,maxpi,n_groups,timedel)
+
+def gti_bins(gti,timedel):
+    '''
+    Time bins of a count cube: uniform bins starting at the beginning of
+    each GTI, only bins fully inside a GTI are kept
+
+    RETURNS
+    -------
+    bin_start: numpy.ndarray
+        Start time of each bin
+    n_bins: numpy.ndarray
+        Number of bins of each GTI
+    '''
+
+    start,stop = gti
+    n_bins = np.floor((np.asarray(stop)-np.asarray(start))/timedel+1e-9).astype(np.int64)
+    n_bins = np.maximum(n_bins,0)
+    gti_index = np.repeat(np.arange(len(n_bins)),n_bins)
+    first = np.cumsum(n_bins)-n_bins
+    bin_start = np.asarray(start)[gti_index]+\
+        (np.arange(n_bins.sum())-first[gti_index])*timedel
+
+    return bin_start,n_bins
+
+def count_cube_stage(full_exp_dir,inst,timedel=CUBE_TIMEDEL,minpi=None,maxpi=None,
+    group=CUBE_GROUP,det_ids=None,chunk_cells=CUBE_CHUNK_CELLS,
+    out_dir=pathlib.Path.cwd(),override=False):
+    '''
+    Histograms the screened events of an exposure into a time x channel
+    count cube
+
+    DESCRIPTION
+    -----------
+    The cube is a binary table (CUBE extension) with one row per time
+    bin: bin start time (TIME) and counts of each channel group (COUNTS,
+    32 bit integer vector). Only the time bins inside the GTIs are
+    stored (see gti_bins), so gaps between GTIs (ex. Earth occultations)
+    cost nothing. Events are read once, in chunks of at most
+    chunk_cells cells, and each chunk is appended to the table as soon
+    as it is binned, so memory usage does not depend on the exposure
+    length. Channel groups (CHANNELS extension) and GTIs with their
+    number of bins (GTI extension, NBINS) are appended afterwards.
+    Band lightcurves are then obtained summing cube columns (see
+    cube_lightcurve).
+
+    PARAMETERS
+    ----------
+    full_exp_dir: string or pathlib.Path
+        Full path of the esposure folder
+    inst: string
+        Instrument (HE, ME, or LE)
+    timedel: float, optional
+        Time resolution [s] (default is CUBE_TIMEDEL)
+    minpi, maxpi: integer or None, optional
+        Energy channel range. If None, the full channel range of the
+        instrument is used
+    group: integer or list, optional
+        Channel grouping (see channel_groups). Default is CUBE_GROUP
+    det_ids: string or None, optional
+        Detector selection string. If None, the lightcurve detectors of
+        the instrument are used
+    chunk_cells: integer, optional
+        Maximum number of cells binned at once
+    out_dir: string or pathlib.Path(), optional
+        Name of the output products folder (containing the analysis
+        folder). Default is current working directory.
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    outfile: pathlib.Path or None
+        Count cube, in the form:
+        <out_dir>/analysis/<exp_ID>/<INST>/
+            <exp_ID>_<INST>_cube_ch<minpi>-<maxpi>_<n_groups>grp_<timedel>s.fits
+    '''
+
+    logging.info('===>>> Running count_cube_stage <<<===')
+
+    if type(full_exp_dir) == str: full_exp_dir = pathlib.Path(full_exp_dir)
+    if type(out_dir) == str: out_dir = pathlib.Path(out_dir)
+
+    # Checking exposure folder format
+    if not check_exp_format(full_exp_dir):
+        logging.info('Something is wrong in the exposure folder name, check:')
+        logging.info(full_exp_dir)
+        return
+
+    exp_ID = str(full_exp_dir.name)
+    exp_dir = out_dir/'analysis'/exp_ID
+    if not (exp_dir/inst).is_dir(): os.makedirs(exp_dir/inst)
+
+    cols = INSTRUMENTS[inst]
+    if minpi is None: minpi = 0
+    if maxpi is None: maxpi = cols['n_chan']-1
+    if det_ids is None: det_ids = cols['lc_det_ids']
+    pi_lo,pi_hi = channel_groups(minpi,maxpi,group)
+    n_groups = len(pi_lo)
+
+    outfile = cube_name(exp_dir,exp_ID,inst,minpi,maxpi,n_groups,timedel)
+    if outfile.is_file() and not override:
+        logging.info('Count cube already exists')
+        return outfile
+
+    screen_file,gti_file = exposure_products(exp_dir,exp_ID,inst)
+    if screen_file is None or gti_file is None:
+        logging.error('{} screened event file or GTI missing'.format(inst))
+        return
+    gti = read_gti(gti_file)
+    if len(gti[0]) == 0:
+        logging.error('Empty GTI')
+        return
+
+    # Time bins inside the GTIs and chunks of rows
+    # -----------------------------------------------------------------
+    bin_start,n_bins = gti_bins(gti,timedel)
+    n_time = len(bin_start)
+    if n_time == 0:
+        logging.error('GTIs shorter than the time resolution')
+        return
+    chunk_bins = max(1,chunk_cells//n_groups)
+    first_bins = np.arange(0,n_time,chunk_bins)
+    last_bins = np.minimum(first_bins+chunk_bins,n_time)
+    # -----------------------------------------------------------------
+
+    # Channel to group lookup table (-1 outside the groups)
+    lookup = np.full(max(cols['n_chan'],maxpi+1),-1,dtype=np.int64)
+    for k in range(n_groups): lookup[pi_lo[k]:pi_hi[k]+1] = k
+
+    logging.info('Binning {} time bins x {} channel groups'.format(n_time,n_groups))
+    windows = iter_event_windows(screen_file,[cols['pi_col'],cols['det_col']],
+        bin_start[first_bins],bin_start[last_bins-1]+timedel)
+
+    row_type = np.dtype([('TIME','>f8'),('COUNTS','>i4',(n_groups,))])
+    def blocks():
+        for first,last,data in zip(first_bins,last_bins,windows):
+            starts = bin_start[first:last]
+            pi = data[cols['pi_col']].astype(np.int64)
+            time = data['TIME']
+            keep = det_mask(data[cols['det_col']],det_ids) & (pi >= 0) & \
+                (pi < len(lookup))
+            groups = lookup[pi[keep]]
+            time = time[keep]
+            # Events between GTIs fall after the end of their bin
+            index = np.searchsorted(starts,time,side='right')-1
+            keep = (groups >= 0) & (index >= 0)
+            keep[keep] = time[keep] < starts[index[keep]]+timedel
+            counts = np.bincount(index[keep]*n_groups+groups[keep],
+                minlength=(last-first)*n_groups)
+            rows = np.empty(last-first,dtype=row_type)
+            rows['TIME'] = starts
+            rows['COUNTS'] = counts.reshape(-1,n_groups)
+            yield rows
+
+    header = fits.BinTableHDU.from_columns([
+        fits.Column(name='TIME',format='D',unit='s',array=np.zeros(0)),
+        fits.Column(name='COUNTS',format='{}J'.format(n_groups),unit='counts',
+            array=np.zeros((0,n_groups)))],name='CUBE').header
+    header['NAXIS2'] = n_time
+    header['INSTRUME'] = ('HXMT/'+inst,'')
+    header['OBS_ID'] = (exp_ID,'')
+    header['TSTART'] = (bin_start[0],'Start of the first time bin [s]')
+    header['TSTOP'] = (bin_start[-1]+timedel,'End of the last time bin [s]')
+    header['TIMEDEL'] = (timedel,'Time resolution [s]')
+    header['TIMEPIXR'] = (0.,'Time bins are labelled by their start')
+    header['CHMIN'] = (int(minpi),'Minimum PI channel')
+    header['CHMAX'] = (int(maxpi),'Maximum PI channel')
+    header['DETIDS'] = (det_ids,'Selected detectors')
+    header['HISTORY'] = 'Binned from {}'.format(pathlib.Path(screen_file).name)
+
+    tmp_file = outfile.with_name(outfile.name+'.tmp')
+    with open(tmp_file,'wb') as out:
+        write_hdu_stream(out,fits.PrimaryHDU().header,[])
+        n_bytes = write_hdu_stream(out,header,blocks())
+    if n_bytes != n_time*row_type.itemsize:
+        logging.error('Inconsistent number of cube rows')
+        os.remove(tmp_file)
+        return
+    with fits.open(tmp_file,mode='append') as hdu_list:
+        hdu_list.append(fits.BinTableHDU.from_columns([
+            fits.Column(name='PI_LO',format='J',array=pi_lo),
+            fits.Column(name='PI_HI',format='J',array=pi_hi)],name='CHANNELS'))
+        hdu_list.append(fits.BinTableHDU.from_columns([
+            fits.Column(name='START',format='D',unit='s',array=gti[0]),
+            fits.Column(name='STOP',format='D',unit='s',array=gti[1]),
+            fits.Column(name='NBINS',format='K',array=n_bins)],name='GTI'))
+    os.replace(tmp_file,outfile)
+
+    return outfile
+
+def cube_lightcurve(cube_file,minpi=None,maxpi=None,rebin=1,dead_file=None,
+    outfile=None,chunk_cells=CUBE_CHUNK_CELLS):
+    '''
+    Derives a band lightcurve from a count cube
+
+    DESCRIPTION
+    -----------
+    The cube (memory mapped) is read in row chunks, summing the channel
+    groups fully included in [minpi, maxpi]. Bins are rebinned within
+    each GTI (incomplete bins at the end of a GTI are dropped). The
+    event file is not read. If a dead time file is given, rates are
+    corrected with the live time fraction of each bin of the cube
+    detectors (see deadtime_funcs.live_fraction).
+
+    PARAMETERS
+    ----------
+    cube_file: string or pathlib.Path
+        Count cube (output of count_cube_stage)
+    minpi, maxpi: integer or None, optional
+        Energy channel range. If None, the cube range is used
+    rebin: integer, optional
+        Number of cube time bins per lightcurve bin (default is 1)
+    dead_file: string or pathlib.Path or None, optional
+        Dead time file of the exposure (see
+        deadtime_funcs.find_dead_time_file, HE and ME only). If None
+        (default), rates are not corrected
+    outfile: string or pathlib.Path or None, optional
+        If specified, the lightcurve is written in OGIP format
+    chunk_cells: integer, optional
+        Maximum number of cells read at once
+
+    RETURNS
+    -------
+    lc: dictionary
+        time (bin centers), counts, rate, error, live (live time
+        fraction, None if not corrected), timedel, chmin, chmax (channel
+        range actually used), gti
+    '''
+
+    with fits.open(cube_file,memmap=True) as hdu_list:
+        header = hdu_list['CUBE'].header
+        cube = raw_records(hdu_list['CUBE'])
+        channels = hdu_columns(hdu_list['CHANNELS'],['PI_LO','PI_HI'])
+        pi_lo,pi_hi = channels['PI_LO'],channels['PI_HI']
+        gti = hdu_columns(hdu_list['GTI'],['START','STOP','NBINS'])
+        n_bins = gti['NBINS']
+        gti = (gti['START'],gti['STOP'])
+
+        if minpi is None: minpi = pi_lo[0]
+        if maxpi is None: maxpi = pi_hi[-1]
+        selected = np.flatnonzero((pi_lo >= minpi) & (pi_hi <= maxpi))
+        if len(selected) == 0:
+            raise ValueError('No channel group in {}-{}'.format(minpi,maxpi))
+        g0,g1 = selected[0],selected[-1]+1
+
+        chunk_bins = max(rebin,chunk_cells//len(pi_lo)//rebin*rebin)
+        time,counts = [],[]
+        offset = 0
+        for n in n_bins:
+            n_out = n//rebin
+            for first in range(offset,offset+n_out*rebin,chunk_bins):
+                last = min(first+chunk_bins,offset+n_out*rebin)
+                block = cube['COUNTS'][first:last,g0:g1].sum(axis=1,dtype=np.int64)
+                counts += [block.reshape(-1,rebin).sum(axis=1)]
+                time += [cube['TIME'][first:last:rebin].astype(np.float64)]
+            offset += n
+        counts = np.concatenate(counts) if counts else np.zeros(0,dtype=np.int64)
+        time = np.concatenate(time) if time else np.zeros(0)
+
+        timedel = header['TIMEDEL']*rebin
+        time = time+timedel/2.
+        lc_header = header.copy()
+
+    live = None
+    if dead_file is None:
+        rate,error = counts/timedel,np.sqrt(counts)/timedel
+    else:
+        inst = lc_header['INSTRUME'].split('/')[-1]
+        live = live_fraction(dead_file,inst,time-timedel/2.,time+timedel/2.,
+            det_ids=lc_header.get('DETIDS'))
+        rate,error = dead_time_correct(counts,timedel,live)
+
+    lc = {'time':time,'counts':counts,'rate':rate,'error':error,'live':live,
+        'timedel':timedel,'chmin':int(pi_lo[g0]),'chmax':int(pi_hi[g1-1]),'gti':gti}
+
+    if not outfile is None:
+        lc_header['TIMEDEL'] = timedel
+        lc_header['TIMEPIXR'] = 0.5
+        lc_header['CHMIN'] = lc['chmin']
+        lc_header['CHMAX'] = lc['chmax']
+        lc_header['DEADAPP'] = (not live is None,'Dead time correction applied')
+        history = ['Derived from {}'.format(pathlib.Path(cube_file).name)]
+        if not live is None:
+            history += ['Dead time from {}'.format(pathlib.Path(dead_file).name)]
+        write_lightcurve(outfile,time,rate,error,header=lc_header,gti=gti,
+            history=history)
+
+    return lc
@@ -0,0 +1,211 @@
+import pathlib
+import logging
+
+import numpy as np
+from astropy.io import fits
+
+from .native_funcs import compile_det_ids
+
+# Layout of the dead time tables of each instrument (dead time is a
+# vector column, one element per detector):
+# - HE: HE-DTime raw file, running dead time counters [s] of the 18
+#   detectors sampled at TIME
+# - ME: dead time file written by megrade (_ME_dtime_<bin>s.fits), dead
+#   time fraction of each detector in each interval
+DEAD_TIME_LAYOUTS = {
+    'HE':{'time_col':'TIME','dead_col':'DEADTIME','fraction':False,
+        'cumulative':True},
+    'ME':{'time_col':'TIME','dead_col':'DEADTIME','fraction':True,
+        'cumulative':False}
+    }
+
+def find_dead_time_file(full_exp_dir,exp_dir,inst):
+    '''
+    Returns the dead time file of an exposure and instrument (HE-DTime
+    raw file for HE, megrade output for ME), None if not available
+    '''
+
+    if inst == 'HE':
+        dead = sorted((pathlib.Path(full_exp_dir)/'HE').glob('*HE-DTime*'))
+    elif inst == 'ME':
+        dead = sorted((pathlib.Path(exp_dir)/'ME').glob('*_ME_dtime_*s.fits'))
+    else:
+        dead = []
+
+    return dead[0] if len(dead) > 0 else None
+
+def read_dead_time(dead_file,inst):
+    '''
+    Reads a dead time table (HE-DTime raw file or ME dead time file
+    produced by megrade)
+
+    DESCRIPTION
+    -----------
+    Dead time is returned as seconds of dead time accumulated by each
+    detector during each sampling interval. Sampling intervals start at
+    the TIME values and end at the following TIME value (the last one
+    has the median sampling length). Running counters are differenced
+    between consecutive samples, so their intervals end at the last
+    TIME value.
+    The table layout of each instrument is given in DEAD_TIME_LAYOUTS:
+    dead time is read from a vector column (dead_col, one element per
+    detector), as seconds or fractions of each interval (fraction), and
+    per interval or as running counters (cumulative).
+
+    PARAMETERS
+    ----------
+    dead_file: string or pathlib.Path
+        Dead time file
+    inst: string
+        Instrument (HE or ME)
+
+    RETURNS
+    -------
+    edges: numpy.ndarray
+        Sampling interval boundaries (n_samples+1,)
+    dead: numpy.ndarray
+        Dead time [s] per interval and detector (n_samples, n_det)
+    '''
+
+    if not inst in DEAD_TIME_LAYOUTS:
+        raise ValueError('No dead time table for {}'.format(inst))
+    layout = DEAD_TIME_LAYOUTS[inst]
+
+    with fits.open(dead_file,memmap=True) as hdu_list:
+        hdu = [h for h in hdu_list if isinstance(h,fits.BinTableHDU)][0]
+        names = {n.upper():n for n in hdu.columns.names}
+        for col in [layout['time_col'],layout['dead_col']]:
+            if not col in names:
+                raise ValueError('No {} column in {}'.format(col,dead_file))
+        time = np.array(hdu.data[names[layout['time_col']]],dtype=np.float64)
+        dead = np.array(hdu.data[names[layout['dead_col']]],dtype=np.float64).\
+            reshape(len(time),-1)
+
+    order = np.argsort(time,kind='mergesort')
+    time,dead = time[order],dead[order]
+
+    if layout['cumulative']:
+        # Counters are sampled at the interval boundaries
+        if len(time) < 2:
+            raise ValueError('Less than two dead time samples in {}'.format(dead_file))
+        edges = time
+        dead = np.diff(dead,axis=0)
+        # Counter resets
+        dead[dead < 0] = 0.
+    else:
+        step = np.median(np.diff(time)) if len(time) > 1 else 1.
+        edges = np.append(time,time[-1]+step)
+    if layout['fraction']:
+        dead = dead*np.diff(edges)[:,None]
+
+    return edges,dead
+
+def dead_time_on_grid(edges,dead,grid,det_ids=None):
+    '''
+    Dead time accumulated within each bin of an arbitrary time grid
+
+    DESCRIPTION
+    -----------
+    The cumulative dead time is linearly interpolated at the grid
+    boundaries, i.e. dead time is assumed uniform within each sampling
+    interval. This works for grids finer (interpolation) and coarser
+    (aggregation) than the dead time table.
+    All detectors are processed at once.
+
+    PARAMETERS
+    ----------
+    edges: numpy.ndarray
+        Sampling interval boundaries of the dead time table
+    dead: numpy.ndarray
+        Dead time per interval and detector (see read_dead_time)
+    grid: numpy.ndarray
+        Time bin boundaries (n_bins+1,)
+    det_ids: string or None, optional
+        Detector selection string (see native_funcs.compile_det_ids).
+        If None (default), all detectors are used
+
+    RETURNS
+    -------
+    grid_dead: numpy.ndarray
+        Dead time [s] per bin (n_bins,), averaged over the selected
+        detectors
+    '''
+
+    grid = np.asarray(grid,dtype=np.float64)
+
+    if not det_ids is None:
+        selected = compile_det_ids(det_ids)[0][:dead.shape[1]]
+        dead = dead[:,selected]
+    dead = dead.mean(axis=1)
+
+    cum_dead = np.concatenate([[0.],np.cumsum(dead)])
+    grid_cum = np.interp(grid,edges,cum_dead)
+
+    return np.diff(grid_cum)
+
+def live_fraction(dead_file,inst,start,stop,det_ids=None):
+    '''
+    Live time fraction of each bin of a time grid
+
+    PARAMETERS
+    ----------
+    dead_file: string or pathlib.Path
+        Dead time file (HE-DTime raw file or ME dead time file)
+    inst: string
+        Instrument (HE or ME)
+    start, stop: numpy.ndarray
+        Bin boundaries (n_bins,), sorted and not overlapping. Bins do
+        not need to be contiguous (ex. bins inside the GTIs only)
+    det_ids: string or None, optional
+        Detector selection string
+
+    RETURNS
+    -------
+    live: numpy.ndarray
+        Live time fraction per bin (n_bins,), between 0 and 1
+    '''
+
+    logging.info('Computing live time from {}'.format(pathlib.Path(dead_file).name))
+
+    start = np.asarray(start,dtype=np.float64)
+    stop = np.asarray(stop,dtype=np.float64)
+    edges,dead = read_dead_time(dead_file,inst)
+    # Gaps between bins are bins too, they are discarded
+    grid_dead = dead_time_on_grid(edges,dead,np.column_stack([start,stop]).ravel(),
+        det_ids=det_ids)[::2]
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.clip(1.-grid_dead/(stop-start),0.,1.)
+
+def dead_time_correct(counts,width,live,min_live=0.05):
+    '''
+    Returns dead time corrected count rates and errors
+
+    PARAMETERS
+    ----------
+    counts: numpy.ndarray
+        Counts per bin (..., n_bins), several lightcurves can be
+        corrected at once
+    width: float or numpy.ndarray
+        Bin width(s) [s]
+    live: numpy.ndarray
+        Live time fraction per bin (n_bins,)
+    min_live: float, optional
+        Bins with live fraction below this threshold are set to NaN
+        (default is 0.05)
+
+    RETURNS
+    -------
+    rate, error: numpy.ndarray
+        Corrected count rate and Poisson error
+    '''
+
+    exposure = np.asarray(width,dtype=np.float64)*live
+    with np.errstate(divide='ignore',invalid='ignore'):
+        rate = counts/exposure
+        error = np.sqrt(counts)/exposure
+    bad = live < min_live
+    rate[...,bad] = np.nan
+    error[...,bad] = np.nan
+
+    return rate,error
@@ -0,0 +1,325 @@
+import os
+import logging
+import pathlib
+import contextlib
+
+import numpy as np
+from astropy.io import fits
+
+# Memory mapped access to FITS binary tables.
+# Tables are opened memory mapped and columns are exposed as views of
+# the raw (big endian, unscaled) records, so reading a few columns of a
+# large event file costs page faults on the accessed bytes only: no
+# FITS_rec column conversion, no scaling copy of the whole table.
+# Native byte order (and TSCAL/TZERO scaling, when present) is applied
+# only to the selected rows by hdu_columns and to_native.
+
+# FITS block and header card sizes (bytes)
+BLOCK = 2880
+CARD = 80
+
+def find_table(hdu_list,ext=None):
+    '''
+    Returns a table of an opened FITS file
+
+    PARAMETERS
+    ----------
+    hdu_list: astropy.io.fits.HDUList
+        Opened FITS file
+    ext: string, integer, or None, optional
+        Extension name or index. If None, the EVENTS extension, if
+        present, otherwise the first extension
+    '''
+
+    if ext is None:
+        for hdu in hdu_list:
+            if hdu.name.upper() == 'EVENTS': return hdu
+        return hdu_list[1]
+    return hdu_list[ext]
+
+@contextlib.contextmanager
+def open_table(fits_file,ext=None):
+    '''
+    Opens a FITS file memory mapped and yields one of its tables (see
+    find_table). The file is closed when the context is exited
+    '''
+
+    with fits.open(fits_file,memmap=True) as hdu_list:
+        yield find_table(hdu_list,ext)
+
+def raw_records(hdu):
+    '''
+    Returns the raw (big endian, unscaled) memory mapped records of a
+    binary table
+    '''
+
+    return np.ndarray.view(hdu.data,np.ndarray)
+
+def column_scale(hdu,col):
+    '''
+    Returns the (TSCAL, TZERO) of a column, None if it is not scaled
+    '''
+
+    column = hdu.columns[col]
+    tscal = 1 if column.bscale is None else column.bscale
+    tzero = 0 if column.bzero is None else column.bzero
+    if tscal == 1 and tzero == 0: return
+    return tscal,tzero
+
+def to_native(values,scale=None):
+    '''
+    Converts raw column values into native byte order, applying the
+    column scaling (see column_scale)
+
+    DESCRIPTION
+    -----------
+    Unsigned integers (TZERO equal to 2^(bits-1)) are converted
+    flipping the sign bit, other scaled columns become float64.
+    '''
+
+    values = values.astype(values.dtype.newbyteorder('='))
+    if scale is None: return values
+
+    tscal,tzero = scale
+    if values.dtype.kind == 'i' and tscal == 1 and \
+        tzero == 2**(8*values.dtype.itemsize-1):
+        unsigned = np.dtype('u{}'.format(values.dtype.itemsize))
+        return values.view(unsigned)^unsigned.type(tzero)
+    return values*np.float64(tscal)+np.float64(tzero)
+
+def column_views(hdu,columns=None):
+    '''
+    Returns raw memory mapped views of the columns of a binary table
+
+    DESCRIPTION
+    -----------
+    Values are in FITS (big endian) byte order and are not scaled.
+    Scaled columns raise a ValueError, use hdu_columns instead.
+
+    PARAMETERS
+    ----------
+    hdu: astropy.io.fits.BinTableHDU
+        Table (opened memory mapped)
+    columns: list or None, optional
+        Columns to return. If None, all the columns
+
+    RETURNS
+    -------
+    views: dictionary
+        Column name: numpy.ndarray
+    '''
+
+    raw = raw_records(hdu)
+    if columns is None: columns = list(raw.dtype.names)
+
+    views = {}
+    for col in columns:
+        if not column_scale(hdu,col) is None:
+            raise ValueError('Column {} is scaled (TSCAL/TZERO)'.format(col))
+        views[col] = raw[col]
+
+    return views
+
+def hdu_columns(hdu,columns,rows=None):
+    '''
+    Reads columns of a binary table in native byte order
+
+    DESCRIPTION
+    -----------
+    Only the selected rows of the requested columns are read from the
+    raw memory mapped records and converted (see to_native).
+
+    PARAMETERS
+    ----------
+    hdu: astropy.io.fits.BinTableHDU
+        Table
+    columns: list
+        Columns to read
+    rows: slice, numpy.ndarray, or None, optional
+        Selected rows (slice, indices, or boolean mask). If None, all
+        the rows
+
+    RETURNS
+    -------
+    data: dictionary
+        Column name: numpy.ndarray
+    '''
+
+    raw = raw_records(hdu)
+    data = {}
+    for col in columns:
+        values = raw[col] if rows is None else raw[col][rows]
+        data[col] = to_native(values,column_scale(hdu,col))
+
+    return data
+
+def read_columns(fits_file,columns,ext=None,rows=None):
+    '''
+    Reads columns of a table of a FITS file in native byte order (see
+    find_table and hdu_columns)
+    '''
+
+    with open_table(fits_file,ext) as hdu:
+        return hdu_columns(hdu,columns,rows)
+
+def table_names(hdu):
+    '''
+    Returns the upper case column names of a binary table
+    '''
+
+    return [name.upper() for name in hdu.columns.names]
+
+def _card_value(cards,key,default=None):
+    '''
+    Returns the value of a keyword from a list of raw header cards
+    '''
+
+    for card in cards:
+        if card[:8].decode('ascii').strip() == key:
+            return fits.Card.fromstring(card.decode('ascii')).value
+    return default
+
+def _edit_header_cards(fits_file,keys,hdus=None):
+    '''
+    Edits header keywords in place, replacing the raw 80-byte cards
+
+    DESCRIPTION
+    -----------
+    Headers are read block by block and data blocks are skipped, so
+    only the modified header blocks are written. All the edits are
+    prepared before writing: if any of them cannot be done in place (a
+    card longer than 80 bytes, a keyword continued on CONTINUE cards,
+    or no free card left in the last header block) nothing is written
+    and False is returned.
+    '''
+
+    edits = []
+    with open(fits_file,'r+b') as infile:
+        size = os.fstat(infile.fileno()).st_size
+        pos,index = 0,0
+        while pos < size:
+            infile.seek(pos)
+            header = b''
+            while True:
+                block = infile.read(BLOCK)
+                if len(block) < BLOCK: return False
+                header += block
+                cards = [header[i:i+CARD] for i in range(0,len(header),CARD)]
+                ends = [i for i,card in enumerate(cards) if card[:8] == b'END     ']
+                if len(ends) > 0: break
+            end = ends[0]
+
+            extname = str(_card_value(cards[:end],'EXTNAME','PRIMARY' if index == 0 else ''))
+            if hdus is None or index in hdus or extname.strip().upper() in hdus:
+                new_cards = cards[:end]
+                for key,value in keys.items():
+                    image = fits.Card(key,value).image.encode('ascii')
+                    if len(image) != CARD: return False
+                    names = [card[:8].decode('ascii').strip() for card in new_cards]
+                    if key.upper() in names:
+                        i = names.index(key.upper())
+                        if i+1 < len(names) and names[i+1] == 'CONTINUE': return False
+                        new_cards[i] = image
+                    else:
+                        new_cards += [image]
+                if len(new_cards) >= len(cards): return False
+                new_header = b''.join(new_cards)+b'END'.ljust(CARD)
+                new_header = new_header.ljust(len(header),b' ')
+                if new_header != header: edits += [(pos,new_header)]
+
+            # Data size (see FITS standard, section 4.4.1.1)
+            naxis = _card_value(cards[:end],'NAXIS',0)
+            n_data = 0
+            if naxis > 0:
+                n_data = 1
+                for i in range(naxis): n_data *= _card_value(cards[:end],'NAXIS{}'.format(i+1),0)
+                n_data = abs(_card_value(cards[:end],'BITPIX'))//8*\
+                    _card_value(cards[:end],'GCOUNT',1)*\
+                    (_card_value(cards[:end],'PCOUNT',0)+n_data)
+            pos += len(header)+-(-n_data//BLOCK)*BLOCK
+            index += 1
+
+        for offset,new_header in edits:
+            infile.seek(offset)
+            infile.write(new_header)
+
+    return True
+
+def update_header_keys(fits_file,keys,hdus=None):
+    '''
+    Updates header keywords of a FITS file with a single open
+
+    DESCRIPTION
+    -----------
+    Cards are edited in place, without rewriting data blocks (see
+    _edit_header_cards). If that is not possible, the file is opened
+    once in update mode with astropy and all the keywords are set.
+
+    PARAMETERS
+    ----------
+    fits_file: string or pathlib.Path
+        FITS file
+    keys: dictionary
+        Keyword: value
+    hdus: list or None, optional
+        Extension names (upper case) or indices of the HDUs to update.
+        If None, all the HDUs
+
+    RETURNS
+    -------
+    in_place: boolean
+        True if the cards were edited in place
+    '''
+
+    if not hdus is None:
+        hdus = [h.upper() if isinstance(h,str) else h for h in hdus]
+    if _edit_header_cards(fits_file,keys,hdus): return True
+
+    with fits.open(fits_file,mode='update') as hdu_list:
+        for i,hdu in enumerate(hdu_list):
+            if not hdus is None and not i in hdus and not hdu.name.upper() in hdus:
+                continue
+            for key,value in keys.items():
+                hdu.header[key] = value
+    return False
+
+def queue_header_keys(updates,fits_file,keys):
+    '''
+    Adds keywords to the pending header updates of a FITS file (see
+    apply_header_updates)
+    '''
+
+    updates.setdefault(pathlib.Path(fits_file),{}).update(keys)
+
+def apply_header_updates(updates,hdus=None):
+    '''
+    Applies the pending header updates of a batch of FITS files, one
+    open per file (see update_header_keys)
+
+    PARAMETERS
+    ----------
+    updates: dictionary
+        FITS file: dictionary of keywords (see queue_header_keys). It
+        is emptied
+    hdus: list or None, optional
+        HDUs to update. If None, all the HDUs
+
+    RETURNS
+    -------
+    n_files: integer
+        Number of updated files
+    '''
+
+    n_files,n_rewritten = 0,0
+    for fits_file,keys in updates.items():
+        if not fits_file.is_file():
+            logging.warning('Cannot update header of {}, file not found'.format(fits_file))
+            continue
+        if not update_header_keys(fits_file,keys,hdus): n_rewritten += 1
+        n_files += 1
+    updates.clear()
+
+    if n_files > 0:
+        logging.info('Headers of {} files updated ({} rewritten by astropy)'.\
+            format(n_files,n_rewritten))
+    return n_files
@@ -3,6 +3,8 @@ from os import path
 import sys
 import pathlib
 from .my_funcs import list_items
+from .native_funcs import INSTRUMENTS, screen_events, sidecar_name, read_bad_det_ids, \
+    exposure_products, cache_events, open_event_cache, cache_name
 
 import glob
 import numpy as np
@@ -281,7 +283,8 @@ def he_gti(full_exp_dir,out_dir=pathlib.Path.cwd(),override=False):
     return outfile
 
 def he_screen(full_exp_dir,cal_evt_file=None,gti_file=None,
-        out_dir = pathlib.Path.cwd(),minpi=0,maxpi=255,override=False):
+        out_dir = pathlib.Path.cwd(),minpi=0,maxpi=255,override=False,
+        native=False,sidecar=False):
     '''
     Runs HXMT tool he_screen creating a screened event file
 
@@ -313,12 +316,19 @@ def he_screen(full_exp_dir,cal_evt_file=None,gti_file=None,
         Default is current working directory.
     override: boolean, optional
         If True, existing files will be overwritten
+    native: boolean, optional
+        If True, screening is performed natively (native_funcs.screen_events)
+        instead of running hescreen. Default is False
+    sidecar: boolean, optional
+        Only used when native is True. If True, a row-index sidecar
+        (<exp_ID>_HE_evt_screen_idx.npy) is written instead of a new 
+        event file. Default is False
 
     RETURN
     ------
     outfile: pathlib.Path or boolean
-        The full path of the screen event file. If some operation
-        is not successfull, it returns False.
+        The full path of the screen event file (or of the row-index
+        sidecar). If some operation is not successfull, it returns False.
 
     HISTORY
     -------
@@ -329,6 +339,7 @@ def he_screen(full_exp_dir,cal_evt_file=None,gti_file=None,
         file is returned
     2021 05 06, Stefano Rapisarda (Uppsala)
         Improved functionality and updated to pathlib.Path
+    2026 10 19, native and sidecar options added
     '''
 
     logging.info('===>>> Running he_screen <<<===')
@@ -388,6 +399,7 @@ def he_screen(full_exp_dir,cal_evt_file=None,gti_file=None,
 
     # Initializing outfile
     outfile=destination/'{}_HE_evt_screen.fits'.format(exp_ID)
+    if native and sidecar: outfile = sidecar_name(outfile)
 
     compute = True
     if outfile.is_file():
@@ -397,12 +409,23 @@ def he_screen(full_exp_dir,cal_evt_file=None,gti_file=None,
     if compute or override:
         logging.info('Performing HE screening')    
 
-        # Running hescreen
-        cmd = f'hescreen evtfile={cal_evt_file} gtifile={gti_file} \
-            outfile={outfile} userdetid="0-17" eventtype=1 \
-            anticoincidence=yes starttime=0 stoptime=0 \
-            minPI={minpi} maxPI={maxpi}  clobber=yes history=yes'
-        os.system(cmd)
+        if native:
+            # Native screening
+            he_pars = INSTRUMENTS['HE']
+            outfile = screen_events(cal_evt_file,gti_file,
+                destination/'{}_HE_evt_screen.fits'.format(exp_ID),'HE',
+                minpi=minpi,maxpi=maxpi,det_ids=he_pars['det_ids'],
+                event_type=he_pars['event_type'],anticoincidence=True,
+                sidecar=sidecar)
+        else:
+            # Running hescreen
+            event_type = INSTRUMENTS['HE']['tool_event_type']
+            cmd = f'hescreen evtfile={cal_evt_file} gtifile={gti_file} \
+                outfile={outfile} userdetid="0-17" \
+                eventtype={event_type} \
+                anticoincidence=yes starttime=0 stoptime=0 \
+                minPI={minpi} maxPI={maxpi}  clobber=yes history=yes'
+            os.system(cmd)
 
         # Verifing successful running
         if not outfile.is_file():
@@ -530,9 +553,10 @@ def he_spec(full_exp_dir,screen_evt_file=None,out_dir=pathlib.Path.cwd(),
         # -------------------------------------------------------------
 
         # Running hespecgen
+        event_type = INSTRUMENTS['HE']['tool_event_type']
         cmd = f'hespecgen evtfile={screen_evt_file} outfile={outfile_root} \
             deadfile={dead} userdetid="{user_det_id}" \
-            eventtype=1 starttime=0 stoptime=0 \
+            eventtype={event_type} starttime=0 stoptime=0 \
             minPI={minpi} maxPI={maxpi} clobber=yes'
         os.system(cmd)
         
@@ -752,7 +776,7 @@ def he_lc(full_exp_dir,screen_evt_file=None,
     outfile_root=destination/file_name_root
 
     lc_test = list_items(destination,itype='file',include_or=file_name_root,
-        exclude_or='bkg',ext='lc')
+        exclude_or=['bkg','net'],ext='lc')
     
     compute = True
     if lc_test:
@@ -778,14 +802,16 @@ def he_lc(full_exp_dir,screen_evt_file=None,
         # -------------------------------------------------------------
 
         # Running helcgen
+        event_type = INSTRUMENTS['HE']['tool_event_type']
         cmd = f'helcgen evtfile={screen_evt_file} outfile={outfile_root} \
             deadfile={dead} deadcorr=yes starttime=0 stoptime=0 \
-            userdetid="{user_det_id}" eventtype=1 minPI={minpi} maxPI={maxpi} \
+            userdetid="{user_det_id}" eventtype={event_type} \
+            minPI={minpi} maxPI={maxpi} \
             binsize={binsize} clobber=yes'
         os.system(cmd)
 
         lc_file = list_items(destination,itype='file',include_or=file_name_root,
-            exclude_or='bkg',ext='lc')
+            exclude_or=['bkg','net'],ext='lc')
     
         # Verifing successful running
         if not lc_file:
@@ -1419,7 +1445,7 @@ def me_gticorr(full_exp_dir,grade_evt_file=None,gti_file=None,
 
 def me_screen(full_exp_dir,grade_evt_file=None,gti_file=None,bad_det_file=None,
             out_dir = pathlib.Path.cwd(),
-            minpi=0,maxpi=1023,override=False):
+            minpi=0,maxpi=1023,override=False,native=False,sidecar=False):
     '''
     It runs HXMT tool me_screen
 
@@ -1448,18 +1474,27 @@ def me_screen(full_exp_dir,grade_evt_file=None,gti_file=None,bad_det_file=None,
         Maximum energy channel, default is 1023
     override: boolean (optional)
         If True output files are overwritten (default is False)
+    native: boolean, optional
+        If True, screening is performed natively (native_funcs.screen_events)
+        instead of running mescreen. If the bad detector file does not
+        contain detector IDs, mescreen is used. Default is False
+    sidecar: boolean, optional
+        Only used when native is True. If True, a row-index sidecar
+        (<exp_ID>_ME_evt_screen_idx.npy) is written instead of a new 
+        event file. Default is False
 
     RETURNS
     -------
     outfile: pathlib.Path or boolean
-        The full path of the screened file. If some of the operations
-        is not successfull, it returns False.
+        The full path of the screened file (or of the row-index sidecar).
+        If some of the operations is not successfull, it returns False.
         The output file has format: <destination>/<exp_if>_ME_evt_screen.fits
     
     HISTORY
     -------
     2021 05 06, Stefano Rapisarda (Uppsala)
         Improved functionality and updated to pathlib.Path
+    2026 10 19, native and sidecar options added
     '''
 
     logging.info('===>>> Running me_screen <<<===')
@@ -1536,6 +1571,14 @@ def me_screen(full_exp_dir,grade_evt_file=None,gti_file=None,bad_det_file=None,
     # Initializing outfile
     outfile=destination/'{}_ME_evt_screen.fits'.format(exp_ID)
 
+    bad_det_ids = None
+    if native:
+        bad_det_ids = read_bad_det_ids(bad_det_file)
+        if bad_det_ids is None:
+            logging.info('Bad detector IDs not readable, running mescreen')
+            native = False
+    if native and sidecar: outfile = sidecar_name(outfile)
+
     compute = True
     if outfile.is_file():
         logging.info('ME screened event file already exists')
@@ -1544,12 +1587,21 @@ def me_screen(full_exp_dir,grade_evt_file=None,gti_file=None,bad_det_file=None,
     if compute or override:
         logging.info('Performing ME screening')    
 
-        # Running hescreen
-        cmd = f'mescreen evtfile={grade_evt_file} gtifile={gti_file} \
-            baddetfile={bad_det_file} outfile={outfile} userdetid="0-53" \
-            starttime=0 stoptime=0 minPI={minpi} maxPI={maxpi} \
-            clobber=yes history=yes'
-        os.system(cmd)
+        if native:
+            # Native screening
+            me_pars = INSTRUMENTS['ME']
+            outfile = screen_events(grade_evt_file,gti_file,
+                destination/'{}_ME_evt_screen.fits'.format(exp_ID),'ME',
+                minpi=minpi,maxpi=maxpi,det_ids=me_pars['det_ids'],
+                event_type=me_pars['event_type'],bad_det_ids=bad_det_ids,
+                sidecar=sidecar)
+        else:
+            # Running mescreen
+            cmd = f'mescreen evtfile={grade_evt_file} gtifile={gti_file} \
+                baddetfile={bad_det_file} outfile={outfile} userdetid="0-53" \
+                starttime=0 stoptime=0 minPI={minpi} maxPI={maxpi} \
+                clobber=yes history=yes'
+            os.system(cmd)
 
         # Verifing successful running
         if not outfile.is_file():
@@ -1805,7 +1857,7 @@ def me_lc(full_exp_dir,screen_evt_file=None,dead_time_file=None,
     outfile_root=destination/file_name_root
 
     lc_test = list_items(destination,itype='file',
-        include_or=[file_name_root],exclude_or=['bkg'],ext='.lc')
+        include_or=[file_name_root],exclude_or=['bkg','net'],ext='.lc')
     compute = True
     if lc_test:
         logging.info('ME lightcurve already exists')
@@ -1825,7 +1877,7 @@ def me_lc(full_exp_dir,screen_evt_file=None,dead_time_file=None,
         os.system(cmd)
 
         output = list_items(destination,itype='file',
-            include_or=[file_name_root],ext='.lc')
+            include_or=[file_name_root],exclude_or=['bkg','net'],ext='.lc')
     
         # Verifing successful running
         if not output.is_file():
@@ -2588,7 +2640,7 @@ def le_gticorr(full_exp_dir,recon_evt_file=None,gti_file=None,
 
 def le_screen(full_exp_dir,recon_evt_file=None,gti_file=None,
         user_det_ids='0-95',minpi=0,maxpi=1535,
-        out_dir = pathlib.Path.cwd(),override=False):
+        out_dir = pathlib.Path.cwd(),override=False,native=False,sidecar=False):
     '''
     It runs HXMT tool le_screen
 
@@ -2616,17 +2668,25 @@ def le_screen(full_exp_dir,recon_evt_file=None,gti_file=None,
         Default is current working directory.
     override: boolean (optional)
         If True output files are overwritten (default is False)
+    native: boolean, optional
+        If True, screening is performed natively (native_funcs.screen_events)
+        instead of running lescreen. Default is False
+    sidecar: boolean, optional
+        Only used when native is True. If True, a row-index sidecar
+        (<exp_ID>_LE_evt_screen_idx.npy) is written instead of a new 
+        event file. Default is False
 
     RETURNS
     -------
     outfile: pathlib.Path or boolean
-        The full path of the screened file. If some of the operations
-        is not successfull, it returns False.
+        The full path of the screened file (or of the row-index sidecar).
+        If some of the operations is not successfull, it returns False.
         The output file has format: <destination>/<exp_if>_LE_evt_screen.fits
 
     HISTORY
     -------
     2021 05 06, Stefano Rapisarda (Uppsala), creation date
+    2026 10 19, native and sidecar options added
     '''
 
     logging.info('===>>> Running le_screen <<<===')
@@ -2687,6 +2747,7 @@ def le_screen(full_exp_dir,recon_evt_file=None,gti_file=None,
 
     # Initializing outfile
     outfile = destination/'{}_LE_evt_screen.fits'.format(exp_ID)
+    if native and sidecar: outfile = sidecar_name(outfile)
 
     compute = True
     if outfile.is_file():
@@ -2696,12 +2757,20 @@ def le_screen(full_exp_dir,recon_evt_file=None,gti_file=None,
     if compute or override:
         logging.info('Performing screening')    
 
-        # Running hescreen
-        cmd = f'lescreen evtfile={recon_evt_file} gtifile={gti_file} \
-            outfile={outfile} userdetid="{user_det_ids}" \
-            eventtype=0 starttime=0 stoptime=0 \
-            minPI={minpi} maxPI={maxpi} clobber=yes history=yes'
-        os.system(cmd)
+        if native:
+            # Native screening
+            outfile = screen_events(recon_evt_file,gti_file,
+                destination/'{}_LE_evt_screen.fits'.format(exp_ID),'LE',
+                minpi=minpi,maxpi=maxpi,det_ids=user_det_ids,
+                event_type=INSTRUMENTS['LE']['event_type'],sidecar=sidecar)
+        else:
+            # Running lescreen
+            event_type = INSTRUMENTS['LE']['tool_event_type']
+            cmd = f'lescreen evtfile={recon_evt_file} gtifile={gti_file} \
+                outfile={outfile} userdetid="{user_det_ids}" \
+                eventtype={event_type} starttime=0 stoptime=0 \
+                minPI={minpi} maxPI={maxpi} clobber=yes history=yes'
+            os.system(cmd)
 
         # Verifing successful running
         if not outfile.is_file():
@@ -2801,7 +2870,7 @@ def le_lc(full_exp_dir,screen_evt_file=None,
     outfile_root=destination/file_name_root
 
     lc_test = list_items(destination,itype='file',
-        include_or=[file_name_root],exclude_or=['bkg'],ext='.lc')
+        include_or=[file_name_root],exclude_or=['bkg','net'],ext='.lc')
     compute = True
     if lc_test:
         logging.info('LE lightcurve already exists')
@@ -2821,7 +2890,7 @@ def le_lc(full_exp_dir,screen_evt_file=None,
         os.system(cmd)
 
         output = list_items(destination,itype='file',
-            include_or=[file_name_root],exclude_or=['bkg'],ext='.lc')
+            include_or=[file_name_root],exclude_or=['bkg','net'],ext='.lc')
     
         # Verifing successful running
         if not output.is_file():
@@ -3204,6 +3273,63 @@ def le_rsp(full_exp_dir,energy_spectrum_file,
         
     return outfile
 
+def event_cache_stage(full_exp_dir,inst,out_dir=pathlib.Path.cwd(),
+    override=False):
+    '''
+    Converts the screened events of an exposure into a columnar cache
+
+    DESCRIPTION
+    -----------
+    Each column of the screened event file (or of the rows selected
+    by a row-index sidecar) is written once into a .npy file (see
+    cache_events). Native stages then read events through zero-copy
+    memory maps instead of parsing the FITS binary table, as long as
+    the cache is not older than the screened event file.
+
+    PARAMETERS
+    ----------
+    full_exp_dir: string or pathlib.Path
+        Full path of the esposure folder
+    inst: string
+        Instrument (HE, ME, or LE)
+    out_dir: string or pathlib.Path(), optional
+        Name of the output products folder (containing the analysis
+        folder). Default is current working directory.
+    override: boolean, optional
+        If True, the cache is rewritten even if up to date
+
+    RETURNS
+    -------
+    folder: pathlib.Path or None
+        Cache folder, in the form:
+        <out_dir>/analysis/<exp_ID>/<INST>/<exp_ID>_<INST>_evt_screen[_idx]_cols
+    '''
+
+    logging.info('===>>> Running event_cache_stage <<<===')
+
+    if type(full_exp_dir) == str: full_exp_dir = pathlib.Path(full_exp_dir)
+    if type(out_dir) == str: out_dir = pathlib.Path(out_dir)
+
+    # Checking exposure folder format
+    if not check_exp_format(full_exp_dir):
+        logging.info('Something is wrong in the exposure folder name, check:')
+        logging.info(full_exp_dir)
+        return
+
+    exp_ID = str(full_exp_dir.name)
+    exp_dir = out_dir/'analysis'/exp_ID
+
+    screen_file,_ = exposure_products(exp_dir,exp_ID,inst)
+    if screen_file is None:
+        logging.error('{} screened event file missing'.format(inst))
+        return
+
+    if not override and not open_event_cache(screen_file) is None:
+        logging.info('Event cache already up to date')
+        return cache_name(screen_file)
+
+    return cache_events(screen_file)
+
 if __name__ == '__main__':
     args = sys.argv
     full_exp_dir = '/Volumes/Samsung_T5/test_hxmt_pipeline/Cygnus_X1/P0101315/P0101315002/P010131500201-20171031-01-01'
@@ -0,0 +1,901 @@
+import os
+import json
+import shutil
+import pathlib
+import logging
+import functools
+import threading
+import queue
+
+import numpy as np
+from astropy.io import fits
+
+from .fits_funcs import find_table, open_table, raw_records, hdu_columns, \
+    read_columns, column_scale, to_native
+
+# Number of event rows processed at once by the native engines
+CHUNK_ROWS = 1000000
+
+# Number of event chunks read in advance by a background thread
+READ_AHEAD = 2
+
+# Size of the detector lookup tables (DET_ID is stored as unsigned byte)
+DET_TABLE_SIZE = 256
+
+# Column names and default selections of the screened event files.
+# type_col/event_type define the event type cut, acd_col (HE only) the
+# anticoincidence veto, lc_det_ids the detectors used for products,
+# band the default (broad band) PI range, n_chan the number of PI channels.
+# tool_event_type is the eventtype parameter of the HEASoft tools giving
+# the same cut: for HE, eventtype=1 selects the normal (NaI) events,
+# flagged by EVENT_TYPE=0 (mescreen has no eventtype parameter)
+INSTRUMENTS = {
+    'HE':{'time_col':'TIME','pi_col':'PI','det_col':'DET_ID',
+        'type_col':'EVENT_TYPE','event_type':0,'tool_event_type':1,'acd_col':'ACD',
+        'det_ids':'0-17','lc_det_ids':'0-15, 17','band':(8,162),'n_chan':256},
+    'ME':{'time_col':'TIME','pi_col':'PI','det_col':'DET_ID',
+        'type_col':'GRADE','event_type':0,'tool_event_type':None,'acd_col':None,
+        'det_ids':'0-53','lc_det_ids':'0-7,11-25,29-43,47-53',
+        'band':(119,546),'n_chan':1024},
+    'LE':{'time_col':'TIME','pi_col':'PI','det_col':'DET_ID',
+        'type_col':'EVENT_TYPE','event_type':0,'tool_event_type':0,'acd_col':None,
+        'det_ids':'0-95','band':(106,1169),'n_chan':1536,
+        'lc_det_ids':'0,2-4,6-10,12,14,20,22-26,28,30,32,34-36,38-42,44,46,52,54-58,60-62,64,66-68,70-74,76,78,84,86,88-90,92-94'}
+    }
+
+def read_gti(gti_file):
+    '''
+    Reads start and stop times from a GTI file
+
+    DESCRIPTION
+    -----------
+    All the extensions whose name starts with GTI are read. ME and LE
+    GTI files (output of megticorr and legticorr) have one extension
+    per detector box: in this case the returned GTI is their
+    intersection.
+
+    PARAMETERS
+    ----------
+    gti_file: string or pathlib.Path
+        Full path of the GTI file
+
+    RETURNS
+    -------
+    start, stop: numpy.ndarray
+        Sorted and merged start and stop times of the good time
+        intervals
+    '''
+
+    gtis = []
+    with fits.open(gti_file,memmap=True) as hdu_list:
+        for hdu in hdu_list:
+            if not hdu.name.upper().startswith('GTI'): continue
+            data = hdu_columns(hdu,['START','STOP'])
+            gtis += [merge_gti(data['START'].astype(np.float64),
+                data['STOP'].astype(np.float64))]
+
+    if len(gtis) == 0:
+        raise ValueError('{} does not contain any GTI extension'.format(gti_file))
+
+    start,stop = gtis[0]
+    for other_start,other_stop in gtis[1:]:
+        start,stop = gti_intersection(start,stop,other_start,other_stop)
+
+    return start,stop
+
+def merge_gti(start,stop):
+    '''
+    Sorts GTIs and merges overlapping or contiguous intervals
+    '''
+
+    start = np.asarray(start,dtype=np.float64)
+    stop = np.asarray(stop,dtype=np.float64)
+    if len(start) == 0: return start,stop
+
+    order = np.argsort(start,kind='mergesort')
+    start,stop = start[order],stop[order]
+
+    # An interval starts a new block if it begins after the end of all
+    # the previous ones
+    running_stop = np.maximum.accumulate(stop)
+    new_block = np.ones(len(start),dtype=bool)
+    new_block[1:] = start[1:] > running_stop[:-1]
+    block_index = np.cumsum(new_block)-1
+
+    merged_start = start[new_block]
+    merged_stop = np.zeros(len(merged_start))
+    np.maximum.at(merged_stop,block_index,stop)
+    merged_stop = np.maximum(merged_stop,merged_start)
+
+    return merged_start,merged_stop
+
+def gti_intersection(start1,stop1,start2,stop2):
+    '''
+    Returns the intersection of two sorted and merged sets of GTIs
+    '''
+
+    # Interval i of the first set can only overlap intervals of the
+    # second set from j_first (first stopping after start1[i]) to j_last
+    # (last starting before stop1[i])
+    j_first = np.searchsorted(stop2,start1,side='right')
+    j_last = np.searchsorted(start2,stop1,side='left')
+    counts = np.clip(j_last-j_first,0,None)
+    i_index = np.repeat(np.arange(len(start1)),counts)
+    offsets = np.arange(len(i_index))-np.repeat(np.cumsum(counts)-counts,counts)
+    j_index = np.repeat(j_first,counts)+offsets
+
+    start = np.maximum(start1[i_index],start2[j_index])
+    stop = np.minimum(stop1[i_index],stop2[j_index])
+    good = stop > start
+
+    return start[good],stop[good]
+
+def gti_mask(time,start,stop):
+    '''
+    Returns a boolean mask selecting times inside the GTIs
+
+    PARAMETERS
+    ----------
+    time: numpy.ndarray
+        Event times
+    start, stop: numpy.ndarray
+        Sorted and merged GTI boundaries (see merge_gti)
+    '''
+
+    index = np.searchsorted(start,time,side='right')-1
+    mask = index >= 0
+    mask[mask] = time[mask] < stop[index[mask]]
+    return mask
+
+@functools.lru_cache(maxsize=None)
+def compile_det_ids(det_ids):
+    '''
+    Compiles a detector selection string into lookup tables
+
+    DESCRIPTION
+    -----------
+    Detector selections follow the HEASoft userdetid syntax: single
+    detectors or detector ranges (-) separated by commas are combined,
+    semicolons separate groups (ex. '0-15, 17' or '0-7;8-15').
+    The string is parsed once (results are cached per unique string) and
+    converted into tables indexed by detector ID, so that selecting
+    events becomes a single table lookup: mask[det_id].
+
+    PARAMETERS
+    ----------
+    det_ids: string
+        Detector selection string
+
+    RETURNS
+    -------
+    mask: numpy.ndarray
+        Read-only boolean table (DET_TABLE_SIZE,), True for selected
+        detectors
+    groups: numpy.ndarray
+        Read-only int16 table (DET_TABLE_SIZE,) with the group index of each
+        detector (-1 for not selected detectors)
+    '''
+
+    groups = np.full(DET_TABLE_SIZE,-1,dtype=np.int16)
+    for g,group in enumerate(det_ids.split(';')):
+        for chunk in group.split(','):
+            chunk = chunk.strip()
+            if chunk == '': continue
+            try:
+                if '-' in chunk:
+                    low,high = [int(c) for c in chunk.split('-')]
+                else:
+                    low = high = int(chunk)
+            except ValueError:
+                raise ValueError('Invalid detector selection {}'.format(det_ids))
+            if low < 0 or high >= DET_TABLE_SIZE or low > high:
+                raise ValueError('Invalid detector range {} in {}'.\
+                    format(chunk,det_ids))
+            overlap = (groups[low:high+1] >= 0) & (groups[low:high+1] != g)
+            if overlap.any():
+                raise ValueError('Detector groups overlap in {}'.format(det_ids))
+            groups[low:high+1] = g
+
+    mask = groups >= 0
+    mask.setflags(write=False)
+    groups.setflags(write=False)
+
+    return mask,groups
+
+def det_mask(det_id,det_ids):
+    '''
+    Returns a boolean mask selecting events of the detectors in det_ids
+
+    PARAMETERS
+    ----------
+    det_id: numpy.ndarray
+        Detector ID column of the events
+    det_ids: string
+        Detector selection string (see compile_det_ids)
+    '''
+
+    return compile_det_ids(det_ids)[0][det_id]
+
+def read_bad_det_ids(bad_det_file):
+    '''
+    Reads the IDs of bad detectors from a bad detector file (output of
+    megticorr)
+
+    RETURNS
+    -------
+    bad_det_ids: numpy.ndarray or None
+        IDs of bad detectors. None if the file does not contain a
+        detector ID column
+    '''
+
+    with fits.open(bad_det_file,memmap=True) as hdu_list:
+        for hdu in hdu_list[1:]:
+            if not isinstance(hdu,fits.BinTableHDU): continue
+            for name in hdu.columns.names:
+                if name.upper().replace('_','') == 'DETID':
+                    return np.unique(np.array(hdu.data[name],dtype=np.int64))
+    return None
+
+def screen_mask(raw,inst,gti=None,minpi=None,maxpi=None,det_ids=None,
+    event_type=None,anticoincidence=False,bad_det_ids=None):
+    '''
+    Computes the screening mask of a chunk of events
+
+    PARAMETERS
+    ----------
+    raw: numpy.ndarray or dictionary
+        Structured array of event records, or dictionary of event
+        columns (see iter_event_chunks)
+    inst: string
+        Instrument (HE, ME, or LE), used to select column names
+    gti: tuple or None, optional
+        (start, stop) arrays of good time intervals
+    minpi, maxpi: integer or None, optional
+        Energy channel range (boundaries included)
+    det_ids: string or None, optional
+        Detector selection string (see compile_det_ids)
+    event_type: integer or None, optional
+        Value of the event type column to keep
+    anticoincidence: boolean, optional
+        If True, events with any anticoincidence flag are rejected
+    bad_det_ids: iterable or None, optional
+        Detector IDs to reject
+
+    RETURNS
+    -------
+    mask: numpy.ndarray
+        Boolean mask, True for events passing the screening
+    '''
+
+    cols = INSTRUMENTS[inst]
+    mask = np.ones(len(raw[cols['time_col']]),dtype=bool)
+
+    if not minpi is None or not maxpi is None:
+        pi = raw[cols['pi_col']]
+        if not minpi is None: mask &= pi >= minpi
+        if not maxpi is None: mask &= pi <= maxpi
+
+    if not event_type is None:
+        mask &= raw[cols['type_col']] == event_type
+
+    if not det_ids is None or not bad_det_ids is None:
+        if det_ids is None:
+            table = np.ones(DET_TABLE_SIZE,dtype=bool)
+        else:
+            table = compile_det_ids(det_ids)[0]
+        if not bad_det_ids is None:
+            table = table.copy()
+            table[np.asarray(bad_det_ids,dtype=np.int64)] = False
+        mask &= table[raw[cols['det_col']]]
+
+    names = raw.keys() if isinstance(raw,dict) else raw.dtype.names
+    if anticoincidence and cols['acd_col'] in names:
+        acd = raw[cols['acd_col']]
+        if acd.ndim > 1: acd = acd.any(axis=1)
+        mask &= acd == 0
+
+    if not gti is None:
+        # Time is checked last, on the surviving events only
+        index = np.flatnonzero(mask)
+        mask[index] = gti_mask(raw[cols['time_col']][index],*gti)
+
+    return mask
+
+def sidecar_name(outfile):
+    '''
+    Returns the name of the row-index sidecar corresponding to a
+    screened event file
+    '''
+
+    outfile = pathlib.Path(outfile)
+    return outfile.with_name(outfile.stem+'_idx.npy')
+
+def write_hdu_stream(out,header,blocks):
+    '''
+    Writes an HDU to an open binary file, streaming its data
+
+    DESCRIPTION
+    -----------
+    The header must already describe the full data size (ex. NAXIS2).
+    Data blocks are written in order as raw bytes, they must be arrays
+    in FITS (big endian) format. The data unit is then padded to a
+    multiple of 2880 bytes.
+
+    PARAMETERS
+    ----------
+    out: file object
+        File opened in binary write mode
+    header: astropy.io.fits.Header
+        Header of the HDU
+    blocks: iterable
+        numpy.ndarray blocks of data
+
+    RETURNS
+    -------
+    n_bytes: integer
+        Number of data bytes written (without padding)
+    '''
+
+    out.write(header.tostring().encode('ascii'))
+    n_bytes = 0
+    for block in blocks:
+        block = np.ascontiguousarray(block).tobytes()
+        out.write(block)
+        n_bytes += len(block)
+    out.write(b'\0'*((-n_bytes)%2880))
+
+    return n_bytes
+
+def screen_events(evt_file,gti_file,outfile,inst,minpi=None,maxpi=None,
+    det_ids=None,event_type=None,anticoincidence=False,bad_det_ids=None,
+    sidecar=False,chunk_rows=CHUNK_ROWS):
+    '''
+    Screens an event file natively, without running the HEASoft tools
+
+    DESCRIPTION
+    -----------
+    The screening mask (GTI, PI range, event type, detector ID, and
+    anticoincidence) is computed on row chunks of the event file (see
+    iter_event_chunks). The selected records of each chunk are written
+    as soon as its mask is known, copying raw bytes without unpacking
+    rows, so the event file is read in a single sequential pass and
+    memory usage does not depend on its size (the number of selected
+    rows is written into the header at the end).
+    The output file contains the primary header, the screened events,
+    and the applied GTI.
+    If sidecar is True, instead of copying events, the indices of the
+    selected rows are saved in a .npy file (<outfile stem>_idx.npy) and
+    the name of the source event file is written in a .txt file with the
+    same name.
+
+    PARAMETERS
+    ----------
+    evt_file: string or pathlib.Path
+        Input event file (calibrated, graded, or reconstructed)
+    gti_file: string or pathlib.Path
+        GTI file
+    outfile: string or pathlib.Path
+        Output screened event file
+    inst: string
+        Instrument (HE, ME, or LE)
+    minpi, maxpi, det_ids, event_type, anticoincidence, bad_det_ids:
+        Screening criteria, see screen_mask
+    sidecar: boolean, optional
+        If True, a row-index sidecar is written instead of a copied event
+        file (default is False)
+    chunk_rows: integer, optional
+        Number of rows processed at once
+
+    RETURNS
+    -------
+    output: pathlib.Path
+        Screened event file or row-index sidecar
+    '''
+
+    evt_file = pathlib.Path(evt_file)
+    outfile = pathlib.Path(outfile)
+
+    gti = read_gti(gti_file)
+    cols = INSTRUMENTS[inst]
+
+    with fits.open(evt_file,memmap=True) as hdu_list:
+        evt_hdu = find_table(hdu_list)
+        raw = raw_records(evt_hdu)
+        n_rows = len(raw)
+
+        # Columns needed by the mask
+        names = raw.dtype.names
+        needed = [cols['time_col']]
+        if not minpi is None or not maxpi is None: needed += [cols['pi_col']]
+        if not event_type is None: needed += [cols['type_col']]
+        if not det_ids is None or not bad_det_ids is None: needed += [cols['det_col']]
+        if anticoincidence and cols['acd_col'] in names: needed += [cols['acd_col']]
+        chunks = iter_event_chunks(evt_file,needed,chunk_rows)
+
+        tmp_file = outfile.with_name(outfile.name+'.tmp')
+        n_selected = 0
+        if sidecar:
+            # Selected row indices are streamed, then stored as .npy
+            output = sidecar_name(outfile)
+            index_type = np.uint32 if n_rows < 2**32 else np.int64
+            with open(tmp_file,'wb') as out:
+                first = 0
+                for data in chunks:
+                    mask = screen_mask(data,inst,gti=gti,minpi=minpi,
+                        maxpi=maxpi,det_ids=det_ids,event_type=event_type,
+                        anticoincidence=anticoincidence,bad_det_ids=bad_det_ids)
+                    rows = (np.flatnonzero(mask)+first).astype(index_type)
+                    out.write(rows.tobytes())
+                    n_selected += len(rows)
+                    first += len(mask)
+            logging.info('Selected {} events out of {}'.format(n_selected,n_rows))
+
+            source = np.memmap(tmp_file,dtype=index_type,mode='r',shape=(n_selected,)) \
+                if n_selected > 0 else np.zeros(0,dtype=index_type)
+            index = np.lib.format.open_memmap(output,mode='w+',
+                dtype=index_type,shape=(n_selected,))
+            for start in range(0,n_selected,chunk_rows):
+                index[start:start+chunk_rows] = source[start:start+chunk_rows]
+            index.flush()
+            del index,source
+            os.remove(tmp_file)
+            with open(output.with_suffix('.txt'),'w') as tmp:
+                tmp.write(str(evt_file)+'\n')
+            return output
+
+        # Selected raw records are copied while the mask is computed; the
+        # number of rows is written in the header at the end
+        header = evt_hdu.header.copy()
+        header['NAXIS2'] = n_rows
+        for key in ['CHECKSUM','DATASUM']:
+            if key in header: del header[key]
+        header['HISTORY'] = 'Screened natively from {}'.format(evt_file.name)
+        header['HISTORY'] = 'GTI from {}'.format(pathlib.Path(gti_file).name)
+
+        def blocks():
+            nonlocal n_selected
+            first = 0
+            for data in chunks:
+                mask = screen_mask(data,inst,gti=gti,minpi=minpi,
+                    maxpi=maxpi,det_ids=det_ids,event_type=event_type,
+                    anticoincidence=anticoincidence,bad_det_ids=bad_det_ids)
+                rows = np.flatnonzero(mask)+first
+                n_selected += len(rows)
+                first += len(mask)
+                yield raw[rows]
+
+        with open(tmp_file,'wb') as out:
+            out.write(hdu_list[0].header.tostring().encode('ascii'))
+            position = out.tell()
+            write_hdu_stream(out,header,blocks())
+            # Same header length: only the NAXIS2 value changes
+            header['NAXIS2'] = n_selected
+            out.seek(position)
+            out.write(header.tostring().encode('ascii'))
+        logging.info('Selected {} events out of {}'.format(n_selected,n_rows))
+
+    gti_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='START',format='D',unit='s',array=gti[0]),
+        fits.Column(name='STOP',format='D',unit='s',array=gti[1])],
+        name='GTI')
+    fits.append(tmp_file,gti_hdu.data,gti_hdu.header)
+    os.replace(tmp_file,outfile)
+
+    return outfile
+
+def exposure_products(exp_dir,exp_ID,inst):
+    '''
+    Returns the screened event file (or its row-index sidecar) and the
+    GTI file of an exposure and instrument
+
+    PARAMETERS
+    ----------
+    exp_dir: string or pathlib.Path
+        Exposure folder inside the analysis folder (analysis/<exp_ID>)
+    exp_ID: string
+        Exposure ID
+    inst: string
+        Instrument (HE, ME, or LE)
+
+    RETURNS
+    -------
+    screen_file, gti_file: pathlib.Path or None
+        None if the file does not exist
+    '''
+
+    destination = pathlib.Path(exp_dir)/inst
+    screen_file = destination/'{}_{}_evt_screen.fits'.format(exp_ID,inst)
+    if not screen_file.is_file(): screen_file = sidecar_name(screen_file)
+    if not screen_file.is_file(): screen_file = None
+
+    gti_file = destination/'{}_{}_gti.fits'.format(exp_ID,inst)
+    if not gti_file.is_file(): gti_file = None
+
+    return screen_file,gti_file
+
+def select_events(data,inst,minpi=None,maxpi=None,det_ids=None):
+    '''
+    Returns the event times selected by energy channel and detector
+
+    PARAMETERS
+    ----------
+    data: dictionary
+        Event columns (see load_screened_columns)
+    inst: string
+        Instrument (HE, ME, or LE)
+    minpi, maxpi: integer or None, optional
+        Energy channel range (boundaries included)
+    det_ids: string or None, optional
+        Detector selection string
+
+    RETURNS
+    -------
+    time: numpy.ndarray
+    '''
+
+    cols = INSTRUMENTS[inst]
+    mask = np.ones(len(data[cols['time_col']]),dtype=bool)
+    if not minpi is None: mask &= data[cols['pi_col']] >= minpi
+    if not maxpi is None: mask &= data[cols['pi_col']] <= maxpi
+    if not det_ids is None: mask &= det_mask(data[cols['det_col']],det_ids)
+
+    return data[cols['time_col']][mask]
+
+def bin_events(time,tstart,timedel,n_bins):
+    '''
+    Counts events on a uniform time grid
+
+    PARAMETERS
+    ----------
+    time: numpy.ndarray
+        Event times
+    tstart: float
+        Start of the first bin
+    timedel: float
+        Bin size
+    n_bins: integer
+        Number of bins
+
+    RETURNS
+    -------
+    counts: numpy.ndarray
+        Counts per bin (n_bins,)
+    '''
+
+    index = np.floor((time-tstart)/timedel).astype(np.int64)
+    index = index[(index >= 0) & (index < n_bins)]
+    return np.bincount(index,minlength=n_bins)
+
+def _resolve_sidecar(screen_file):
+    '''
+    Returns the event file and the selected rows (None for a full
+    screened event file) of a screened event file or sidecar
+    '''
+
+    screen_file = pathlib.Path(screen_file)
+
+    rows = None
+    if screen_file.suffix == '.npy':
+        rows = np.load(screen_file,mmap_mode='r')
+        with open(screen_file.with_suffix('.txt'),'r') as tmp:
+            screen_file = pathlib.Path(tmp.readline().strip())
+
+    return screen_file,rows
+
+def cache_name(screen_file):
+    '''
+    Returns the folder of the columnar cache of a screened event file
+    (or row-index sidecar)
+    '''
+
+    screen_file = pathlib.Path(screen_file)
+    return screen_file.with_name(screen_file.stem+'_cols')
+
+def _cache_stamp(screen_file):
+    '''
+    Size and modification time of the files a screened event file
+    (or row-index sidecar) depends on
+    '''
+
+    files = [pathlib.Path(screen_file)]
+    event_file,rows = _resolve_sidecar(screen_file)
+    if not rows is None: files += [event_file]
+
+    stamp = {}
+    for f in files:
+        info = os.stat(f)
+        stamp[str(f.name)] = [info.st_size,info.st_mtime_ns]
+    return stamp
+
+def open_event_cache(screen_file,columns=None):
+    '''
+    Opens the columnar cache of a screened event file
+
+    DESCRIPTION
+    -----------
+    Columns are memory mapped read-only (no copy, no byte swapping).
+    The cache is used only if its stamp matches the current size and
+    modification time of the screened event file (and of the event
+    file a sidecar refers to), so a stale cache is never read.
+
+    PARAMETERS
+    ----------
+    screen_file: string or pathlib.Path
+        Screened event file or row-index sidecar (.npy)
+    columns: list or None, optional
+        Columns that must be in the cache. If None, all the cached
+        columns are returned
+
+    RETURNS
+    -------
+    data: dictionary or None
+        Column name: numpy.memmap. None if the cache does not exist,
+        is outdated, or does not contain all the columns
+    '''
+
+    folder = cache_name(screen_file)
+    stamp_file = folder/'stamp.json'
+    if not stamp_file.is_file(): return
+
+    with open(stamp_file,'r') as infile:
+        stamp = json.load(infile)
+    if stamp['source'] != _cache_stamp(screen_file): return
+
+    if columns is None: columns = stamp['columns']
+    if any(not col in stamp['columns'] for col in columns): return
+
+    return {col:np.load(folder/'{}.npy'.format(col),mmap_mode='r')
+        for col in columns}
+
+def cache_events(screen_file,columns=None,chunk_rows=CHUNK_ROWS):
+    '''
+    Writes the columnar cache of a screened event file
+
+    DESCRIPTION
+    -----------
+    Each column is written, in native byte order, into a .npy file of
+    the folder <screened event file stem>_cols, next to the screened
+    event file. Rows are copied chunk by chunk from the memory mapped
+    event table (applying the row indices of a sidecar), so memory
+    usage does not depend on the file size. The folder is written
+    under a temporary name and renamed when complete, together with a
+    stamp of its source files (see open_event_cache).
+
+    PARAMETERS
+    ----------
+    screen_file: string or pathlib.Path
+        Screened event file or row-index sidecar (.npy)
+    columns: list or None, optional
+        Columns to cache. If None, all the columns of the event table
+    chunk_rows: integer, optional
+        Number of rows copied at once
+
+    RETURNS
+    -------
+    folder: pathlib.Path
+        Cache folder
+    '''
+
+    folder = cache_name(screen_file)
+    tmp_folder = folder.with_name(folder.name+'.tmp')
+    if tmp_folder.is_dir(): shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    event_file,rows = _resolve_sidecar(screen_file)
+    with open_table(event_file) as hdu:
+        raw = raw_records(hdu)
+        if columns is None: columns = list(raw.dtype.names)
+        n_rows = len(raw) if rows is None else len(rows)
+        for col in columns:
+            scale = column_scale(hdu,col)
+            dtype = to_native(raw[col][:0],scale).dtype
+            out = np.lib.format.open_memmap(tmp_folder/'{}.npy'.format(col),
+                mode='w+',dtype=dtype,shape=(n_rows,)+raw.dtype[col].shape)
+            for first in range(0,n_rows,chunk_rows):
+                last = min(first+chunk_rows,n_rows)
+                selection = slice(first,last) if rows is None else rows[first:last]
+                out[first:last] = to_native(raw[col][selection],scale)
+            out.flush()
+            del out
+
+    with open(tmp_folder/'stamp.json','w') as outfile:
+        json.dump({'source':_cache_stamp(screen_file),'columns':columns,
+            'rows':n_rows},outfile)
+    if folder.is_dir(): shutil.rmtree(folder)
+    os.replace(tmp_folder,folder)
+
+    return folder
+
+def screened_header(screen_file):
+    '''
+    Returns the header of the event extension of a screened event file
+    (or of the event file a row-index sidecar refers to)
+    '''
+
+    screen_file,_ = _resolve_sidecar(screen_file)
+    with open_table(screen_file) as hdu:
+        return hdu.header.copy()
+
+def _read_ahead(chunks,read_ahead):
+    '''
+    Runs a chunk generator in a background thread, keeping at most
+    read_ahead chunks in advance of the consumer
+    '''
+
+    buffer = queue.Queue(maxsize=read_ahead)
+    stop = threading.Event()
+    done = object()
+
+    def producer():
+        try:
+            for chunk in chunks:
+                while not stop.is_set():
+                    try:
+                        buffer.put(chunk,timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set(): return
+            buffer.put(done)
+        except BaseException as e:
+            buffer.put(e)
+
+    thread = threading.Thread(target=producer,daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = buffer.get()
+            if chunk is done: return
+            if isinstance(chunk,BaseException): raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+
+def iter_event_chunks(event_file,columns,chunk_rows=CHUNK_ROWS,
+    read_ahead=READ_AHEAD):
+    '''
+    Yields fixed-size row chunks of the columns of an event file
+
+    DESCRIPTION
+    -----------
+    Works with any event file (calibrated, graded, reconstructed, or
+    screened) and with row-index sidecars. Rows are read in order,
+    chunk_rows at a time, from the memory mapped event table (or from
+    the columnar cache, see cache_events), so peak memory is set by
+    chunk_rows and read_ahead only, regardless of the file size.
+    While a chunk is processed, the following read_ahead chunks are
+    read by a background thread.
+
+    PARAMETERS
+    ----------
+    event_file: string or pathlib.Path
+        Event file or row-index sidecar (.npy)
+    columns: list
+        Names of the columns to read
+    chunk_rows: integer, optional
+        Number of rows per chunk (default is CHUNK_ROWS)
+    read_ahead: integer, optional
+        Number of chunks read in advance (default is READ_AHEAD). If 0,
+        chunks are read only when requested
+
+    YIELDS
+    ------
+    data: dictionary
+        Column name: numpy.ndarray (native byte order)
+    '''
+
+    columns = list(dict.fromkeys(columns))
+
+    def chunks():
+        cache = open_event_cache(event_file,columns)
+        if not cache is None:
+            n_rows = len(cache[columns[0]])
+            # An empty file yields one empty chunk
+            for first in range(0,max(n_rows,1),chunk_rows):
+                yield {col:np.array(cache[col][first:first+chunk_rows])
+                    for col in columns}
+            return
+
+        screen_file,rows = _resolve_sidecar(event_file)
+        with open_table(screen_file) as hdu:
+            n_rows = hdu.header['NAXIS2'] if rows is None else len(rows)
+            for first in range(0,max(n_rows,1),chunk_rows):
+                last = min(first+chunk_rows,n_rows)
+                selection = slice(first,last) if rows is None else rows[first:last]
+                yield hdu_columns(hdu,columns,selection)
+
+    if read_ahead > 0:
+        yield from _read_ahead(chunks(),read_ahead)
+    else:
+        yield from chunks()
+
+def iter_event_windows(screen_file,columns,starts,stops,chunk_rows=CHUNK_ROWS,
+    read_ahead=READ_AHEAD):
+    '''
+    Yields the events of consecutive time windows of a screened event
+    file
+
+    DESCRIPTION
+    -----------
+    Events are streamed in row chunks (see iter_event_chunks) and split
+    into windows as they are read, so memory usage is bounded by the
+    chunk size and by the number of events in a window.
+
+    PARAMETERS
+    ----------
+    screen_file: string or pathlib.Path
+        Screened event file or row-index sidecar (.npy)
+    columns: list
+        Names of the columns to read (TIME is always read)
+    starts, stops: numpy.ndarray
+        Sorted, non overlapping window boundaries
+    chunk_rows, read_ahead: integer, optional
+        See iter_event_chunks
+
+    YIELDS
+    ------
+    data: dictionary
+        Column name: numpy.ndarray, events in [start, stop)
+    '''
+
+    columns = list(dict.fromkeys(['TIME']+list(columns)))
+    starts = np.asarray(starts,dtype=np.float64)
+    stops = np.asarray(stops,dtype=np.float64)
+    n_win = len(starts)
+    if n_win == 0: return
+
+    k = 0
+    pending = {col:[] for col in columns}
+
+    def window():
+        return {col:np.concatenate(pending[col]) if len(pending[col]) > 1 else
+            pending[col][0] for col in columns}
+
+    for data in iter_event_chunks(screen_file,columns,chunk_rows,read_ahead):
+        time = data['TIME']
+        empty = {col:data[col][:0] for col in columns}
+        if len(time) == 0: continue
+        while k < n_win:
+            first = np.searchsorted(time,starts[k])
+            if stops[k] > time[-1]:
+                # The window continues in the next chunk
+                for col in columns: pending[col] += [data[col][first:]]
+                break
+            last = np.searchsorted(time,stops[k])
+            for col in columns: pending[col] += [data[col][first:last]]
+            yield window()
+            pending = {col:[] for col in columns}
+            k += 1
+        if k == n_win: return
+
+    # Windows after the last event
+    while k < n_win:
+        for col in columns: pending[col] += [empty[col]]
+        yield window()
+        pending = {col:[] for col in columns}
+        k += 1
+
+def load_screened_columns(screen_file,columns):
+    '''
+    Reads columns from a screened event file or from a row-index sidecar
+
+    PARAMETERS
+    ----------
+    screen_file: string or pathlib.Path
+        Screened event file or row-index sidecar (.npy)
+    columns: list
+        Names of the columns to read
+
+    RETURNS
+    -------
+    data: dictionary
+        Column name: numpy.ndarray (read-only memory maps if a valid
+        columnar cache exists, see cache_events)
+    '''
+
+    cache = open_event_cache(screen_file,columns)
+    if not cache is None: return cache
+
+    screen_file,rows = _resolve_sidecar(screen_file)
+    return read_columns(screen_file,columns,rows=rows)
@@ -0,0 +1,718 @@
+import os
+import re
+import pathlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from .fits_funcs import hdu_columns, table_names
+
+# Keywords describing the table structure, they are never copied
+# between headers
+STRUCTURAL_KEYS = ['XTENSION','BITPIX','NAXIS','PCOUNT','GCOUNT','TFIELDS',
+    'EXTNAME','CHECKSUM','DATASUM']
+COLUMN_KEYS = ['TTYPE','TFORM','TUNIT','TNULL','TSCAL','TZERO','TDISP','TDIM',
+    'TLMIN','TLMAX','TCTYP','TCRVL','TCDLT','TCRPX','TCUNI']
+
+# Folder (inside analysis) for products combining all the exposures of a
+# target
+TARGET_FOLDER = 'target'
+
+# Lightcurve names: <exp_ID>_<INST>_lc_ch<minpi>-<maxpi>_<binsize>s...
+LC_NAME = re.compile(r'^(P\d{12}-\d{8}-\d{2}-\d{2})_(HE|ME|LE)_lc_ch(\d+)-(\d+)_([0-9.e-]+)s')
+
+# Default colours (numerator, denominator) of the pipeline broad bands:
+# soft colour ME/LE and hard colour HE/ME
+DEFAULT_COLOURS = [(('ME',119,546),('LE',106,1169)),
+    (('HE',8,162),('ME',119,546))]
+
+def target_dir(out_dir):
+    '''
+    Returns (and creates) the folder of target-wide products
+    '''
+
+    destination = pathlib.Path(out_dir)/'analysis'/TARGET_FOLDER
+    if not destination.is_dir(): os.makedirs(destination)
+    return destination
+
+def copy_keywords(src_header,dest_header):
+    '''
+    Copies non structural keywords from src_header to dest_header
+    '''
+
+    for card in src_header.cards:
+        key = card.keyword
+        if key in ['','COMMENT','HISTORY']: continue
+        if key.rstrip('0123456789') in STRUCTURAL_KEYS+COLUMN_KEYS: continue
+        if key in dest_header: continue
+        dest_header[key] = (card.value,card.comment)
+
+def read_lightcurve(lc_file):
+    '''
+    Reads a lightcurve file (output of helcgen, melcgen, lelcgen, or of
+    the background tools)
+
+    RETURNS
+    -------
+    lc: dictionary
+        time, rate, error, fracexp (None if not available), timedel,
+        gti (tuple of start and stop arrays, None if not available),
+        header (header of the RATE extension)
+    '''
+
+    with fits.open(lc_file,memmap=True) as hdu_list:
+        rate_hdu = None
+        for hdu in hdu_list[1:]:
+            if hdu.name.upper() == 'RATE': rate_hdu = hdu
+        if rate_hdu is None:
+            rate_hdu = [h for h in hdu_list[1:] if 'TIME' in h.columns.names][0]
+
+        names = table_names(rate_hdu)
+        data = hdu_columns(rate_hdu,[c for c in ['TIME','RATE','ERROR','COUNTS',
+            'FRACEXP'] if c in names])
+        lc = {'time':data['TIME'].astype(np.float64),
+            'header':rate_hdu.header.copy()}
+        if 'RATE' in names:
+            lc['rate'] = data['RATE'].astype(np.float64)
+            lc['error'] = data['ERROR'].astype(np.float64)
+        else:
+            # Counts lightcurve
+            counts = data['COUNTS'].astype(np.float64)
+            timedel = rate_hdu.header.get('TIMEDEL',np.median(np.diff(lc['time'])))
+            lc['rate'] = counts/timedel
+            lc['error'] = np.sqrt(counts)/timedel
+        lc['fracexp'] = data['FRACEXP'].astype(np.float64) \
+            if 'FRACEXP' in names else None
+
+        if 'TIMEDEL' in rate_hdu.header:
+            lc['timedel'] = float(rate_hdu.header['TIMEDEL'])
+        else:
+            lc['timedel'] = float(np.median(np.diff(lc['time'])))
+
+        lc['gti'] = None
+        for hdu in hdu_list[1:]:
+            if hdu.name.upper().startswith('GTI'):
+                gti = hdu_columns(hdu,['START','STOP'])
+                lc['gti'] = (gti['START'].astype(np.float64),
+                    gti['STOP'].astype(np.float64))
+                break
+
+    return lc
+
+def write_lightcurve(outfile,time,rate,error,header=None,fracexp=None,
+    gti=None,history=None):
+    '''
+    Writes a lightcurve in OGIP format (RATE and GTI extensions)
+
+    PARAMETERS
+    ----------
+    outfile: string or pathlib.Path
+        Output file
+    time, rate, error: numpy.ndarray
+        Lightcurve columns
+    header: astropy.io.fits.Header or None, optional
+        Keywords to copy into the RATE extension
+    fracexp: numpy.ndarray or None, optional
+        Fractional exposure column
+    gti: tuple or None, optional
+        (start, stop) arrays
+    history: string or list or None, optional
+        HISTORY records
+    '''
+
+    cols = [fits.Column(name='TIME',format='D',unit='s',array=time),
+        fits.Column(name='RATE',format='E',unit='counts/s',array=rate),
+        fits.Column(name='ERROR',format='E',unit='counts/s',array=error)]
+    if not fracexp is None:
+        cols += [fits.Column(name='FRACEXP',format='E',array=fracexp)]
+    rate_hdu = fits.BinTableHDU.from_columns(cols,name='RATE')
+    if not header is None: copy_keywords(header,rate_hdu.header)
+    if not history is None:
+        if type(history) == str: history = [history]
+        for line in history: rate_hdu.header['HISTORY'] = line
+
+    hdu_list = [fits.PrimaryHDU(),rate_hdu]
+    if not gti is None:
+        hdu_list += [fits.BinTableHDU.from_columns([
+            fits.Column(name='START',format='D',unit='s',array=gti[0]),
+            fits.Column(name='STOP',format='D',unit='s',array=gti[1])],
+            name='GTI')]
+
+    fits.HDUList(hdu_list).writeto(outfile,overwrite=True)
+
+def align_lightcurve(time,ref_time,ref_values,timedel):
+    '''
+    Samples ref_values (defined at ref_time) on the bins centered at time
+
+    DESCRIPTION
+    -----------
+    If a bin of ref_time matches each bin of time (within half bin), the
+    values are copied, otherwise they are linearly interpolated.
+    Bins outside the reference time interval are set to NaN.
+
+    PARAMETERS
+    ----------
+    time: numpy.ndarray
+        Target time bins
+    ref_time: numpy.ndarray
+        Reference time bins (sorted)
+    ref_values: numpy.ndarray
+        Values at ref_time (..., n_ref), several arrays can be aligned
+        at once
+    timedel: float
+        Bin size of the target time bins
+    '''
+
+    ref_values = np.atleast_2d(ref_values)
+    aligned = np.full((ref_values.shape[0],len(time)),np.nan)
+
+    index = np.clip(np.searchsorted(ref_time,time),1,len(ref_time)-1)
+    left_closer = np.abs(time-ref_time[index-1]) <= np.abs(time-ref_time[index])
+    nearest = np.where(left_closer,index-1,index)
+    matched = np.abs(ref_time[nearest]-time) < timedel/2.
+
+    if matched.all():
+        aligned = ref_values[:,nearest]
+    else:
+        inside = (time >= ref_time[0]) & (time <= ref_time[-1])
+        for k in range(ref_values.shape[0]):
+            aligned[k,inside] = np.interp(time[inside],ref_time,ref_values[k])
+        aligned[:,matched] = ref_values[:,nearest[matched]]
+
+    return aligned
+
+def net_name(lc_file):
+    '''
+    Returns the name of the background subtracted lightcurve
+    '''
+
+    lc_file = pathlib.Path(lc_file)
+    return lc_file.with_name(lc_file.stem+'_net.lc')
+
+def net_lightcurve(lc_file,bkg_file=None,outfile=None,override=False):
+    '''
+    Computes a background subtracted lightcurve
+
+    DESCRIPTION
+    -----------
+    The background lightcurve is aligned to the time grid of the
+    source lightcurve (see align_lightcurve) and subtracted. Errors are
+    propagated in quadrature. Bins without background are removed.
+
+    PARAMETERS
+    ----------
+    lc_file: string or pathlib.Path
+        Source lightcurve
+    bkg_file: string or pathlib.Path or None, optional
+        Background lightcurve. If None (default), <lc_file stem>_bkg.lc
+    outfile: string or pathlib.Path or None, optional
+        Output file. If None (default), <lc_file stem>_net.lc
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    outfile: pathlib.Path or None
+        Background subtracted lightcurve. None if the background
+        lightcurve does not exist
+    '''
+
+    lc_file = pathlib.Path(lc_file)
+    if bkg_file is None: bkg_file = lc_file.with_name(lc_file.stem+'_bkg.lc')
+    bkg_file = pathlib.Path(bkg_file)
+    if outfile is None: outfile = net_name(lc_file)
+    outfile = pathlib.Path(outfile)
+
+    if outfile.is_file() and not override:
+        logging.info('{} already exists'.format(outfile.name))
+        return outfile
+
+    if not bkg_file.is_file():
+        logging.error('Background lightcurve {} does not exist'.format(bkg_file.name))
+        return
+
+    src = read_lightcurve(lc_file)
+    bkg = read_lightcurve(bkg_file)
+
+    bkg_rate,bkg_error = align_lightcurve(src['time'],bkg['time'],
+        np.vstack([bkg['rate'],bkg['error']]),src['timedel'])
+
+    good = np.isfinite(bkg_rate)
+    net_rate = src['rate']-bkg_rate
+    net_error = np.hypot(src['error'],bkg_error)
+
+    fracexp = None if src['fracexp'] is None else src['fracexp'][good]
+    header = src['header']
+    header['BACKFILE'] = bkg_file.name
+    write_lightcurve(outfile,src['time'][good],net_rate[good],net_error[good],
+        header=header,fracexp=fracexp,gti=src['gti'],
+        history=['Background subtracted using {}'.format(bkg_file.name)])
+
+    return outfile
+
+def find_lightcurves(out_dir,inst,kind='src'):
+    '''
+    Lists lightcurves of all the exposures of a target
+
+    PARAMETERS
+    ----------
+    out_dir: string or pathlib.Path
+        Target folder (containing the analysis folder)
+    inst: string
+        Instrument (HE, ME, or LE)
+    kind: string, optional
+        'src' (default), 'bkg', or 'net'
+
+    RETURNS
+    -------
+    lc_files: list
+        Sorted list of pathlib.Path
+    '''
+
+    an = pathlib.Path(out_dir)/'analysis'
+    if not an.is_dir(): return []
+
+    lc_files = []
+    for exp_dir in sorted(an.iterdir()):
+        if not (exp_dir/inst).is_dir(): continue
+        lc_files += sorted((exp_dir/inst).glob('*_{}_lc_*.lc'.format(inst)))
+
+    if kind == 'src':
+        return [f for f in lc_files if not f.stem.endswith(('_bkg','_net'))]
+    else:
+        return [f for f in lc_files if f.stem.endswith('_'+kind)]
+
+def net_lc_stage(out_dir,instruments=['HE','ME','LE'],n_workers=None,
+    override=False):
+    '''
+    Computes background subtracted lightcurves for all the exposures of
+    a target
+
+    DESCRIPTION
+    -----------
+    For each instrument, all the source lightcurves with a matching
+    background lightcurve (<stem>_bkg.lc) are processed in parallel.
+    Output files have the form <stem>_net.lc
+
+    PARAMETERS
+    ----------
+    out_dir: string or pathlib.Path
+        Target folder (containing the analysis folder)
+    instruments: list, optional
+        Instruments to process (default is HE, ME, and LE)
+    n_workers: integer or None, optional
+        Number of processes (default is the number of CPUs)
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    outfiles: list
+        Background subtracted lightcurves
+    '''
+
+    logging.info('===>>> Running net_lc_stage <<<===')
+
+    lc_files = []
+    for inst in instruments:
+        lc_files += [f for f in find_lightcurves(out_dir,inst)
+            if f.with_name(f.stem+'_bkg.lc').is_file()]
+    logging.info('Found {} lightcurves with background'.format(len(lc_files)))
+    if len(lc_files) == 0: return []
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        outfiles = list(executor.map(net_lightcurve,lc_files,
+            [None]*len(lc_files),[None]*len(lc_files),
+            [override]*len(lc_files)))
+
+    return [f for f in outfiles if not f is None]
+
+def parse_lc_name(lc_file):
+    '''
+    Returns exposure ID, instrument, channel range, and bin size of a
+    pipeline lightcurve, None if the name does not match
+    '''
+
+    match = LC_NAME.match(pathlib.Path(lc_file).name)
+    if match is None: return
+    exp_ID,inst,minpi,maxpi,binsize = match.groups()
+    return {'exp_ID':exp_ID,'inst':inst,'minpi':int(minpi),'maxpi':int(maxpi),
+        'binsize':float(binsize)}
+
+def lightcurve_mean_rate(lc_file):
+    '''
+    Mean count rate of a lightcurve
+
+    RETURNS
+    -------
+    mean_rate, error, tstart, tstop: float
+        Mean of the finite rates, its error, and first and last bin
+        boundaries
+    '''
+
+    lc = read_lightcurve(lc_file)
+    good = np.isfinite(lc['rate'])
+    if not good.any(): return np.nan,np.nan,np.nan,np.nan
+    rate,error,time = lc['rate'][good],lc['error'][good],lc['time'][good]
+    n = len(rate)
+
+    return rate.mean(),np.sqrt(np.sum(error**2))/n,time[0]-lc['timedel']/2.,\
+        time[-1]+lc['timedel']/2.
+
+def colour_stage(out_dir,colours=DEFAULT_COLOURS,instruments=['HE','ME','LE'],
+    n_workers=None,override=False):
+    '''
+    Computes band rates, hardness ratios, and colours of all the
+    exposures of a target
+
+    DESCRIPTION
+    -----------
+    The mean count rate of each exposure, instrument, and energy band
+    is computed from the lightcurves already produced by the pipeline
+    (background subtracted lightcurves are used when available), in
+    parallel. Rates are arranged into an (exposure, band) matrix and
+    all the colours (rate ratios) and their errors are computed at once.
+    Results are written into a single table, one row per exposure, with
+    the columns needed for hardness-intensity and colour-colour
+    diagrams. The kind (src or net) of the lightcurve of each exposure
+    and band is recorded, as rates of source and net lightcurves are
+    not comparable. The lightcurves read (file name and modification
+    time) are listed in the LIGHTCURVES extension: the table is rebuilt
+    when any of them is new, removed, or modified.
+
+    PARAMETERS
+    ----------
+    out_dir: string or pathlib.Path
+        Target folder (containing the analysis folder)
+    colours: list, optional
+        List of (numerator band, denominator band) tuples, each band
+        being (instrument, minpi, maxpi). Default is ME/LE (soft colour)
+        and HE/ME (hard colour) of the pipeline broad bands
+    instruments: list, optional
+        Instruments to consider (default is HE, ME, and LE)
+    n_workers: integer or None, optional
+        Number of processes (default is the number of CPUs)
+    override: boolean, optional
+        If True, the table is rebuilt even if up to date
+
+    RETURNS
+    -------
+    outfile: pathlib.Path or None
+        Colour table: <out_dir>/analysis/target/<target>_colours.fits
+        RATES extension columns: EXP_ID, TSTART, TSTOP, RATE_<band>,
+        ERROR_<band>, KIND_<band>, INTENSITY, INT_ERR, COLOURk, COL_ERRk.
+        The numerator and denominator of COLOURk are stored in the
+        COLkNUM and COLkDEN keywords. LIGHTCURVES extension columns:
+        LC_FILE, MTIME
+    '''
+
+    logging.info('===>>> Running colour_stage <<<===')
+
+    out_dir = pathlib.Path(out_dir)
+    outfile = target_dir(out_dir)/'{}_colours.fits'.format(out_dir.name)
+
+    # Selecting one lightcurve per exposure and band
+    # -----------------------------------------------------------------
+    # Net lightcurves are preferred, then larger bin sizes (fewer rows)
+    selected = {}
+    for inst in instruments:
+        for kind,rank in [('src',0),('net',1)]:
+            for lc_file in find_lightcurves(out_dir,inst,kind=kind):
+                info = parse_lc_name(lc_file)
+                if info is None: continue
+                key = (info['exp_ID'],(inst,info['minpi'],info['maxpi']))
+                score = (rank,info['binsize'])
+                if not key in selected or score > selected[key][0]:
+                    selected[key] = (score,lc_file)
+    if len(selected) == 0:
+        logging.error('No lightcurve found')
+        return
+    # -----------------------------------------------------------------
+
+    keys = sorted(selected.keys())
+    lc_files = [selected[k][1] for k in keys]
+    lc_names = np.array([f.name for f in lc_files])
+    mtimes = np.array([os.path.getmtime(f) for f in lc_files])
+
+    # Same lightcurves (name and modification time) as the existing table
+    if outfile.is_file() and not override:
+        with fits.open(outfile) as hdu_list:
+            if 'LIGHTCURVES' in hdu_list:
+                old = hdu_list['LIGHTCURVES'].data
+                if dict(zip(old['LC_FILE'],old['MTIME'])) == dict(zip(lc_names,mtimes)):
+                    logging.info('{} is up to date'.format(outfile.name))
+                    return outfile
+        logging.info('Updating {}'.format(outfile.name))
+
+    logging.info('Reading {} lightcurves'.format(len(lc_files)))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        stats = np.array(list(executor.map(lightcurve_mean_rate,lc_files)),
+            dtype=np.float64).reshape(-1,4)
+
+    # (exposure, band) matrices
+    # -----------------------------------------------------------------
+    exp_IDs = sorted(set([k[0] for k in keys]))
+    bands = sorted(set([k[1] for k in keys]))
+    exp_index = np.searchsorted(exp_IDs,[k[0] for k in keys])
+    band_index = np.array([bands.index(k[1]) for k in keys])
+
+    rate = np.full((len(exp_IDs),len(bands)),np.nan)
+    error = np.full((len(exp_IDs),len(bands)),np.nan)
+    kind = np.full((len(exp_IDs),len(bands)),'',dtype='<U3')
+    rate[exp_index,band_index] = stats[:,0]
+    error[exp_index,band_index] = stats[:,1]
+    kind[exp_index,band_index] = [['src','net'][selected[k][0][0]] for k in keys]
+    tstart = np.full(len(exp_IDs),np.inf)
+    tstop = np.full(len(exp_IDs),-np.inf)
+    np.minimum.at(tstart,exp_index,np.nan_to_num(stats[:,2],nan=np.inf))
+    np.maximum.at(tstop,exp_index,np.nan_to_num(stats[:,3],nan=-np.inf))
+    # -----------------------------------------------------------------
+
+    # Colours and intensity
+    # -----------------------------------------------------------------
+    colours = [c for c in colours if tuple(c[0]) in bands and tuple(c[1]) in bands]
+    num = np.array([bands.index(tuple(c[0])) for c in colours],dtype=np.int64)
+    den = np.array([bands.index(tuple(c[1])) for c in colours],dtype=np.int64)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        colour = rate[:,num]/rate[:,den]
+        colour_error = np.abs(colour)*np.hypot(error[:,num]/rate[:,num],
+            error[:,den]/rate[:,den])
+    intensity = np.nansum(rate,axis=1)
+    intensity_error = np.sqrt(np.nansum(error**2,axis=1))
+    # -----------------------------------------------------------------
+
+    cols = [fits.Column(name='EXP_ID',format='30A',array=np.array(exp_IDs)),
+        fits.Column(name='TSTART',format='D',unit='s',array=tstart),
+        fits.Column(name='TSTOP',format='D',unit='s',array=tstop)]
+    for k,(inst,minpi,maxpi) in enumerate(bands):
+        name = '{}_{}_{}'.format(inst,minpi,maxpi)
+        cols += [fits.Column(name='RATE_'+name,format='D',unit='counts/s',
+            array=rate[:,k]),
+            fits.Column(name='ERROR_'+name,format='D',unit='counts/s',
+            array=error[:,k]),
+            fits.Column(name='KIND_'+name,format='3A',array=kind[:,k])]
+    cols += [fits.Column(name='INTENSITY',format='D',unit='counts/s',array=intensity),
+        fits.Column(name='INT_ERR',format='D',unit='counts/s',array=intensity_error)]
+    for k in range(len(colours)):
+        cols += [fits.Column(name='COLOUR{}'.format(k+1),format='D',array=colour[:,k]),
+            fits.Column(name='COL_ERR{}'.format(k+1),format='D',array=colour_error[:,k])]
+
+    hdu = fits.BinTableHDU.from_columns(cols,name='RATES')
+    for k,(c_num,c_den) in enumerate(colours):
+        hdu.header['COL{}NUM'.format(k+1)] = ('{}_{}_{}'.format(*c_num),'Colour numerator')
+        hdu.header['COL{}DEN'.format(k+1)] = ('{}_{}_{}'.format(*c_den),'Colour denominator')
+    hdu.header['OBJECT'] = out_dir.name
+    lc_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='LC_FILE',format='{}A'.format(max([len(n) for n in lc_names])),
+            array=lc_names),
+        fits.Column(name='MTIME',format='D',array=mtimes)],name='LIGHTCURVES')
+    fits.HDUList([fits.PrimaryHDU(),hdu,lc_hdu]).writeto(outfile,overwrite=True)
+
+    return outfile
+
+def longterm_name(out_dir,inst,minpi,maxpi,binsize,kind='src'):
+    '''
+    Returns the name of the long-term lightcurve of a band and bin size
+    '''
+
+    out_dir = pathlib.Path(out_dir)
+    suffix = '' if kind == 'src' else '_'+kind
+    return target_dir(out_dir)/'{}_{}_lc_ch{}-{}_{}s{}_longterm.fits'.format(
+        out_dir.name,inst,minpi,maxpi,binsize,suffix)
+
+def read_longterm(lt_file):
+    '''
+    Reads a long-term lightcurve
+
+    RETURNS
+    -------
+    rows: dictionary
+        TIME, RATE, ERROR, EXP_INDEX columns
+    exposures: dictionary
+        EXP_ID, LC_FILE, MTIME columns of the EXPOSURES extension
+    '''
+
+    with fits.open(lt_file) as hdu_list:
+        rows = {c:np.array(hdu_list['RATE'].data[c]) for c in
+            ['TIME','RATE','ERROR','EXP_INDEX']}
+        exposures = {c:np.array(hdu_list['EXPOSURES'].data[c]) for c in
+            ['EXP_ID','LC_FILE','MTIME']}
+    exposures['EXP_ID'] = exposures['EXP_ID'].astype(str)
+    exposures['LC_FILE'] = exposures['LC_FILE'].astype(str)
+
+    return rows,exposures
+
+def _read_lc_rows(lc_file):
+    '''
+    Returns time, rate, and error of the finite bins of a lightcurve
+    '''
+
+    lc = read_lightcurve(lc_file)
+    good = np.isfinite(lc['rate'])
+    return lc['time'][good],lc['rate'][good],lc['error'][good]
+
+def update_longterm(lt_file,lc_files,n_workers=None,rebuild=False):
+    '''
+    Creates or incrementally updates a long-term lightcurve
+
+    DESCRIPTION
+    -----------
+    Lightcurves already included (same file name and modification time)
+    are not read again. Rows of lightcurves modified since the last
+    update are replaced, new lightcurves are read in parallel and
+    appended, and all the rows are sorted by time. Each row carries the
+    index of its exposure in the EXPOSURES extension.
+
+    PARAMETERS
+    ----------
+    lt_file: pathlib.Path
+        Long-term lightcurve file
+    lc_files: list
+        All the lightcurves of the band (one per exposure)
+    n_workers: integer or None, optional
+        Number of processes (default is the number of CPUs)
+    rebuild: boolean, optional
+        If True, the long-term lightcurve is rebuilt from scratch
+
+    RETURNS
+    -------
+    n_new: integer
+        Number of lightcurves read
+    '''
+
+    exp_IDs = [parse_lc_name(f)['exp_ID'] for f in lc_files]
+    mtimes = np.array([os.path.getmtime(f) for f in lc_files])
+
+    if lt_file.is_file() and not rebuild:
+        rows,old = read_longterm(lt_file)
+    else:
+        rows = {'TIME':np.zeros(0),'RATE':np.zeros(0),'ERROR':np.zeros(0),
+            'EXP_INDEX':np.zeros(0,dtype=np.int32)}
+        old = {'EXP_ID':np.zeros(0,dtype=str),'LC_FILE':np.zeros(0,dtype=str),
+            'MTIME':np.zeros(0)}
+
+    # Exposures to (re)read
+    old_mtime = dict(zip(old['LC_FILE'],old['MTIME']))
+    to_read = [k for k,f in enumerate(lc_files) if old_mtime.get(pathlib.Path(f).name)
+        != mtimes[k]]
+    removed = set(old['EXP_ID'])-set(exp_IDs)
+    if len(to_read) == 0 and len(removed) == 0: return 0
+
+    # Keeping rows of unchanged exposures, with their new index
+    exposure_index = {e:k for k,e in enumerate(exp_IDs)}
+    changed = set([exp_IDs[k] for k in to_read])
+    keep_old = np.array([(not e in changed) and (e in exposure_index)
+        for e in old['EXP_ID']],dtype=bool)
+    new_index = np.array([exposure_index.get(e,-1) for e in old['EXP_ID']],
+        dtype=np.int32)
+    keep_rows = keep_old[rows['EXP_INDEX']] if len(keep_old) > 0 else \
+        np.zeros(0,dtype=bool)
+
+    times = [rows['TIME'][keep_rows]]
+    rates = [rows['RATE'][keep_rows]]
+    errors = [rows['ERROR'][keep_rows]]
+    indexes = [new_index[rows['EXP_INDEX'][keep_rows]] if len(new_index) > 0
+        else np.zeros(0,dtype=np.int32)]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        new_rows = list(executor.map(_read_lc_rows,[lc_files[k] for k in to_read]))
+    for k,(time,rate,error) in zip(to_read,new_rows):
+        times += [time]
+        rates += [rate]
+        errors += [error]
+        indexes += [np.full(len(time),k,dtype=np.int32)]
+
+    time = np.concatenate(times)
+    order = np.argsort(time,kind='mergesort')
+
+    rate_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='TIME',format='D',unit='s',array=time[order]),
+        fits.Column(name='RATE',format='E',unit='counts/s',
+            array=np.concatenate(rates)[order]),
+        fits.Column(name='ERROR',format='E',unit='counts/s',
+            array=np.concatenate(errors)[order]),
+        fits.Column(name='EXP_INDEX',format='J',
+            array=np.concatenate(indexes)[order])],name='RATE')
+    exp_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='EXP_ID',format='30A',array=np.array(exp_IDs)),
+        fits.Column(name='LC_FILE',format='{}A'.format(
+            max([len(pathlib.Path(f).name) for f in lc_files])),
+            array=np.array([pathlib.Path(f).name for f in lc_files])),
+        fits.Column(name='MTIME',format='D',array=mtimes)],name='EXPOSURES')
+
+    with fits.open(lc_files[0]) as hdu_list:
+        header = hdu_list[1].header
+        for key in ['OBJECT','TELESCOP','INSTRUME','TIMEDEL','TIMEPIXR',
+            'MJDREFI','MJDREFF','TIMESYS','TIMEUNIT']:
+            if key in header: rate_hdu.header[key] = header[key]
+
+    tmp_file = lt_file.with_name(lt_file.name+'.tmp')
+    fits.HDUList([fits.PrimaryHDU(),rate_hdu,exp_hdu]).writeto(tmp_file,overwrite=True)
+    os.replace(tmp_file,lt_file)
+
+    return len(to_read)
+
+def longterm_stage(out_dir,instruments=['HE','ME','LE'],kind='src',
+    n_workers=None,override=False):
+    '''
+    Aggregates the lightcurves of all the exposures of a target into
+    long-term lightcurves
+
+    DESCRIPTION
+    -----------
+    Lightcurves are grouped per instrument, energy band, and bin size.
+    Each group is concatenated into a single time sorted table (RATE
+    extension, with the exposure index of each row) and the list of
+    included exposures (EXPOSURES extension). Products are updated
+    incrementally: only lightcurves that are new or modified since the
+    last run are read (see update_longterm).
+
+    PARAMETERS
+    ----------
+    out_dir: string or pathlib.Path
+        Target folder (containing the analysis folder)
+    instruments: list, optional
+        Instruments to process (default is HE, ME, and LE)
+    kind: string, optional
+        'src' (default) or 'net' lightcurves
+    n_workers: integer or None, optional
+        Number of processes (default is the number of CPUs)
+    override: boolean, optional
+        If True, products are rebuilt from scratch
+
+    RETURNS
+    -------
+    outfiles: list
+        Long-term lightcurves, in the form:
+        <out_dir>/analysis/target/
+            <target>_<INST>_lc_ch<minpi>-<maxpi>_<binsize>s[_net]_longterm.fits
+    '''
+
+    logging.info('===>>> Running longterm_stage <<<===')
+
+    out_dir = pathlib.Path(out_dir)
+    groups = {}
+    for inst in instruments:
+        for lc_file in find_lightcurves(out_dir,inst,kind=kind):
+            info = parse_lc_name(lc_file)
+            if info is None: continue
+            key = (inst,info['minpi'],info['maxpi'],info['binsize'])
+            groups.setdefault(key,{})
+            # One lightcurve per exposure (the first one, ex. if several
+            # detector selections exist)
+            groups[key].setdefault(info['exp_ID'],lc_file)
+
+    outfiles = []
+    for (inst,minpi,maxpi,binsize),files in sorted(groups.items()):
+        lt_file = longterm_name(out_dir,inst,minpi,maxpi,
+            '{:g}'.format(binsize),kind)
+        lc_files = [files[e] for e in sorted(files.keys())]
+        n_new = update_longterm(lt_file,lc_files,n_workers=n_workers,
+            rebuild=override)
+        logging.info('{}: {} lightcurves ({} new or updated)'.format(
+            lt_file.name,len(lc_files),n_new))
+        outfiles += [lt_file]
+
+    return outfiles
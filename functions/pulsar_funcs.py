@@ -0,0 +1,356 @@
+import os
+import pathlib
+import logging
+
+import numpy as np
+from astropy.io import fits
+
+from .hxmt_funcs import check_exp_format
+from .native_funcs import INSTRUMENTS, read_gti, det_mask, exposure_products, \
+    iter_event_chunks, screened_header
+from .bary_funcs import bary_name, read_bary, barycentre
+
+# Maximum number of (trial, event) phases computed at once
+FOLD_CHUNK_CELLS = 2**20
+
+# Maximum number of harmonics of the H test (de Jager et al. 1989)
+H_MAX_HARM = 20
+
+def fold_phases(time,freq,fdot=0.,fddot=0.,epoch=0.):
+    '''
+    Pulse phases of events for a batch of trial ephemerides
+
+    PARAMETERS
+    ----------
+    time: numpy.ndarray
+        Event times (n_events,)
+    freq, fdot, fddot: float or numpy.ndarray
+        Frequency and derivatives of each trial (n_trials,)
+    epoch: float
+        Reference time of the ephemerides
+
+    RETURNS
+    -------
+    phase: numpy.ndarray
+        Phases in [0, 1) (n_trials, n_events)
+    '''
+
+    dt = (np.asarray(time,dtype=np.float64)-epoch)[None,:]
+    freq = np.atleast_1d(freq)[:,None]
+    fdot = np.atleast_1d(fdot)[:,None]
+    fddot = np.atleast_1d(fddot)[:,None]
+
+    phase = dt*(freq+dt*(fdot/2.+dt*fddot/6.))
+    return phase-np.floor(phase)
+
+def trial_grid(f0,tspan,n_freq=1,oversample=5,fdot=0.,fdot_step=0.,n_fdot=1,
+    fddot=0.):
+    '''
+    Grid of trial ephemerides centered on (f0, fdot)
+
+    DESCRIPTION
+    -----------
+    Frequencies are spaced by 1/(oversample*tspan), the independent
+    Fourier spacing divided by the oversampling factor.
+
+    PARAMETERS
+    ----------
+    f0: float
+        Central frequency [Hz]
+    tspan: float
+        Time span of the data [s]
+    n_freq: integer, optional
+        Number of trial frequencies (default is 1)
+    oversample: float, optional
+        Oversampling factor (default is 5)
+    fdot: float, optional
+        Central frequency derivative [Hz/s] (default is 0)
+    fdot_step: float, optional
+        Spacing of trial derivatives. If 0 (default),
+        1/(oversample*tspan^2) is used
+    n_fdot: integer, optional
+        Number of trial derivatives (default is 1)
+    fddot: float, optional
+        Second frequency derivative [Hz/s^2], same for all the trials
+
+    RETURNS
+    -------
+    freq, fdot, fddot: numpy.ndarray
+        Flattened trial grid (n_freq*n_fdot,)
+    '''
+
+    df = 1./(oversample*tspan)
+    if fdot_step == 0.: fdot_step = 1./(oversample*tspan**2)
+    freqs = f0+df*(np.arange(n_freq)-(n_freq-1)/2.)
+    fdots = fdot+fdot_step*(np.arange(n_fdot)-(n_fdot-1)/2.)
+    freq_grid,fdot_grid = np.meshgrid(freqs,fdots,indexing='ij')
+
+    return freq_grid.ravel(),fdot_grid.ravel(),np.full(freq_grid.size,fddot)
+
+def fold_accumulate(time,freq,fdot,fddot,epoch,n_bins,n_harm,profiles,
+    harmonics,chunk_cells=FOLD_CHUNK_CELLS):
+    '''
+    Adds a chunk of events to the profiles and harmonic sums of all
+    the trials (in place)
+
+    DESCRIPTION
+    -----------
+    Events are processed in sub-chunks so that at most chunk_cells
+    phases are in memory. Harmonic sums (sum of exp(2 pi i k phase)) are
+    computed by successive multiplication, profiles with a single
+    bincount over all the trials. Phases are computed in double
+    precision, harmonic terms in single precision.
+
+    PARAMETERS
+    ----------
+    time: numpy.ndarray
+        Event times
+    freq, fdot, fddot: numpy.ndarray
+        Trial ephemerides (n_trials,)
+    epoch: float
+        Reference time
+    n_bins: integer
+        Number of phase bins
+    n_harm: integer
+        Number of harmonics
+    profiles: numpy.ndarray
+        Profiles (n_trials, n_bins), updated in place
+    harmonics: numpy.ndarray
+        Complex harmonic sums (n_trials, n_harm), updated in place
+    '''
+
+    n_trials = len(freq)
+    step = max(1,chunk_cells//n_trials)
+    trial_offset = (np.arange(n_trials)*n_bins)[:,None]
+    for start in range(0,len(time),step):
+        phase = fold_phases(time[start:start+step],freq,fdot,fddot,epoch)
+
+        bins = np.minimum((phase*n_bins).astype(np.int64),n_bins-1)
+        profiles += np.bincount((bins+trial_offset).ravel(),
+            minlength=n_trials*n_bins).reshape(n_trials,n_bins)
+
+        # Single precision is enough for the harmonic terms (phases are
+        # computed in double precision) and much faster
+        angle = (2.*np.pi*phase).astype(np.float32)
+        z = np.empty(angle.shape,dtype=np.complex64)
+        z.real = np.cos(angle)
+        z.imag = np.sin(angle)
+        zk = z.copy()
+        for k in range(n_harm):
+            harmonics[:,k] += zk.sum(axis=1)
+            if k < n_harm-1: zk *= z
+
+def z2_statistics(harmonics,n_events):
+    '''
+    Z^2_n and H statistics from the harmonic sums
+
+    PARAMETERS
+    ----------
+    harmonics: numpy.ndarray
+        Complex harmonic sums (n_trials, n_harm)
+    n_events: integer
+        Number of folded events
+
+    RETURNS
+    -------
+    z2: numpy.ndarray
+        Cumulative Z^2_m for m = 1, ..., n_harm (n_trials, n_harm)
+    h: numpy.ndarray
+        H statistic (n_trials,), max over m of Z^2_m-4m+4
+    h_harm: numpy.ndarray
+        Number of harmonics maximizing H (n_trials,)
+    '''
+
+    z2 = 2./max(n_events,1)*np.cumsum(np.abs(harmonics)**2,axis=1)
+    m = np.arange(1,z2.shape[1]+1)
+    h_all = z2-4.*m[None,:]+4.
+    h_harm = np.argmax(h_all,axis=1)+1
+
+    return z2,h_all.max(axis=1),h_harm
+
+def fold_stage(full_exp_dir,inst,f0,fdot=0.,fddot=0.,n_freq=1,oversample=5,
+    fdot_step=0.,n_fdot=1,epoch=None,n_bins=32,n_harm=2,h_test=True,minpi=None,
+    maxpi=None,det_ids=None,bary=False,out_dir=pathlib.Path.cwd(),override=False):
+    '''
+    Epoch folding search and pulse profiles of an exposure
+
+    DESCRIPTION
+    -----------
+    Screened events are streamed in row chunks (see iter_event_chunks).
+    For each chunk, phases of all the trial ephemerides (see
+    trial_grid) are computed at once and accumulated into pulse
+    profiles and harmonic sums (see fold_accumulate), so memory usage
+    does not depend on the exposure length.
+    Z^2_n (n_harm harmonics) and H statistics are computed for each
+    trial; the profile of the trial with the highest Z^2_n is written
+    separately.
+    If bary is True, event times are barycentred on the fly with the
+    correction grid of the barycentering file (see bary_stage).
+
+    PARAMETERS
+    ----------
+    full_exp_dir: string or pathlib.Path
+        Full path of the esposure folder
+    inst: string
+        Instrument (HE, ME, or LE)
+    f0, fdot, fddot: float
+        Central ephemeris (frequency [Hz] and derivatives)
+    n_freq, oversample, fdot_step, n_fdot: optional
+        Trial grid (see trial_grid). Default is a single trial
+    epoch: float or None, optional
+        Reference time of the ephemeris. If None, start of the first GTI
+        (barycentred if bary is True)
+    n_bins: integer, optional
+        Number of phase bins (default is 32)
+    n_harm: integer, optional
+        Number of harmonics of the Z^2_n statistic (default is 2)
+    h_test: boolean, optional
+        If True (default), harmonic sums are accumulated up to the 20th
+        harmonic for the H test. If False, only n_harm harmonics are
+        accumulated (faster) and H is limited to n_harm harmonics
+    minpi, maxpi: integer or None, optional
+        Energy channel range. If None, the pipeline broad band
+    det_ids: string or None, optional
+        Detector selection string. If None, the lightcurve detectors of
+        the instrument are used
+    bary: boolean, optional
+        If True, barycentric times are folded (default is False)
+    out_dir: string or pathlib.Path(), optional
+        Name of the output products folder (containing the analysis
+        folder). Default is current working directory.
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    outfile: pathlib.Path or None
+        Folding file, in the form:
+        <out_dir>/analysis/<exp_ID>/<INST>/
+            <exp_ID>_<INST>_fold_ch<minpi>-<maxpi>_<n_bins>bins[_bary].fits
+        SEARCH extension (one row per trial: FREQ, FDOT, FDDOT, Z2, H,
+        H_HARM, PROFILE) and PROFILE extension (best trial)
+    '''
+
+    logging.info('===>>> Running fold_stage <<<===')
+
+    if type(full_exp_dir) == str: full_exp_dir = pathlib.Path(full_exp_dir)
+    if type(out_dir) == str: out_dir = pathlib.Path(out_dir)
+
+    # Checking exposure folder format
+    if not check_exp_format(full_exp_dir):
+        logging.info('Something is wrong in the exposure folder name, check:')
+        logging.info(full_exp_dir)
+        return
+
+    exp_ID = str(full_exp_dir.name)
+    exp_dir = out_dir/'analysis'/exp_ID
+    destination = exp_dir/inst
+    if not destination.is_dir(): os.makedirs(destination)
+
+    cols = INSTRUMENTS[inst]
+    if minpi is None: minpi = cols['band'][0]
+    if maxpi is None: maxpi = cols['band'][1]
+    if det_ids is None: det_ids = cols['lc_det_ids']
+
+    outfile = destination/'{}_{}_fold_ch{}-{}_{}bins{}.fits'.format(
+        exp_ID,inst,minpi,maxpi,n_bins,'_bary' if bary else '')
+    if outfile.is_file() and not override:
+        logging.info('Folding file already exists')
+        return outfile
+
+    screen_file,gti_file = exposure_products(exp_dir,exp_ID,inst)
+    if screen_file is None or gti_file is None:
+        logging.error('{} screened event file or GTI missing'.format(inst))
+        return
+    gti_start,gti_stop = read_gti(gti_file)
+    if len(gti_start) == 0:
+        logging.error('Empty GTI')
+        return
+
+    if bary:
+        bary_file = bary_name(exp_dir,exp_ID,inst)
+        if not bary_file.is_file():
+            logging.error('{} barycentering file missing, run bary_stage first'.format(inst))
+            return
+        grid,correction = read_bary(bary_file)
+        gti_start = barycentre(gti_start,grid,correction)
+        gti_stop = barycentre(gti_stop,grid,correction)
+    if epoch is None: epoch = gti_start[0]
+
+    freq,fdots,fddots = trial_grid(f0,gti_stop[-1]-gti_start[0],n_freq=n_freq,
+        oversample=oversample,fdot=fdot,fdot_step=fdot_step,n_fdot=n_fdot,
+        fddot=fddot)
+    n_trials = len(freq)
+    n_harm_acc = max(n_harm,H_MAX_HARM) if h_test else n_harm
+    logging.info('Folding {} events on {} trials'.format(inst,n_trials))
+
+    # Streaming events
+    # -----------------------------------------------------------------
+    profiles = np.zeros((n_trials,n_bins),dtype=np.int64)
+    harmonics = np.zeros((n_trials,n_harm_acc),dtype=np.complex128)
+    n_events = 0
+    for data in iter_event_chunks(screen_file,[cols['time_col'],cols['pi_col'],
+        cols['det_col']]):
+        pi = data[cols['pi_col']]
+        keep = det_mask(data[cols['det_col']],det_ids) & (pi >= minpi) & (pi <= maxpi)
+        time = data[cols['time_col']][keep]
+        if bary: time = barycentre(time,grid,correction)
+        fold_accumulate(time,freq,fdots,fddots,epoch,n_bins,n_harm_acc,
+            profiles,harmonics)
+        n_events += len(time)
+    # -----------------------------------------------------------------
+
+    z2,h,h_harm = z2_statistics(harmonics,n_events)
+    z2n = z2[:,n_harm-1]
+    best = np.argmax(z2n)
+    logging.info('Best trial: f={} Hz, fdot={} Hz/s, Z2_{}={:.1f}'.format(
+        freq[best],fdots[best],n_harm,z2n[best]))
+
+    # Writing products
+    # -----------------------------------------------------------------
+    exposure = np.sum(gti_stop-gti_start)
+    phase_lo = np.arange(n_bins)/n_bins
+    best_profile = profiles[best]
+
+    search_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='FREQ',format='D',unit='Hz',array=freq),
+        fits.Column(name='FDOT',format='D',unit='Hz/s',array=fdots),
+        fits.Column(name='FDDOT',format='D',unit='Hz/s2',array=fddots),
+        fits.Column(name='Z2',format='D',array=z2n),
+        fits.Column(name='H',format='D',array=h),
+        fits.Column(name='H_HARM',format='I',array=h_harm),
+        fits.Column(name='PROFILE',format='{}J'.format(n_bins),array=profiles)],
+        name='SEARCH')
+    profile_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='PHASE_LO',format='D',array=phase_lo),
+        fits.Column(name='PHASE_HI',format='D',array=phase_lo+1./n_bins),
+        fits.Column(name='COUNTS',format='J',unit='counts',array=best_profile),
+        fits.Column(name='RATE',format='D',unit='counts/s',
+            array=best_profile*n_bins/exposure),
+        fits.Column(name='ERROR',format='D',unit='counts/s',
+            array=np.sqrt(best_profile)*n_bins/exposure)],name='PROFILE')
+
+    header = screened_header(screen_file)
+    for hdu in [search_hdu,profile_hdu]:
+        for key in ['OBJECT','TELESCOP','INSTRUME','OBS_ID','MJDREFI','MJDREFF','TIMESYS']:
+            if key in header: hdu.header[key] = header[key]
+        hdu.header['EPOCH'] = (epoch,'Reference time of the ephemerides [s]')
+        hdu.header['NEVENTS'] = (n_events,'Number of folded events')
+        hdu.header['NHARM'] = (n_harm,'Number of harmonics of Z2')
+        hdu.header['CHMIN'] = (int(minpi),'Minimum PI channel')
+        hdu.header['CHMAX'] = (int(maxpi),'Maximum PI channel')
+        hdu.header['EXPOSURE'] = (exposure,'Good time [s]')
+        if bary:
+            hdu.header['TIMESYS'] = 'TDB'
+            hdu.header['TIMEREF'] = ('SOLARSYSTEM','Barycentred times')
+    profile_hdu.header['F0'] = (freq[best],'Frequency [Hz]')
+    profile_hdu.header['F1'] = (fdots[best],'Frequency derivative [Hz/s]')
+    profile_hdu.header['F2'] = (fddots[best],'Second frequency derivative [Hz/s2]')
+    profile_hdu.header['Z2'] = (z2n[best],'Z2 statistic')
+    profile_hdu.header['H'] = (h[best],'H statistic')
+
+    fits.HDUList([fits.PrimaryHDU(),search_hdu,profile_hdu]).writeto(
+        outfile,overwrite=True)
+    # -----------------------------------------------------------------
+
+    return outfile
@@ -0,0 +1,1088 @@
+import os
+import pathlib
+import logging
+
+import numpy as np
+from astropy.io import fits
+
+from .hxmt_funcs import check_exp_format, he_bkg, me_bkg, le_bkg, \
+    he_rsp, me_rsp, le_rsp
+from .native_funcs import INSTRUMENTS, read_gti, merge_gti, gti_intersection, \
+    gti_mask, det_mask, exposure_products, iter_event_windows, screened_header
+from .deadtime_funcs import find_dead_time_file, read_dead_time, dead_time_on_grid
+from .product_funcs import copy_keywords, target_dir, TARGET_FOLDER
+from .fits_funcs import update_header_keys
+
+BKG_FUNCS = {'HE':he_bkg,'ME':me_bkg,'LE':le_bkg}
+RSP_FUNCS = {'HE':he_rsp,'ME':me_rsp,'LE':le_rsp}
+
+# Number of responses stacked at once when averaging responses
+RSP_BATCH = 16
+
+def slice_intervals(gti,intervals):
+    '''
+    Defines the time slices of time-resolved products
+
+    PARAMETERS
+    ----------
+    gti: tuple
+        (start, stop) arrays, sorted and merged
+    intervals: string or float or list
+        'gti' (one slice per GTI), slice length [s] (each GTI is split
+        into consecutive slices, the last one of each GTI can be
+        shorter), list of (start, stop) tuples, or name of a text file
+        with two columns (start and stop)
+
+    RETURNS
+    -------
+    starts, stops: numpy.ndarray
+        Slice boundaries. Slices not overlapping the GTIs are removed
+    '''
+
+    gti_start,gti_stop = gti
+
+    if isinstance(intervals,str) and intervals == 'gti':
+        return gti_start.copy(),gti_stop.copy()
+    if isinstance(intervals,(str,pathlib.Path)):
+        intervals = np.atleast_2d(np.loadtxt(intervals))
+    if np.isscalar(intervals):
+        n_slices = np.ceil((gti_stop-gti_start)/intervals-1e-9).astype(np.int64)
+        offsets = np.arange(n_slices.sum())-np.repeat(np.cumsum(n_slices)-n_slices,n_slices)
+        starts = np.repeat(gti_start,n_slices)+intervals*offsets
+        stops = np.minimum(starts+intervals,np.repeat(gti_stop,n_slices))
+    else:
+        intervals = np.asarray(intervals,dtype=np.float64).reshape(-1,2)
+        starts,stops = intervals[:,0],intervals[:,1]
+
+    # Removing slices without good time
+    index = np.searchsorted(gti_stop,starts,side='right')
+    overlap = (index < len(gti_start))
+    overlap[overlap] = gti_start[index[overlap]] < stops[overlap]
+
+    return starts[overlap],stops[overlap]
+
+def write_slice_gti(gti_file,outfile,start,stop):
+    '''
+    Writes the GTI file of a time slice
+
+    DESCRIPTION
+    -----------
+    The structure of the original GTI file is preserved (ex. one GTI
+    extension per detector box for ME and LE), each GTI extension is
+    intersected with [start, stop].
+    '''
+
+    with fits.open(gti_file) as hdu_list:
+        new_list = [fits.PrimaryHDU(header=hdu_list[0].header)]
+        for hdu in hdu_list[1:]:
+            if not hdu.name.upper().startswith('GTI'):
+                new_list += [hdu.copy()]
+                continue
+            gti = merge_gti(hdu.data['START'],hdu.data['STOP'])
+            gti = gti_intersection(*gti,np.array([start]),np.array([stop]))
+            new_hdu = fits.BinTableHDU.from_columns([
+                fits.Column(name='START',format='D',unit='s',array=gti[0]),
+                fits.Column(name='STOP',format='D',unit='s',array=gti[1])],
+                header=hdu.header.copy())
+            new_hdu.header['TSTART'] = start
+            new_hdu.header['TSTOP'] = stop
+            new_list += [new_hdu]
+        fits.HDUList(new_list).writeto(outfile,overwrite=True)
+
+def write_pha(outfile,counts,exposure,inst,header=None,gti=None,minpi=None,
+    maxpi=None,history=None,error=None,background=False,backfile='none',
+    respfile='none'):
+    '''
+    Writes an OGIP (type I) energy spectrum
+
+    PARAMETERS
+    ----------
+    outfile: string or pathlib.Path
+        Output file
+    counts: numpy.ndarray
+        Counts per channel (all the channels of the instrument)
+    exposure: float
+        Exposure (live time) [s]
+    inst: string
+        Instrument (HE, ME, or LE)
+    header: astropy.io.fits.Header or None, optional
+        Keywords (OBJECT, RA_OBJ, ...) to copy into the SPECTRUM extension
+    gti: tuple or None, optional
+        (start, stop) arrays
+    minpi, maxpi: integer or None, optional
+        Channels outside this range are flagged as bad (QUALITY=5)
+    history: string or list or None, optional
+        HISTORY records
+    error: numpy.ndarray or None, optional
+        If given, the spectrum is written as RATE with STAT_ERR (ex.
+        scaled backgrounds), otherwise as Poissonian COUNTS
+    background: boolean, optional
+        If True, the spectrum is flagged as a background (HDUCLAS2)
+    backfile, respfile: string, optional
+        BACKFILE and RESPFILE keywords (default is none)
+    '''
+
+    channel = np.arange(len(counts))
+    quality = np.zeros(len(counts),dtype=np.int16)
+    if not minpi is None: quality[channel < minpi] = 5
+    if not maxpi is None: quality[channel > maxpi] = 5
+
+    if error is None:
+        data_cols = [fits.Column(name='COUNTS',format='J',unit='counts',array=counts)]
+    else:
+        data_cols = [fits.Column(name='RATE',format='D',unit='counts/s',
+            array=counts/exposure),
+            fits.Column(name='STAT_ERR',format='D',unit='counts/s',
+            array=error/exposure)]
+    spec_hdu = fits.BinTableHDU.from_columns(
+        [fits.Column(name='CHANNEL',format='J',array=channel)]+data_cols+
+        [fits.Column(name='QUALITY',format='I',array=quality)],name='SPECTRUM')
+    spec = spec_hdu.header
+    spec['TELESCOP'] = 'HXMT'
+    spec['INSTRUME'] = inst
+    spec['FILTER'] = 'NONE'
+    spec['EXPOSURE'] = (exposure,'Exposure time [s]')
+    spec['AREASCAL'] = 1.
+    spec['BACKSCAL'] = 1.
+    spec['CORRSCAL'] = 0.
+    spec['BACKFILE'] = backfile
+    spec['CORRFILE'] = 'none'
+    spec['RESPFILE'] = respfile
+    spec['ANCRFILE'] = 'none'
+    spec['HDUCLASS'] = 'OGIP'
+    spec['HDUCLAS1'] = 'SPECTRUM'
+    spec['HDUVERS'] = '1.2.1'
+    spec['HDUCLAS2'] = 'BKG' if background else 'TOTAL'
+    spec['HDUCLAS3'] = 'COUNT' if error is None else 'RATE'
+    spec['POISSERR'] = error is None
+    spec['CHANTYPE'] = 'PI'
+    spec['DETCHANS'] = len(counts)
+    if not gti is None and len(gti[0]) > 0:
+        spec['TSTART'] = gti[0][0]
+        spec['TSTOP'] = gti[1][-1]
+    if not header is None: copy_keywords(header,spec)
+    if not history is None:
+        if type(history) == str: history = [history]
+        for line in history: spec['HISTORY'] = line
+
+    hdu_list = [fits.PrimaryHDU(),spec_hdu]
+    if not gti is None:
+        hdu_list += [fits.BinTableHDU.from_columns([
+            fits.Column(name='START',format='D',unit='s',array=gti[0]),
+            fits.Column(name='STOP',format='D',unit='s',array=gti[1])],
+            name='GTI')]
+
+    fits.HDUList(hdu_list).writeto(outfile,overwrite=True)
+
+def time_resolved_spectra(full_exp_dir,inst,intervals='gti',minpi=0,maxpi=None,
+    det_ids=None,dead_time=True,out_dir=pathlib.Path.cwd(),override=False):
+    '''
+    Computes the energy spectra of several time slices with a single
+    pass over the screened events
+
+    DESCRIPTION
+    -----------
+    Events of each time slice are read from the memory mapped screened
+    event file (only the rows of the slice are accessed) and histogrammed
+    by PI channel. The exposure of each slice is its good time (slice
+    intersected with the GTIs), corrected for dead time when a dead
+    time file is available (HE and ME). For each slice, a spectrum, a
+    GTI file (with the structure of the exposure GTI file, needed by
+    the background tools), and the ascii list used by the background
+    tools are written.
+
+    PARAMETERS
+    ----------
+    full_exp_dir: string or pathlib.Path
+        Full path of the esposure folder
+    inst: string
+        Instrument (HE, ME, or LE)
+    intervals: string or float or list, optional
+        Time slices (see slice_intervals). Default is 'gti', one slice
+        per GTI
+    minpi, maxpi: integer or None, optional
+        Energy channel range. Default is the full channel range
+    det_ids: string or None, optional
+        Detector selection string. If None, the lightcurve detectors of
+        the instrument are used
+    dead_time: boolean, optional
+        If True (default), exposures are corrected for dead time
+    out_dir: string or pathlib.Path(), optional
+        Name of the output products folder (containing the analysis
+        folder). Default is current working directory.
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    slices: list or None
+        List of (spectrum, GTI file) tuples, in the form:
+        <out_dir>/analysis/<exp_ID>/<INST>/
+            <exp_ID>_<INST>_tspec<k>_ch<minpi>-<maxpi>.pha
+            <exp_ID>_<INST>_tspec<k>_gti.fits
+    '''
+
+    logging.info('===>>> Running time_resolved_spectra <<<===')
+
+    if type(full_exp_dir) == str: full_exp_dir = pathlib.Path(full_exp_dir)
+    if type(out_dir) == str: out_dir = pathlib.Path(out_dir)
+
+    # Checking exposure folder format
+    if not check_exp_format(full_exp_dir):
+        logging.info('Something is wrong in the exposure folder name, check:')
+        logging.info(full_exp_dir)
+        return
+
+    exp_ID = str(full_exp_dir.name)
+    exp_dir = out_dir/'analysis'/exp_ID
+    destination = exp_dir/inst
+    if not destination.is_dir(): os.makedirs(destination)
+
+    cols = INSTRUMENTS[inst]
+    n_chan = cols['n_chan']
+    if maxpi is None: maxpi = n_chan-1
+    if det_ids is None: det_ids = cols['lc_det_ids']
+
+    screen_file,gti_file = exposure_products(exp_dir,exp_ID,inst)
+    if screen_file is None or gti_file is None:
+        logging.error('{} screened event file or GTI missing'.format(inst))
+        return
+    gti = read_gti(gti_file)
+
+    starts,stops = slice_intervals(gti,intervals)
+    if len(starts) == 0:
+        logging.error('No time slice overlapping the GTIs')
+        return
+    logging.info('Computing {} time-resolved {} spectra'.format(len(starts),inst))
+
+    slices = []
+    for k in range(len(starts)):
+        root = '{}_{}_tspec{:03d}'.format(exp_ID,inst,k)
+        slices += [(destination/'{}_ch{}-{}.pha'.format(root,minpi,maxpi),
+            destination/'{}_gti.fits'.format(root))]
+    if all([s[0].is_file() and s[1].is_file() for s in slices]) and not override:
+        logging.info('Time-resolved spectra already exist')
+        return slices
+
+    # Good time intervals of each slice
+    # -----------------------------------------------------------------
+    slice_gtis = [gti_intersection(*gti,starts[k:k+1],stops[k:k+1])
+        for k in range(len(starts))]
+    pieces = np.concatenate([np.column_stack(g) for g in slice_gtis])
+    piece_slice = np.repeat(np.arange(len(starts)),[len(g[0]) for g in slice_gtis])
+    good_time = np.bincount(piece_slice,weights=pieces[:,1]-pieces[:,0],
+        minlength=len(starts))
+    # -----------------------------------------------------------------
+
+    # Dead time of each slice, all slices at once
+    # -----------------------------------------------------------------
+    dead = np.zeros(len(starts))
+    dead_file = find_dead_time_file(full_exp_dir,exp_dir,inst) if dead_time else None
+    if not dead_file is None:
+        try:
+            edges,dead_table = read_dead_time(dead_file,inst)
+            grid_dead = dead_time_on_grid(edges,dead_table,pieces.ravel(),
+                det_ids=det_ids)
+            dead = np.bincount(piece_slice,weights=grid_dead[::2],
+                minlength=len(starts))
+        except (ValueError,KeyError,IndexError) as e:
+            logging.warning('Could not read dead time from {} ({})'.format(
+                dead_file.name,e))
+    elif dead_time and inst != 'LE':
+        logging.warning('{} dead time file not found, exposure not corrected'.format(inst))
+    exposure = good_time-dead
+    # -----------------------------------------------------------------
+
+    header = screened_header(screen_file)
+    windows = iter_event_windows(screen_file,[cols['pi_col'],cols['det_col']],
+        starts,stops)
+    for k,data in enumerate(windows):
+        spec_file,slice_gti_file = slices[k]
+        keep = det_mask(data[cols['det_col']],det_ids) & \
+            gti_mask(data['TIME'],*slice_gtis[k])
+        pi = data[cols['pi_col']][keep].astype(np.int64)
+        counts = np.bincount(pi[(pi >= 0) & (pi < n_chan)],minlength=n_chan)
+
+        write_pha(spec_file,counts,exposure[k],inst,header=header,
+            gti=slice_gtis[k],minpi=minpi,maxpi=maxpi,
+            history=['Time slice {}-{} from {}'.format(starts[k],stops[k],
+            pathlib.Path(screen_file).name),'DET_ID {}'.format(det_ids)])
+        write_slice_gti(gti_file,slice_gti_file,starts[k],stops[k])
+        with open(spec_file.with_suffix('.txt'),'w') as tmp:
+            tmp.write(str(spec_file)+'\n')
+
+    return slices
+
+def time_resolved_stage(full_exp_dir,inst,intervals='gti',minpi=0,maxpi=None,
+    det_ids=None,bkg=True,rsp=True,share_rsp=True,out_dir=pathlib.Path.cwd(),
+    override=False):
+    '''
+    Computes time-resolved spectra and their backgrounds and responses
+
+    DESCRIPTION
+    -----------
+    Spectra of all the slices are computed with time_resolved_spectra.
+    Then, for each slice, the background (he_bkg, me_bkg, or le_bkg) is
+    computed using the GTI file of the slice and the response (he_rsp,
+    me_rsp, or le_rsp) is generated. Responses do not depend on time
+    within an exposure, so by default (share_rsp=True) the response of
+    the first slice is used for all of them. BACKFILE and RESPFILE
+    keywords are updated.
+
+    PARAMETERS
+    ----------
+    full_exp_dir: string or pathlib.Path
+        Full path of the esposure folder
+    inst: string
+        Instrument (HE, ME, or LE)
+    intervals: string or float or list, optional
+        Time slices (see slice_intervals). Default is 'gti'
+    minpi, maxpi: integer or None, optional
+        Energy channel range. Default is the full channel range
+    det_ids: string or None, optional
+        Detector selection string
+    bkg, rsp: boolean, optional
+        If True (default), backgrounds and responses are computed
+    share_rsp: boolean, optional
+        If True (default), a single response is computed
+    out_dir: string or pathlib.Path(), optional
+        Name of the output products folder (containing the analysis
+        folder). Default is current working directory.
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    spec_files: list or None
+        Time-resolved spectra
+    '''
+
+    logging.info('===>>> Running time_resolved_stage <<<===')
+
+    slices = time_resolved_spectra(full_exp_dir,inst,intervals=intervals,
+        minpi=minpi,maxpi=maxpi,det_ids=det_ids,out_dir=out_dir,
+        override=override)
+    if not slices: return
+
+    rsp_file = None
+    for spec_file,slice_gti_file in slices:
+        keys = {}
+
+        if rsp:
+            if rsp_file is None or not share_rsp:
+                rsp_file = RSP_FUNCS[inst](full_exp_dir,spec_file,
+                    out_dir=out_dir,override=override)
+            if rsp_file and pathlib.Path(rsp_file).is_file():
+                keys['RESPFILE'] = str(pathlib.Path(rsp_file).name)
+            else:
+                logging.info('Response of {} not computed'.format(spec_file.name))
+
+        if bkg:
+            bkg_file = BKG_FUNCS[inst](full_exp_dir,spec_file,
+                gti_file=slice_gti_file,out_dir=out_dir,override=override)
+            if bkg_file:
+                keys['BACKFILE'] = str(pathlib.Path(bkg_file).name)
+            else:
+                logging.info('Background of {} not computed'.format(spec_file.name))
+
+        if len(keys) > 0: update_header_keys(spec_file,keys,hdus=['SPECTRUM'])
+
+    return [s[0] for s in slices]
+
+def read_pha(pha_file):
+    '''
+    Reads an OGIP (type I) energy spectrum
+
+    RETURNS
+    -------
+    pha: dictionary
+        counts (float, RATE spectra are converted to counts), error
+        (statistical error on counts), exposure, backscal, areascal,
+        backfile, respfile, header (SPECTRUM extension)
+    '''
+
+    with fits.open(pha_file) as hdu_list:
+        hdu = hdu_list['SPECTRUM']
+        header = hdu.header.copy()
+        names = [n.upper() for n in hdu.columns.names]
+        exposure = float(header['EXPOSURE'])
+        if 'COUNTS' in names:
+            counts = np.array(hdu.data['COUNTS'],dtype=np.float64)
+            error = np.array(hdu.data['STAT_ERR'],dtype=np.float64) \
+                if 'STAT_ERR' in names else np.sqrt(counts)
+        else:
+            counts = np.array(hdu.data['RATE'],dtype=np.float64)*exposure
+            error = np.array(hdu.data['STAT_ERR'],dtype=np.float64)*exposure \
+                if 'STAT_ERR' in names else np.sqrt(np.abs(counts))
+        # BACKSCAL and AREASCAL can be keywords or columns
+        scal = {}
+        for key in ['BACKSCAL','AREASCAL']:
+            if key in names: scal[key] = np.array(hdu.data[key],dtype=np.float64)
+            else: scal[key] = float(header.get(key,1.))
+
+    return {'counts':counts,'error':error,'exposure':exposure,
+        'backscal':scal['BACKSCAL'],'areascal':scal['AREASCAL'],
+        'backfile':str(header.get('BACKFILE','none')).strip(),
+        'respfile':str(header.get('RESPFILE','none')).strip(),'header':header}
+
+def _group_column(column,n_used):
+    '''
+    Concatenates the first n_used elements of each row of a (fixed or
+    variable length) vector column
+    '''
+
+    if isinstance(column,np.ndarray) and column.dtype != object:
+        column = column.reshape(len(column),-1)
+        used = np.arange(column.shape[1])[None,:] < n_used[:,None]
+        return column[used]
+    return np.concatenate([np.atleast_1d(np.asarray(row))[:n]
+        for row,n in zip(column,n_used)])
+
+def read_response(rsp_file):
+    '''
+    Reads a response matrix into a dense array
+
+    DESCRIPTION
+    -----------
+    The compressed OGIP format (N_GRP, F_CHAN, N_CHAN, MATRIX) is
+    expanded with a single vectorized scatter of all the matrix
+    elements.
+
+    RETURNS
+    -------
+    rsp: dictionary
+        energ_lo, energ_hi (n_energies,), matrix (n_energies, n_chan),
+        first_chan (first channel number), ebounds (EBOUNDS HDU),
+        header (matrix extension header)
+    '''
+
+    with fits.open(rsp_file) as hdu_list:
+        hdu = [h for h in hdu_list[1:] if 'MATRIX' in h.name.upper()][0]
+        ebounds = hdu_list['EBOUNDS'].copy()
+        header = hdu.header.copy()
+        data = hdu.data
+        n_chan = len(ebounds.data)
+
+        f_index = [n.upper() for n in hdu.columns.names].index('F_CHAN')+1
+        first_chan = int(header.get('TLMIN{}'.format(f_index),ebounds.data['CHANNEL'][0]))
+
+        energ_lo = np.array(data['ENERG_LO'],dtype=np.float64)
+        energ_hi = np.array(data['ENERG_HI'],dtype=np.float64)
+        n_energies = len(energ_lo)
+
+        n_grp = np.array(data['N_GRP'],dtype=np.int64)
+        f_chan = _group_column(data['F_CHAN'],n_grp).astype(np.int64)-first_chan
+        n_chans = _group_column(data['N_CHAN'],n_grp).astype(np.int64)
+        row_length = np.bincount(np.repeat(np.arange(n_energies),n_grp),
+            weights=n_chans,minlength=n_energies).astype(np.int64)
+        values = _group_column(data['MATRIX'],row_length).astype(np.float64)
+
+    # Element k of a channel group is channel F_CHAN+k
+    grp_energy = np.repeat(np.arange(n_energies),n_grp)
+    element_group = np.repeat(np.arange(len(n_chans)),n_chans)
+    offsets = np.arange(len(element_group))-np.repeat(np.cumsum(n_chans)-n_chans,
+        n_chans)
+
+    matrix = np.zeros((n_energies,n_chan))
+    matrix[grp_energy[element_group],f_chan[element_group]+offsets] = values
+
+    return {'energ_lo':energ_lo,'energ_hi':energ_hi,'matrix':matrix,
+        'first_chan':first_chan,'ebounds':ebounds,'header':header}
+
+def write_response(outfile,rsp,matrix,history=None):
+    '''
+    Writes a dense response matrix in OGIP format
+
+    DESCRIPTION
+    -----------
+    Each energy row is stored as a single channel group spanning from
+    the first to the last non-zero channel.
+
+    PARAMETERS
+    ----------
+    outfile: string or pathlib.Path
+        Output file
+    rsp: dictionary
+        Reference response (see read_response), energy grid, EBOUNDS,
+        and keywords are taken from it
+    matrix: numpy.ndarray
+        Response (n_energies, n_chan)
+    history: string or list or None, optional
+        HISTORY records
+    '''
+
+    nonzero = matrix != 0
+    has_values = nonzero.any(axis=1)
+    first = np.where(has_values,np.argmax(nonzero,axis=1),0)
+    last = np.where(has_values,matrix.shape[1]-1-np.argmax(nonzero[:,::-1],axis=1),0)
+    n_chans = np.where(has_values,last-first+1,0)
+    rows = [matrix[k,first[k]:first[k]+n_chans[k]].astype(np.float32)
+        for k in range(matrix.shape[0])]
+
+    matrix_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='ENERG_LO',format='E',unit='keV',array=rsp['energ_lo']),
+        fits.Column(name='ENERG_HI',format='E',unit='keV',array=rsp['energ_hi']),
+        fits.Column(name='N_GRP',format='I',array=has_values.astype(np.int16)),
+        fits.Column(name='F_CHAN',format='J',array=first+rsp['first_chan']),
+        fits.Column(name='N_CHAN',format='J',array=n_chans),
+        fits.Column(name='MATRIX',format='PE()',array=np.array(rows,dtype=object))],
+        name='MATRIX')
+    header = matrix_hdu.header
+    header['TLMIN4'] = rsp['first_chan']
+    header['TLMAX4'] = rsp['first_chan']+matrix.shape[1]-1
+    copy_keywords(rsp['header'],header)
+    if not history is None:
+        if type(history) == str: history = [history]
+        for line in history: header['HISTORY'] = line
+
+    fits.HDUList([fits.PrimaryHDU(),matrix_hdu,rsp['ebounds']]).writeto(
+        outfile,overwrite=True)
+
+def find_spectra(out_dir,inst,exp_IDs=None):
+    '''
+    Lists the energy spectra (output of he_spec, me_spec, or le_spec)
+    of all the exposures of a target
+
+    RETURNS
+    -------
+    pha_files: dictionary
+        Channel range string (ex. ch0-255): sorted list of pathlib.Path
+    '''
+
+    an = pathlib.Path(out_dir)/'analysis'
+    pha_files = {}
+    if not an.is_dir(): return pha_files
+
+    for exp_dir in sorted(an.iterdir()):
+        if not (exp_dir/inst).is_dir(): continue
+        if not exp_IDs is None and not exp_dir.name in exp_IDs: continue
+        for pha_file in sorted((exp_dir/inst).glob('*_{}_spec_ch*.pha'.format(inst))):
+            if pha_file.stem.endswith('_bkg'): continue
+            channels = pha_file.stem.split('_spec_')[1].split('_')[0]
+            pha_files.setdefault(channels,[]).append(pha_file)
+
+    return pha_files
+
+def coadded_files(pha_file):
+    '''
+    Returns the names of the spectra summed into a co-added spectrum,
+    read from its HISTORY records (see coadd_spectra)
+    '''
+
+    with fits.open(pha_file) as hdu_list:
+        history = [str(h) for h in hdu_list['SPECTRUM'].header.get('HISTORY',[])]
+    for k,line in enumerate(history):
+        if line.startswith('Sum of') and line.endswith('spectra'):
+            return [h.strip() for h in history[k+1:k+1+int(line.split()[2])]]
+    return []
+
+def coadd_spectra(pha_files,outfile,inst,override=False):
+    '''
+    Co-adds energy spectra, their backgrounds, and responses
+
+    DESCRIPTION
+    -----------
+    All the spectra are stacked into an (n_spectra, n_chan) array:
+    counts and exposures are summed. Backgrounds (BACKFILE) are scaled
+    to each source spectrum (exposure and BACKSCAL ratios) and summed
+    into a background rate spectrum with propagated errors, so that the
+    co-added spectrum has BACKSCAL=1. Responses (RESPFILE or the .rsp
+    file with the same name) are expanded to dense matrices and averaged
+    with exposure weights, stacking RSP_BATCH responses at a time.
+    An existing co-added spectrum is kept only if it was computed from
+    the same spectra (see coadded_files) and none of them has been
+    modified since.
+
+    PARAMETERS
+    ----------
+    pha_files: list
+        Energy spectra (same instrument and channels)
+    outfile: pathlib.Path
+        Co-added spectrum. Background and response are written as
+        <stem>_bkg.pha and <stem>.rsp
+    inst: string
+        Instrument (HE, ME, or LE)
+    override: boolean, optional
+        If True, existing files will be overwritten even if up to date
+
+    RETURNS
+    -------
+    outfile: pathlib.Path or None
+    '''
+
+    outfile = pathlib.Path(outfile)
+    if outfile.is_file() and not override:
+        mtime = os.path.getmtime(outfile)
+        if coadded_files(outfile) == [pathlib.Path(f).name for f in pha_files] and \
+            all([os.path.getmtime(f) <= mtime for f in pha_files]):
+            logging.info('{} is up to date'.format(outfile.name))
+            return outfile
+        logging.info('Spectra of {} changed, co-adding again'.format(outfile.name))
+
+    phas = [read_pha(f) for f in pha_files]
+    if len(set([len(p['counts']) for p in phas])) > 1:
+        logging.error('Spectra have different number of channels')
+        return
+
+    exposure = np.array([p['exposure'] for p in phas])
+    counts = np.vstack([p['counts'] for p in phas])
+    total_exposure = exposure.sum()
+
+    # Backgrounds
+    # -----------------------------------------------------------------
+    bkg_files = [pathlib.Path(f).with_name(p['backfile']) for f,p in zip(pha_files,phas)]
+    has_bkg = [p['backfile'].lower() not in ['none',''] and b.is_file()
+        for p,b in zip(phas,bkg_files)]
+    bkg_outfile = None
+    if all(has_bkg):
+        bkgs = [read_pha(b) for b in bkg_files]
+        # Scale factor of each background to its source spectrum
+        scale = np.vstack([np.broadcast_to(
+            p['exposure']*np.asarray(p['backscal']*p['areascal'])/
+            (b['exposure']*np.asarray(b['backscal']*b['areascal'])),
+            p['counts'].shape) for p,b in zip(phas,bkgs)])
+        bkg_counts = np.vstack([b['counts'] for b in bkgs])*scale
+        bkg_error = np.sqrt(np.sum((np.vstack([b['error'] for b in bkgs])*scale)**2,axis=0))
+
+        bkg_outfile = outfile.with_name(outfile.stem+'_bkg.pha')
+        write_pha(bkg_outfile,bkg_counts.sum(axis=0),total_exposure,inst,
+            header=phas[0]['header'],error=bkg_error,background=True,
+            history=['Sum of {} scaled backgrounds'.format(len(bkgs))])
+    else:
+        logging.warning('Background missing for some spectra, not co-added')
+    # -----------------------------------------------------------------
+
+    # Responses
+    # -----------------------------------------------------------------
+    rsp_files = []
+    for f,p in zip(pha_files,phas):
+        rsp_file = pathlib.Path(f).with_name(p['respfile']) if \
+            p['respfile'].lower() not in ['none',''] else pathlib.Path(f).with_suffix('.rsp')
+        rsp_files += [rsp_file]
+    rsp_outfile = None
+    if all([r.is_file() for r in rsp_files]):
+        weights = exposure/total_exposure
+        reference = read_response(rsp_files[0])
+        matrix = np.zeros_like(reference['matrix'])
+        for start in range(0,len(rsp_files),RSP_BATCH):
+            batch = [read_response(r) for r in rsp_files[start:start+RSP_BATCH]]
+            if any([b['matrix'].shape != matrix.shape or
+                not np.allclose(b['energ_lo'],reference['energ_lo']) for b in batch]):
+                logging.error('Responses have different energy or channel grids')
+                return
+            matrix += np.tensordot(weights[start:start+RSP_BATCH],
+                np.stack([b['matrix'] for b in batch]),axes=1)
+        rsp_outfile = outfile.with_suffix('.rsp')
+        write_response(rsp_outfile,reference,matrix,
+            history=['Exposure weighted average of {} responses'.format(len(rsp_files))])
+    else:
+        logging.warning('Response missing for some spectra, not averaged')
+    # -----------------------------------------------------------------
+
+    header = phas[0]['header'].copy()
+    tstart = [p['header']['TSTART'] for p in phas if 'TSTART' in p['header']]
+    tstop = [p['header']['TSTOP'] for p in phas if 'TSTOP' in p['header']]
+    if len(tstart) > 0: header['TSTART'] = min(tstart)
+    if len(tstop) > 0: header['TSTOP'] = max(tstop)
+    # Same channel range as the first spectrum (grouping quality ignored)
+    minpi,maxpi = good_channels(pha_files[0],counts.shape[1])
+    if maxpi < minpi: minpi = maxpi = None
+    write_pha(outfile,np.rint(counts.sum(axis=0)).astype(np.int64),total_exposure,
+        inst,header=header,minpi=minpi,maxpi=maxpi,
+        backfile=bkg_outfile.name if bkg_outfile else 'none',
+        respfile=rsp_outfile.name if rsp_outfile else 'none',
+        history=['Sum of {} spectra'.format(len(pha_files))]+
+        ['  {}'.format(pathlib.Path(f).name) for f in pha_files])
+
+    return outfile
+
+def coadd_stage(out_dir,instruments=['HE','ME','LE'],exp_IDs=None,
+    override=False):
+    '''
+    Co-adds the energy spectra of the exposures of a target
+
+    DESCRIPTION
+    -----------
+    For each instrument and channel range, spectra, backgrounds, and
+    responses of all the (or of the selected) exposures are co-added
+    (see coadd_spectra).
+
+    PARAMETERS
+    ----------
+    out_dir: string or pathlib.Path
+        Target folder (containing the analysis folder)
+    instruments: list, optional
+        Instruments to process (default is HE, ME, and LE)
+    exp_IDs: list or None, optional
+        Exposures to co-add. If None (default), all the exposures
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    outfiles: list
+        Co-added spectra, in the form:
+        <out_dir>/analysis/target/<target>_<INST>_spec_<channels>_sum.pha
+    '''
+
+    logging.info('===>>> Running coadd_stage <<<===')
+
+    out_dir = pathlib.Path(out_dir)
+    outfiles = []
+    for inst in instruments:
+        for channels,pha_files in find_spectra(out_dir,inst,exp_IDs).items():
+            outfile = target_dir(out_dir)/'{}_{}_spec_{}_sum.pha'.format(
+                out_dir.name,inst,channels)
+            logging.info('Co-adding {} {} spectra into {}'.format(len(pha_files),
+                inst,outfile.name))
+            outfile = coadd_spectra(pha_files,outfile,inst,override=override)
+            if outfile: outfiles += [outfile]
+
+    return outfiles
+
+def _walk_groups(lo,hi,n_chan,next_end):
+    '''
+    Defines consecutive channel groups of a batch of spectra
+
+    DESCRIPTION
+    -----------
+    Groups are built from channel lo to channel hi of each spectrum.
+    At each iteration, the next group of all the spectra is defined at
+    once by next_end, so the number of iterations is the maximum number
+    of groups, not the number of spectra.
+
+    PARAMETERS
+    ----------
+    lo, hi: numpy.ndarray
+        First and last channel to group of each spectrum (n_spec,)
+    n_chan: integer
+        Number of channels
+    next_end: function
+        next_end(rows, pos) returns the last channel of the groups
+        starting at pos for the spectra rows, or -1 if the criterion
+        cannot be satisfied before hi
+
+    RETURNS
+    -------
+    grouping, quality: numpy.ndarray
+        OGIP GROUPING (1 group start, -1 continuation) and QUALITY
+        (2 for the last, incomplete, group) of each spectrum
+        (n_spec, n_chan)
+    '''
+
+    n_spec = len(lo)
+    starts = np.zeros((n_spec,n_chan),dtype=bool)
+    tail = np.full(n_spec,-1,dtype=np.int64)
+
+    pos = lo.copy()
+    rows = np.flatnonzero(pos <= hi)
+    while len(rows) > 0:
+        starts[rows,pos[rows]] = True
+        end = next_end(rows,pos[rows])
+        missing = (end < 0) | (end > hi[rows])
+        tail[rows[missing]] = pos[rows[missing]]
+        pos[rows] = np.where(missing,hi[rows]+1,end+1)
+        rows = rows[~missing]
+        rows = rows[pos[rows] <= hi[rows]]
+
+    channel = np.arange(n_chan)[None,:]
+    inside = (channel >= lo[:,None]) & (channel <= hi[:,None])
+    grouping = np.where(inside & ~starts,-1,1).astype(np.int16)
+    quality = np.where(inside,0,5).astype(np.int16)
+    quality[(channel >= tail[:,None]) & (tail[:,None] >= 0) & inside] = 2
+
+    return grouping,quality
+
+def group_min_counts(counts,lo,hi,min_counts=25):
+    '''
+    Groups spectra so that each group has at least min_counts counts
+
+    DESCRIPTION
+    -----------
+    Cumulative counts of all the spectra are concatenated into a single
+    increasing array (each spectrum shifted above the previous one), so
+    the end of the next group of every spectrum is found with one
+    searchsorted call.
+
+    PARAMETERS
+    ----------
+    counts: numpy.ndarray
+        Counts (n_spec, n_chan)
+    lo, hi: numpy.ndarray
+        First and last channel to group of each spectrum
+    min_counts: float, optional
+        Minimum counts per group (default is 25)
+
+    RETURNS
+    -------
+    grouping, quality: numpy.ndarray
+        See _walk_groups
+    '''
+
+    n_spec,n_chan = counts.shape
+    cum = np.cumsum(counts,axis=1,dtype=np.float64)
+    step = cum[:,-1].max()+min_counts+1.
+    offset = step*np.arange(n_spec)
+    flat = (cum+offset[:,None]).ravel()
+
+    def next_end(rows,pos):
+        before = np.where(pos > 0,cum[rows,np.maximum(pos-1,0)],0.)
+        end = np.searchsorted(flat,before+min_counts+offset[rows],side='left')-rows*n_chan
+        return np.where(end < n_chan,end,-1)
+
+    return _walk_groups(lo,hi,n_chan,next_end)
+
+def group_min_snr(counts,lo,hi,min_snr=5.,bkg_counts=None,bkg_scale=None):
+    '''
+    Groups spectra so that each group has a signal to noise ratio of at
+    least min_snr
+
+    DESCRIPTION
+    -----------
+    Signal is source minus scaled background counts, noise the square
+    root of source plus scaled background variance. The end of the next
+    group of all the spectra is found at once from the cumulative
+    signal and variance.
+
+    PARAMETERS
+    ----------
+    counts: numpy.ndarray
+        Counts (n_spec, n_chan)
+    lo, hi: numpy.ndarray
+        First and last channel to group of each spectrum
+    min_snr: float, optional
+        Minimum signal to noise ratio (default is 5)
+    bkg_counts: numpy.ndarray or None, optional
+        Background counts (n_spec, n_chan)
+    bkg_scale: numpy.ndarray or None, optional
+        Background scale factors (n_spec,) or (n_spec, n_chan)
+
+    RETURNS
+    -------
+    grouping, quality: numpy.ndarray
+        See _walk_groups
+    '''
+
+    n_spec,n_chan = counts.shape
+    if bkg_counts is None:
+        bkg_counts = np.zeros_like(counts,dtype=np.float64)
+        bkg_scale = np.zeros(n_spec)
+    bkg_scale = np.broadcast_to(np.asarray(bkg_scale,dtype=np.float64).\
+        reshape(n_spec,-1),counts.shape)
+    signal = np.cumsum(counts-bkg_scale*bkg_counts,axis=1)
+    variance = np.cumsum(counts+bkg_scale**2*bkg_counts,axis=1)
+    channel = np.arange(n_chan)[None,:]
+
+    def next_end(rows,pos):
+        previous = np.maximum(pos-1,0)[:,None]
+        first = (pos == 0)[:,None]
+        group_signal = signal[rows]-np.where(first,0.,
+            np.take_along_axis(signal[rows],previous,axis=1))
+        group_variance = variance[rows]-np.where(first,0.,
+            np.take_along_axis(variance[rows],previous,axis=1))
+        ok = (group_variance > 0) & (channel >= pos[:,None]) & \
+            (group_signal >= min_snr*np.sqrt(np.abs(group_variance)))
+        return np.where(ok.any(axis=1),np.argmax(ok,axis=1),-1)
+
+    return _walk_groups(lo,hi,n_chan,next_end)
+
+def response_fwhm(rsp):
+    '''
+    Energy resolution (FWHM, in channels) at each channel of a response
+
+    DESCRIPTION
+    -----------
+    For each energy row, the FWHM is the number of channels above half
+    of the row maximum and is assigned to the channel of the maximum.
+    Values are interpolated onto all the channels.
+    '''
+
+    matrix = rsp['matrix']
+    valid = matrix.max(axis=1) > 0
+    matrix = matrix[valid]
+    peak = np.argmax(matrix,axis=1)
+    fwhm = np.sum(matrix >= 0.5*matrix.max(axis=1)[:,None],axis=1)
+
+    order = np.argsort(peak,kind='mergesort')
+    return np.maximum(np.interp(np.arange(matrix.shape[1]),peak[order],
+        fwhm[order].astype(np.float64)),1.)
+
+def group_optimal(counts,lo,hi,fwhm):
+    '''
+    Optimal binning of Kaastra & Bleeker (2016)
+
+    DESCRIPTION
+    -----------
+    The optimal bin width is a fraction of the FWHM depending on the
+    number of counts per resolution element N_r and on the number of
+    resolution elements R: with x = ln(N_r(1+0.2R)), the width is one
+    FWHM for x <= 2.119, (0.08+7/x+1.8/x^2)/(1+5.9/x) FWHM otherwise.
+    Widths are computed for every channel, groups are defined by the
+    integer part of the cumulative sum of the inverse widths.
+
+    PARAMETERS
+    ----------
+    counts: numpy.ndarray
+        Counts (n_spec, n_chan)
+    lo, hi: numpy.ndarray
+        First and last channel to group of each spectrum
+    fwhm: numpy.ndarray
+        Resolution in channels (n_spec, n_chan), see response_fwhm
+
+    RETURNS
+    -------
+    grouping, quality: numpy.ndarray
+    '''
+
+    n_spec,n_chan = counts.shape
+    channel = np.arange(n_chan)[None,:]
+    inside = (channel >= lo[:,None]) & (channel <= hi[:,None])
+
+    # Counts within one FWHM centered on each channel
+    cum = np.concatenate([np.zeros((n_spec,1)),np.cumsum(counts*inside,axis=1)],axis=1)
+    left = np.clip(np.rint(channel-fwhm/2.).astype(np.int64),0,n_chan)
+    right = np.clip(np.rint(channel+fwhm/2.).astype(np.int64)+1,0,n_chan)
+    n_res = np.take_along_axis(cum,right,axis=1)-np.take_along_axis(cum,left,axis=1)
+    n_elements = np.sum(inside/fwhm,axis=1)
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        x = np.log(np.maximum(n_res,1e-10)*(1.+0.2*n_elements[:,None]))
+        ratio = np.where(x <= 2.119,1.,(0.08+7./x+1.8/x**2)/(1.+5.9/x))
+    width = np.maximum(ratio*fwhm,1.)
+
+    # New group every time the cumulative number of bins crosses an integer
+    position = np.cumsum(np.where(inside,1./width,0.),axis=1)
+    first_position = np.take_along_axis(position,lo[:,None],axis=1)
+    group_id = np.floor(position-first_position+1e-9)
+    starts = np.ones((n_spec,n_chan),dtype=bool)
+    starts[:,1:] = group_id[:,1:] != group_id[:,:-1]
+
+    grouping = np.where(inside & ~starts,-1,1).astype(np.int16)
+    quality = np.where(inside,0,5).astype(np.int16)
+
+    return grouping,quality
+
+def write_grouping(pha_file,grouping,quality):
+    '''
+    Writes (or replaces) the GROUPING and QUALITY columns of a spectrum
+    in place
+    '''
+
+    with fits.open(pha_file,mode='update') as hdu_list:
+        hdu = hdu_list['SPECTRUM']
+        cols = [c for c in hdu.columns if not c.name.upper() in ['GROUPING','QUALITY']]
+        cols += [fits.Column(name='QUALITY',format='I',array=quality),
+            fits.Column(name='GROUPING',format='I',array=grouping)]
+        new_hdu = fits.BinTableHDU.from_columns(cols,header=hdu.header,name='SPECTRUM')
+        hdu_list[hdu_list.index_of('SPECTRUM')] = new_hdu
+
+def good_channels(pha_file,n_chan):
+    '''
+    First and last channel with good quality (QUALITY=0) of a spectrum
+    '''
+
+    with fits.open(pha_file,memmap=True) as hdu_list:
+        hdu = hdu_list['SPECTRUM']
+        if not 'QUALITY' in hdu.columns.names: return 0,n_chan-1
+        quality = np.array(hdu.data['QUALITY'])
+        # Quality set by a previous grouping is reset
+        good = np.flatnonzero((quality == 0) | (quality == 2))
+    if len(good) == 0: return 0,-1
+    return good[0],good[-1]
+
+def group_stage(out_dir,scheme='counts',value=25,instruments=['HE','ME','LE'],
+    override=False):
+    '''
+    Groups all the energy spectra of a target
+
+    DESCRIPTION
+    -----------
+    Spectra of each instrument (per exposure, time-resolved, and
+    co-added) are stacked and grouped at once, then the GROUPING and
+    QUALITY columns are written in place. Channels with bad quality
+    (ex. outside the selected channel range) are not grouped.
+
+    PARAMETERS
+    ----------
+    out_dir: string or pathlib.Path
+        Target folder (containing the analysis folder)
+    scheme: string, optional
+        'counts' (minimum counts per group, default), 'snr' (minimum
+        signal to noise ratio, background subtracted if BACKFILE is
+        available), or 'optimal' (Kaastra & Bleeker 2016, requires the
+        response)
+    value: float, optional
+        Minimum counts (default is 25) or signal to noise ratio.
+        Ignored for optimal binning
+    instruments: list, optional
+        Instruments to process (default is HE, ME, and LE)
+    override: boolean, optional
+        If True, spectra already containing a GROUPING column are
+        grouped again (default is False)
+
+    RETURNS
+    -------
+    pha_files: list
+        Grouped spectra
+    '''
+
+    logging.info('===>>> Running group_stage <<<===')
+
+    an = pathlib.Path(out_dir)/'analysis'
+    grouped = []
+    for inst in instruments:
+        pha_files = sorted(an.glob('*/{}/*_{}_*spec*.pha'.format(inst,inst)))+\
+            sorted(an.glob('{}/*_{}_spec_*.pha'.format(TARGET_FOLDER,inst)))
+        pha_files = [f for f in pha_files if not f.stem.endswith('_bkg')]
+        if not override:
+            pha_files = [f for f in pha_files if
+                not 'GROUPING' in fits.getheader(f,'SPECTRUM').values()]
+        if len(pha_files) == 0: continue
+        logging.info('Grouping {} {} spectra ({})'.format(len(pha_files),inst,scheme))
+
+        phas = [read_pha(f) for f in pha_files]
+        n_chan = INSTRUMENTS[inst]['n_chan']
+        keep = [k for k,p in enumerate(phas) if len(p['counts']) == n_chan]
+        if len(keep) < len(phas):
+            logging.warning('Skipping {} {} spectra with binned channels'.\
+                format(len(phas)-len(keep),inst))
+        if len(keep) == 0: continue
+        phas = [phas[k] for k in keep]
+        pha_files = [pha_files[k] for k in keep]
+        counts = np.vstack([p['counts'] for p in phas])
+        lo,hi = np.array([good_channels(f,n_chan) for f in pha_files]).T
+
+        if scheme == 'counts':
+            grouping,quality = group_min_counts(counts,lo,hi,min_counts=value)
+        elif scheme == 'snr':
+            bkg_counts = np.zeros_like(counts)
+            bkg_scale = np.zeros(len(phas))
+            for k,(f,p) in enumerate(zip(pha_files,phas)):
+                bkg_file = pathlib.Path(f).with_name(p['backfile'])
+                if p['backfile'].lower() in ['none',''] or not bkg_file.is_file(): continue
+                bkg = read_pha(bkg_file)
+                bkg_counts[k] = bkg['counts']
+                bkg_scale[k] = np.mean(p['exposure']*np.asarray(p['backscal'])/
+                    (bkg['exposure']*np.asarray(bkg['backscal'])))
+            grouping,quality = group_min_snr(counts,lo,hi,min_snr=value,
+                bkg_counts=bkg_counts,bkg_scale=bkg_scale)
+        elif scheme == 'optimal':
+            fwhm = np.ones_like(counts)
+            for k,(f,p) in enumerate(zip(pha_files,phas)):
+                rsp_file = pathlib.Path(f).with_name(p['respfile']) if \
+                    p['respfile'].lower() not in ['none',''] else pathlib.Path(f).with_suffix('.rsp')
+                if not rsp_file.is_file():
+                    logging.warning('Response of {} missing, using 1 channel resolution'.\
+                        format(pathlib.Path(f).name))
+                    continue
+                fwhm[k] = response_fwhm(read_response(rsp_file))
+            grouping,quality = group_optimal(counts,lo,hi,fwhm)
+        else:
+            logging.error('Unknown grouping scheme {}'.format(scheme))
+            return []
+
+        for k,pha_file in enumerate(pha_files):
+            write_grouping(pha_file,grouping[k],quality[k])
+        grouped += list(pha_files)
+
+    return grouped
@@ -0,0 +1,395 @@
+import os
+import shutil
+import pathlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .my_funcs import list_items
+
+# Local scratch staging of exposures.
+# The raw files of an exposure (and the ACS and AUX folders of its
+# observation) are copied to a local scratch folder with the same
+# proposal/observation/exposure layout of the destination folder,
+# together with the products already computed. All the stages run on
+# scratch (full_exp_dir and out_dir pointing to it), then new or
+# changed products are published to <out_dir>/analysis/<exp_ID> with
+# atomic renames and the scratch folder is removed.
+
+def _same_file(file1,file2):
+    '''
+    Returns True if file2 exists and has the same size and modification
+    time of file1
+    '''
+
+    if not file2.is_file(): return False
+    stat1,stat2 = file1.stat(),file2.stat()
+    return stat1.st_size == stat2.st_size and stat1.st_mtime_ns == stat2.st_mtime_ns
+
+def _copy_file(source,target,relocate=None):
+    '''
+    Copies a file preserving its modification time. If relocate is a
+    tuple (old folder, new folder), paths inside text (.txt) files, ex.
+    file lists and row-index sidecars, are moved to the new folder
+    '''
+
+    if relocate is None or target.suffix != '.txt':
+        shutil.copy2(source,target)
+        return
+    with open(source,'r') as infile:
+        text = infile.read()
+    with open(target,'w') as outfile:
+        outfile.write(text.replace(str(relocate[0]),str(relocate[1])))
+    shutil.copystat(source,target)
+
+def _copy_tree(source,target,relocate=None):
+    '''
+    Copies a folder preserving modification times (files already
+    present and unchanged are not copied again)
+    '''
+
+    for root,_,files in os.walk(source):
+        root = pathlib.Path(root)
+        out_root = target/root.relative_to(source)
+        if not out_root.is_dir(): os.makedirs(out_root)
+        for name in files:
+            if _same_file(root/name,out_root/name): continue
+            _copy_file(root/name,out_root/name,relocate)
+
+def stage_exposure(full_exp_dir,out_dir,scratch_dir):
+    '''
+    Copies an exposure to a local scratch folder
+
+    DESCRIPTION
+    -----------
+    The exposure folder, the ACS and AUX folders of its observation,
+    and the products already computed (<out_dir>/analysis/<exp_ID>) are
+    copied to <scratch_dir>/<exp_ID>, keeping the folder layout of
+    out_dir. A previous scratch copy of the same exposure is removed.
+
+    PARAMETERS
+    ----------
+    full_exp_dir: string or pathlib.Path
+        Full path of the exposure folder (inside out_dir)
+    out_dir: string or pathlib.Path
+        Destination folder (containing the analysis folder)
+    scratch_dir: string or pathlib.Path
+        Local scratch folder
+
+    RETURNS
+    -------
+    staged: dictionary
+        full_exp_dir (exposure folder on scratch), out_dir (scratch
+        folder to use as out_dir), exp_ID, destination (original
+        out_dir)
+    '''
+
+    full_exp_dir = pathlib.Path(full_exp_dir)
+    out_dir = pathlib.Path(out_dir)
+    exp_ID = full_exp_dir.name
+
+    scratch_out = pathlib.Path(scratch_dir).resolve()/exp_ID
+    if scratch_out.is_dir(): shutil.rmtree(scratch_out)
+    os.makedirs(scratch_out)
+
+    relative = full_exp_dir.relative_to(out_dir)
+    scratch_exp_dir = scratch_out/relative
+    _copy_tree(full_exp_dir,scratch_exp_dir)
+    for folder in ['ACS','AUX']:
+        if (full_exp_dir.parent/folder).is_dir():
+            _copy_tree(full_exp_dir.parent/folder,scratch_exp_dir.parent/folder)
+
+    products = out_dir/'analysis'/exp_ID
+    if products.is_dir():
+        _copy_tree(products,scratch_out/'analysis'/exp_ID,
+            relocate=(out_dir,scratch_out))
+
+    logging.info('Exposure {} staged to {}'.format(exp_ID,scratch_out))
+
+    return {'full_exp_dir':scratch_exp_dir,'out_dir':scratch_out,
+        'exp_ID':exp_ID,'destination':out_dir}
+
+def _publish_file(source,target,relocate=None):
+    '''
+    Copies a file to a temporary name in the target folder, then
+    renames it
+    '''
+
+    if not target.parent.is_dir(): os.makedirs(target.parent)
+    tmp_file = target.with_name(target.name+'.tmp'+target.suffix)
+    _copy_file(source,tmp_file,relocate)
+    os.replace(tmp_file,target)
+
+def _publish_folder(source,target):
+    '''
+    Copies a folder to a temporary name in the target folder, then
+    replaces the target folder
+    '''
+
+    tmp_folder = target.with_name(target.name+'.tmp')
+    if tmp_folder.is_dir(): shutil.rmtree(tmp_folder)
+    shutil.copytree(source,tmp_folder)
+    if target.is_dir(): shutil.rmtree(target)
+    os.replace(tmp_folder,target)
+
+def _changed(source,target):
+    '''
+    Returns True if any file of the source folder is missing or
+    different in the target folder
+    '''
+
+    for root,_,files in os.walk(source):
+        root = pathlib.Path(root)
+        for name in files:
+            if not _same_file(root/name,target/root.relative_to(source)/name):
+                return True
+    return False
+
+def publish_exposure(staged,clean=True):
+    '''
+    Publishes the products of a staged exposure to the destination
+
+    DESCRIPTION
+    -----------
+    New or changed products in <scratch>/analysis/<exp_ID>/<INST> are
+    copied to the corresponding destination folder under a temporary
+    name and renamed when complete, so partial products are never
+    visible in the destination. Sub-folders (ex. column caches) are
+    published as a whole, paths inside text files are moved from the
+    scratch folder to the destination. The scratch folder is then
+    removed.
+
+    PARAMETERS
+    ----------
+    staged: dictionary
+        Staged exposure (see stage_exposure)
+    clean: boolean, optional
+        If True (default), the scratch folder is removed
+
+    RETURNS
+    -------
+    n_published: integer
+        Number of published files and folders
+    '''
+
+    exp_ID = staged['exp_ID']
+    source = staged['out_dir']/'analysis'/exp_ID
+    target = staged['destination']/'analysis'/exp_ID
+
+    relocate = (staged['out_dir'],staged['destination'])
+
+    n_published = 0
+    if source.is_dir():
+        for inst_dir in sorted(source.iterdir()):
+            if not inst_dir.is_dir(): continue
+            for item in sorted(inst_dir.iterdir()):
+                out_item = target/inst_dir.name/item.name
+                if '.tmp' in item.name: continue
+                if item.is_dir():
+                    if not _changed(item,out_item): continue
+                    if not out_item.parent.is_dir(): os.makedirs(out_item.parent)
+                    _publish_folder(item,out_item)
+                else:
+                    if _same_file(item,out_item): continue
+                    _publish_file(item,out_item,relocate)
+                n_published += 1
+    logging.info('{} products of {} published'.format(n_published,exp_ID))
+
+    if clean: shutil.rmtree(staged['out_dir'])
+
+    return n_published
+
+def discard_exposure(staged):
+    '''
+    Removes the scratch folder of a staged exposure without publishing
+    its products (ex. when a stage failed, so partial products never
+    reach the destination)
+    '''
+
+    if staged['out_dir'].is_dir(): shutil.rmtree(staged['out_dir'])
+    logging.info('Products of {} not published, scratch copy removed'.format(
+        staged['exp_ID']))
+
+# Exposures staged in advance (see make_prefetcher)
+PREFETCH = 2
+
+def _tree_size(folder):
+    '''
+    Returns the total size (bytes) of the files inside a folder
+    '''
+
+    size = 0
+    for root,_,files in os.walk(folder):
+        for name in files:
+            try:
+                size += os.stat(os.path.join(root,name)).st_size
+            except FileNotFoundError:
+                continue
+    return size
+
+def staging_size(full_exp_dir,out_dir):
+    '''
+    Returns the size (bytes) of the scratch copy of an exposure (see
+    stage_exposure)
+    '''
+
+    full_exp_dir = pathlib.Path(full_exp_dir)
+    size = _tree_size(full_exp_dir)
+    for folder in ['ACS','AUX']:
+        size += _tree_size(full_exp_dir.parent/folder)
+    return size+_tree_size(pathlib.Path(out_dir)/'analysis'/full_exp_dir.name)
+
+def list_exposures(observations):
+    '''
+    Returns the exposure folders of a list of observations, skipping
+    observations without AUX folder (not reduced by the pipeline)
+    '''
+
+    exposures = []
+    for observation in observations:
+        if not (pathlib.Path(observation)/'AUX').is_dir(): continue
+        items = list_items(observation,exclude_or=['ACS','AUX'])
+        if type(items) != list: items = [items]
+        exposures += items
+    return exposures
+
+def make_prefetcher(out_dir,scratch_dir,lookahead=PREFETCH,n_workers=2,
+    max_bytes=None):
+    '''
+    Background prefetcher of staged exposures
+
+    DESCRIPTION
+    -----------
+    Exposures are added to the schedule with schedule_exposures and
+    obtained, in any order, with fetch_exposure. Every time an exposure
+    is fetched, the next lookahead exposures of the schedule are staged
+    (see stage_exposure) in background threads, so that the copy from
+    the destination folder overlaps the reduction of the current one.
+    A new exposure is not staged in advance if the scratch folder
+    (including the exposure being reduced) would exceed max_bytes.
+
+    PARAMETERS
+    ----------
+    out_dir: string or pathlib.Path
+        Destination folder
+    scratch_dir: string or pathlib.Path
+        Local scratch folder
+    lookahead: integer, optional
+        Number of exposures staged in advance
+    n_workers: integer, optional
+        Number of exposures staged at the same time
+    max_bytes: integer or None, optional
+        Maximum size of the scratch folder. If None, no limit
+
+    RETURNS
+    -------
+    prefetcher: dictionary
+    '''
+
+    return {'out_dir':pathlib.Path(out_dir),'scratch_dir':pathlib.Path(scratch_dir),
+        'lookahead':lookahead,'max_bytes':max_bytes,'schedule':[],'current':-1,
+        'futures':{},'sizes':{},
+        'executor':ThreadPoolExecutor(max_workers=max(1,n_workers))}
+
+def schedule_exposures(prefetcher,exposures):
+    '''
+    Appends exposures to the schedule of a prefetcher (exposures already
+    scheduled are ignored)
+    '''
+
+    for exposure in exposures:
+        exposure = pathlib.Path(exposure)
+        if not exposure in prefetcher['schedule']:
+            prefetcher['schedule'] += [exposure]
+    _fill_prefetcher(prefetcher)
+
+def _fill_prefetcher(prefetcher):
+    '''
+    Stages in background the next exposures of the schedule, within
+    the lookahead and the disk cap
+    '''
+
+    schedule = prefetcher['schedule']
+    futures = prefetcher['futures']
+    start = prefetcher['current']+1
+    for exposure in schedule[start:start+prefetcher['lookahead']]:
+        if exposure in futures: continue
+
+        size = staging_size(exposure,prefetcher['out_dir'])
+        if not prefetcher['max_bytes'] is None:
+            # Staging in progress is counted with its final size
+            used = _tree_size(prefetcher['scratch_dir'])+sum(
+                prefetcher['sizes'][e] for e,f in futures.items() if not f.done())
+            if used+size > prefetcher['max_bytes']: break
+
+        prefetcher['sizes'][exposure] = size
+        futures[exposure] = prefetcher['executor'].submit(stage_exposure,
+            exposure,prefetcher['out_dir'],prefetcher['scratch_dir'])
+
+def fetch_exposure(prefetcher,full_exp_dir):
+    '''
+    Returns a staged exposure (see stage_exposure), waiting for its
+    background staging or staging it now if it was not prefetched,
+    and starts staging the following exposures of the schedule
+    '''
+
+    exposure = pathlib.Path(full_exp_dir)
+    schedule = prefetcher['schedule']
+    if not exposure in schedule: schedule += [exposure]
+    prefetcher['current'] = schedule.index(exposure)
+
+    future = prefetcher['futures'].pop(exposure,None)
+    prefetcher['sizes'].pop(exposure,None)
+    if future is None:
+        staged = stage_exposure(exposure,prefetcher['out_dir'],prefetcher['scratch_dir'])
+    else:
+        staged = future.result()
+        logging.info('Exposure {} prefetched'.format(exposure.name))
+
+    _fill_prefetcher(prefetcher)
+
+    return staged
+
+def close_prefetcher(prefetcher):
+    '''
+    Stops a prefetcher, removing exposures staged but never fetched
+    '''
+
+    for future in prefetcher['futures'].values(): future.cancel()
+    prefetcher['executor'].shutdown(wait=True)
+    for exposure,future in prefetcher['futures'].items():
+        if future.cancelled(): continue
+        scratch_out = prefetcher['scratch_dir'].resolve()/exposure.name
+        if scratch_out.is_dir(): shutil.rmtree(scratch_out)
+    prefetcher['futures'] = {}
+
+def working_folders(full_exp_dir,out_dir,scratch_dir=None,prefetcher=None):
+    '''
+    Returns the folders where the stages of an exposure run
+
+    DESCRIPTION
+    -----------
+    Without staging, the exposure folder and out_dir themselves. With
+    a prefetcher (see fetch_exposure) or a scratch folder (see
+    stage_exposure), the exposure is staged and the scratch copies are
+    returned, so that all the products are written on scratch and
+    published afterwards (see publish_exposure).
+
+    RETURNS
+    -------
+    staged: dictionary or None
+        Staged exposure, None if not staging
+    full_exp_dir: pathlib.Path
+        Exposure folder to pass to the stages
+    out_dir: pathlib.Path
+        Output folder (containing the analysis folder) to pass to the
+        stages
+    '''
+
+    staged = None
+    if not prefetcher is None:
+        staged = fetch_exposure(prefetcher,full_exp_dir)
+    elif not scratch_dir is None:
+        staged = stage_exposure(full_exp_dir,out_dir,scratch_dir)
+    if staged is None: return None,pathlib.Path(full_exp_dir),pathlib.Path(out_dir)
+
+    return staged,staged['full_exp_dir'],staged['out_dir']
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+# Exposure ID in the format checked by check_exp_format
+EXP_ID = 'P010131500101-20171031-01-01'
+
+def write_events(fits_file,columns,header=None,name='EVENTS'):
+    '''
+    Writes an event file from a dictionary of column name: (format,
+    array)
+    '''
+
+    hdu = fits.BinTableHDU.from_columns([fits.Column(name=col,format=fmt,array=array)
+        for col,(fmt,array) in columns.items()],name=name)
+    if not header is None: hdu.header.update(header)
+    fits.HDUList([fits.PrimaryHDU(),hdu]).writeto(fits_file,overwrite=True)
+
+def write_gti(gti_file,start,stop,names=['GTI']):
+    '''
+    Writes a GTI file (one extension per name)
+    '''
+
+    hdus = [fits.PrimaryHDU()]
+    for name in names:
+        hdus += [fits.BinTableHDU.from_columns([
+            fits.Column(name='START',format='D',array=np.asarray(start,dtype=float)),
+            fits.Column(name='STOP',format='D',array=np.asarray(stop,dtype=float))],
+            name=name)]
+    fits.HDUList(hdus).writeto(gti_file,overwrite=True)
+
+def write_he_dtime(dead_file,time,rate):
+    '''
+    HE-DTime layout: running dead time counters of the 18 detectors,
+    each detector dead for a fraction rate[det] of the time
+    '''
+
+    counter = (time[:,None]-time[0])*np.asarray(rate)[None,:]
+    write_events(dead_file,{'TIME':('D',time),'DEADTIME':('18D',counter)},name='DTime')
+
+@pytest.fixture
+def screened_exposure(tmp_path):
+    '''
+    Returns a function writing the screened event file and the GTI file
+    of a synthetic exposure in <tmp_path>/target/analysis/<EXP_ID>/<INST>
+    and returning (full_exp_dir, out_dir, destination)
+    '''
+
+    def make(inst,time,pi,det_id,gti,header=None):
+        full_exp_dir = tmp_path/'raw'/EXP_ID
+        os.makedirs(full_exp_dir,exist_ok=True)
+        out_dir = tmp_path/'target'
+        destination = out_dir/'analysis'/EXP_ID/inst
+        os.makedirs(destination,exist_ok=True)
+        order = np.argsort(time,kind='mergesort')
+        write_events(destination/'{}_{}_evt_screen.fits'.format(EXP_ID,inst),
+            {'TIME':('D',np.asarray(time)[order]),'PI':('J',np.asarray(pi)[order]),
+            'DET_ID':('B',np.asarray(det_id)[order])},header=header)
+        write_gti(destination/'{}_{}_gti.fits'.format(EXP_ID,inst),*gti)
+        return full_exp_dir,out_dir,destination
+
+    return make
@@ -0,0 +1,108 @@
+import io
+import json
+import tarfile
+
+import pytest
+
+from functions.archive_funcs import extract_archive, is_extracted, \
+    manifest_name, archive_exposures, extract_iter, archive_view, \
+    fetch_raw_inputs, release_raw_inputs
+
+OBS = 'P0101315/P0101315001'
+EXP_ID = 'P010131500101-20171031-01-01'
+MEMBERS = {
+    OBS+'/ACS/HXMT_P0101315001_Att_FFFFFF_V1_L1P.FITS':b'att'*10,
+    OBS+'/ACS/HXMT_P0101315001_Orbit_FFFFFF_V1_L1P.FITS':b'orb'*10,
+    OBS+'/AUX/HXMT_P0101315001_EHK_FFFFFF_V1_L1P.FITS':b'ehk'*10,
+    OBS+'/'+EXP_ID+'/HE/HXMT_P0101315001_HE-Evt_FFFFFF_V1_L1P.FITS':b'evt'*100,
+    OBS+'/'+EXP_ID+'/HE/HXMT_P0101315001_HE-DTime_FFFFFF_V1_L1P.FITS':b'dt'*10,
+    OBS+'/'+EXP_ID+'/HE/HXMT_P0101315001_HE-HV_FFFFFF_V1_L1P.FITS':b'hv'*10,
+    OBS+'/'+EXP_ID+'/ME/HXMT_P0101315001_ME-Evt_FFFFFF_V1_L1P.FITS':b'me'*100,
+    }
+
+def make_archive(tmp_path,compressed,members=MEMBERS,name='P0101315001'):
+    archive = tmp_path/(name+'.tar'+('.gz' if compressed else ''))
+    with tarfile.open(archive,'w:gz' if compressed else 'w') as tar:
+        for name,data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 1.5e9
+            tar.addfile(info,io.BytesIO(data))
+    return archive
+
+def test_extract_selection_and_manifest(tmp_path):
+    archive = make_archive(tmp_path,True)
+    destination = tmp_path/'dst'
+
+    result = extract_archive(archive,destination,instruments=['HE'],
+        file_types=['*HE-Evt*'])
+    assert result['status'] == 'extracted' and result['n_files'] == 4
+    assert (destination/OBS/EXP_ID/'HE'/'HXMT_P0101315001_HE-Evt_FFFFFF_V1_L1P.FITS').\
+        read_bytes() == b'evt'*100
+    assert not (destination/OBS/EXP_ID/'HE'/'HXMT_P0101315001_HE-DTime_FFFFFF_V1_L1P.FITS').exists()
+    assert not (destination/OBS/EXP_ID/'ME').exists()
+
+    with open(manifest_name(archive,destination),'r') as infile:
+        assert len(json.load(infile)['members']) == 4
+    assert is_extracted(archive,destination,['HE'],['*HE-Evt*'])
+    assert not is_extracted(archive,destination,['HE','ME'],['*HE-Evt*'])
+    assert extract_archive(archive,destination,['HE'],['*HE-Evt*'])['status'] == 'skipped'
+    assert archive_exposures(archive,destination) == \
+        {destination/'P0101315':{destination/OBS:[destination/OBS/EXP_ID]}}
+
+    # A removed file invalidates the manifest
+    (destination/OBS/'AUX'/'HXMT_P0101315001_EHK_FFFFFF_V1_L1P.FITS').unlink()
+    assert not is_extracted(archive,destination,['HE'],['*HE-Evt*'])
+
+def test_extract_iter_yields_archive_exposures(tmp_path):
+    # The second exposure of the observation is in another archive
+    data_dir = tmp_path/'data'
+    data_dir.mkdir()
+    make_archive(data_dir,True)
+    exp_2 = 'P010131500102-20171031-01-01'
+    make_archive(data_dir,True,name='P0101315001_2',members={
+        OBS+'/AUX/HXMT_P0101315001_EHK_FFFFFF_V1_L1P.FITS':b'ehk'*10,
+        OBS+'/'+exp_2+'/HE/HXMT_P0101315001_HE-Evt_FFFFFF_V1_L1P.FITS':b'evt'})
+    destination = tmp_path/'dst'
+    # Folder left by a previous run
+    (destination/OBS/'P010131500103-20171031-01-01').mkdir(parents=True)
+
+    batches = list(extract_iter(data_dir,destination,instruments=['HE'],n_workers=2))
+    assert len(batches) == 2
+    yielded = sorted(exposures[destination/OBS] for proposal,exposures in batches)
+    assert yielded == [[destination/OBS/EXP_ID],[destination/OBS/exp_2]]
+
+@pytest.mark.parametrize('compressed',[False,True])
+def test_fetch_and_release(tmp_path,monkeypatch,compressed):
+    archive = make_archive(tmp_path,compressed)
+    destination = tmp_path/'dst'
+    view = archive_view(tmp_path,destination,n_workers=1)
+    full_exp_dir = destination/OBS/EXP_ID
+    assert (full_exp_dir/'HE').is_dir() and (full_exp_dir/'ME').is_dir()
+    assert not any(f.is_file() for f in destination.rglob('*.FITS'))
+
+    n_open = []
+    tar_open = tarfile.open
+    def counting_open(*args,**kwargs):
+        n_open.append(args)
+        return tar_open(*args,**kwargs)
+    monkeypatch.setattr(tarfile,'open',counting_open)
+
+    # All the HE stages in a single pass
+    files = fetch_raw_inputs(view,full_exp_dir,['he_cal','he_gti','he_lc','he_rsp'])
+    names = sorted(f.name for f in files)
+    assert names == sorted(set(names))
+    assert len(names) == 5
+    assert len(n_open) == (1 if compressed else 0)
+    for f in files:
+        assert f.read_bytes() == MEMBERS[str(f.relative_to(destination))]
+    assert not (full_exp_dir/'ME'/'HXMT_P0101315001_ME-Evt_FFFFFF_V1_L1P.FITS').exists()
+
+    # Files already extracted are not read again
+    assert fetch_raw_inputs(view,full_exp_dir,'he_lc') == \
+        [full_exp_dir/'HE'/'HXMT_P0101315001_HE-DTime_FFFFFF_V1_L1P.FITS']
+    assert len(n_open) == (1 if compressed else 0)
+
+    release_raw_inputs(view,full_exp_dir)
+    assert not any(f.is_file() for f in files)
+    assert view['fetched'] == {}
@@ -0,0 +1,116 @@
+import os
+import pathlib
+
+import numpy as np
+from astropy.io import fits
+
+from functions.my_funcs import list_items
+from functions.bary_funcs import bary_correction, barycentre, bary_stage, \
+    read_bary, bary_name, BARY_FOLDER
+from functions.product_funcs import find_lightcurves
+
+EXP_ID = 'P010131500203-20171102-01-01'
+MJDREF = 55927.00076601852
+RA,DEC = 83.633,22.0145
+T0,T = 1.8e8,300.
+
+def make_exposure(tmp_path,n_events=2000):
+    '''
+    Synthetic exposure: circular orbit file (km), screened events, GTI,
+    and a source and a background lightcurve
+    '''
+
+    full_exp_dir = tmp_path/'raw'/EXP_ID
+    os.makedirs(full_exp_dir/'ACS')
+    orbit_time = np.arange(T0-100,T0+T+100,1.)
+    phase = 2*np.pi/5700*orbit_time
+    position = [7000*np.cos(phase),7000*np.sin(phase),0*phase]
+    orbit = fits.BinTableHDU.from_columns([fits.Column('Time','D',array=orbit_time)]+
+        [fits.Column(axis,'D',unit='km',array=p) for axis,p in zip('XYZ',position)],
+        name='Orbit')
+    fits.HDUList([fits.PrimaryHDU(),orbit]).writeto(
+        full_exp_dir/'ACS'/'HXMT_P010131500203_Orbit_FFFFFF_V1_L1P.FITS')
+
+    out_dir = tmp_path/'target'
+    destination = out_dir/'analysis'/EXP_ID/'HE'
+    os.makedirs(destination)
+    time = np.sort(np.random.default_rng(1).uniform(T0,T0+T,n_events))
+    events = fits.BinTableHDU.from_columns([fits.Column('TIME','D',array=time),
+        fits.Column('DET_ID','B',array=np.zeros(n_events)),
+        fits.Column('PI','I',array=np.full(n_events,150))],name='EVENTS')
+    events.header.update(MJDREFI=55927,MJDREFF=0.00076601852,TIMESYS='TT',
+        RA_OBJ=RA,DEC_OBJ=DEC)
+    fits.HDUList([fits.PrimaryHDU(),events]).writeto(
+        destination/'{}_HE_evt_screen.fits'.format(EXP_ID))
+    gti = fits.BinTableHDU.from_columns([fits.Column('START','D',array=[T0]),
+        fits.Column('STOP','D',array=[T0+T])],name='GTI')
+    fits.HDUList([fits.PrimaryHDU(),gti]).writeto(destination/'{}_HE_gti.fits'.format(EXP_ID))
+    for suffix in ['','_bkg']:
+        lc = fits.BinTableHDU.from_columns([
+            fits.Column('TIME','D',array=T0+np.arange(T)+0.5),
+            fits.Column('RATE','D',array=np.ones(int(T))),
+            fits.Column('ERROR','D',array=np.ones(int(T)))],name='RATE')
+        lc.header['TIMESYS'] = 'TT'
+        fits.HDUList([fits.PrimaryHDU(),lc]).writeto(
+            destination/'{}_HE_lc_ch8-162_1s{}.lc'.format(EXP_ID,suffix))
+
+    return full_exp_dir,out_dir,destination,time
+
+def test_geocentric_correction_vs_astropy():
+    from astropy.time import Time
+    from astropy.coordinates import SkyCoord, EarthLocation
+
+    time = np.array([T0,T0+5000.])
+    corr = bary_correction(time,np.array([0.,3e8]),np.zeros((2,3)),RA,DEC,MJDREF)
+
+    tt = Time(MJDREF,time/86400,format='mjd',scale='tt')
+    ltt = tt.light_travel_time(SkyCoord(RA,DEC,unit='deg'),kind='barycentric',
+        location=EarthLocation.from_geocentric(0,0,0,unit='m'),ephemeris='builtin')
+    ref = tt.tdb+ltt
+    ref = ((ref.tdb.jd1-tt.jd1)+(ref.tdb.jd2-tt.jd2))*86400
+
+    # astropy does not include the Shapiro delay (~ 1 us)
+    assert np.all(np.abs(corr-ref) < 2e-6)
+
+def test_barycentre_interpolation():
+    grid = np.array([0.,10.,20.])
+    correction = np.array([1.,2.,3.])
+    assert np.allclose(barycentre(np.array([5.,15.]),grid,correction),[6.5,17.5])
+
+def test_bary_stage(tmp_path):
+    full_exp_dir,out_dir,destination,time = make_exposure(tmp_path)
+    outfile = bary_stage(full_exp_dir,'HE',out_dir=out_dir)
+
+    assert outfile == bary_name(out_dir/'analysis'/EXP_ID,EXP_ID,'HE')
+    grid,correction = read_bary(outfile)
+    bary_time = fits.getdata(outfile,'BARYTIME')['BARYTIME']
+    assert len(bary_time) == len(time)
+    assert np.allclose(bary_time,barycentre(time,grid,correction),atol=1e-9)
+    # Roemer delay within one light-travel time of the Earth orbit
+    assert np.all(np.abs(correction) < 600)
+
+    bary_lc = destination/BARY_FOLDER/'{}_HE_lc_ch8-162_1s_bary.lc'.format(EXP_ID)
+    assert fits.getheader(bary_lc,1)['TIMESYS'] == 'TDB'
+
+def test_bary_stage_rerun_keeps_lightcurve_lookups(tmp_path):
+    # Regression: barycentred lightcurves in the instrument folder were
+    # picked up by the he_lc/he_bkg lookups and by find_lightcurves
+    full_exp_dir,out_dir,destination,_ = make_exposure(tmp_path)
+    bary_stage(full_exp_dir,'HE',out_dir=out_dir)
+    bary_stage(full_exp_dir,'HE',out_dir=out_dir,override=True)
+
+    file_name_root = '{}_HE_lc_ch8-162_1s'.format(EXP_ID)
+    lc_file = list_items(destination,itype='file',include_or=file_name_root,
+        exclude_or=['bkg','net'],ext='lc')
+    assert isinstance(lc_file,pathlib.Path)
+    bkg_file = list_items(destination,itype='file',
+        include_and=[file_name_root,'_bkg'],ext='lc')
+    assert isinstance(bkg_file,pathlib.Path)
+
+    assert find_lightcurves(out_dir,'HE') == [destination/(file_name_root+'.lc')]
+    assert find_lightcurves(out_dir,'HE',kind='bkg') == \
+        [destination/(file_name_root+'_bkg.lc')]
+
+    # Barycentred copies are not barycentred again
+    bary_files = sorted(f.name for f in (destination/BARY_FOLDER).glob('*.lc'))
+    assert bary_files == [file_name_root+'_bary.lc',file_name_root+'_bkg_bary.lc']
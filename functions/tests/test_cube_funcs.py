@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from functions.cube_funcs import channel_groups, gti_bins, count_cube_stage, \
+    cube_lightcurve
+from conftest import write_events
+
+def test_channel_groups():
+    pi_lo,pi_hi = channel_groups(0,9,4)
+    assert list(pi_lo) == [0,4,8] and list(pi_hi) == [3,7,9]
+    pi_lo,pi_hi = channel_groups(2,9,[2,5])
+    assert list(pi_lo) == [2,5] and list(pi_hi) == [4,9]
+    with pytest.raises(ValueError):
+        channel_groups(0,9,[1,5])
+
+def test_gti_bins():
+    bin_start,n_bins = gti_bins((np.array([0.,100.]),np.array([2.5,101.])),1.)
+    assert list(n_bins) == [2,1]
+    assert list(bin_start) == [0.,1.,100.]
+
+def test_cube_only_stores_gti_bins(screened_exposure):
+    rng = np.random.default_rng(2)
+    gti = (np.array([1000.,5000.]),np.array([1010.,5020.]))
+    time = np.concatenate([rng.uniform(1000,1010,500),rng.uniform(5000,5020,800),
+        rng.uniform(2000,3000,300)])
+    pi = rng.integers(0,256,len(time))
+    det_id = rng.integers(0,16,len(time))
+    full_exp_dir,out_dir,_ = screened_exposure('HE',time,pi,det_id,gti)
+
+    cube_file = count_cube_stage(full_exp_dir,'HE',timedel=0.5,group=16,
+        chunk_cells=16*7,out_dir=out_dir)
+    with fits.open(cube_file) as hdu_list:
+        cube = hdu_list['CUBE'].data
+        # 20 + 40 bins, the 4 ks gap is not stored
+        assert len(cube) == 60
+        assert list(hdu_list['GTI'].data['NBINS']) == [20,40]
+        counts = np.array(cube['COUNTS'])
+        bins = np.array(cube['TIME'])
+
+    assert counts.shape == (60,16)
+    in_gti = ((time >= 1000) & (time < 1010)) | ((time >= 5000) & (time < 5020))
+    assert counts.sum() == in_gti.sum()
+    expected = np.zeros((60,16),dtype=np.int64)
+    row = np.searchsorted(bins,time[in_gti],side='right')-1
+    np.add.at(expected,(row,pi[in_gti]//16),1)
+    assert np.array_equal(counts,expected)
+
+    lc = cube_lightcurve(cube_file,minpi=32,maxpi=63,rebin=4)
+    band = in_gti & (pi >= 32) & (pi <= 63)
+    assert lc['chmin'] == 32 and lc['chmax'] == 63
+    assert len(lc['time']) == 5+10
+    assert lc['counts'].sum() == band.sum()
+    assert np.allclose(lc['time'][:2],[1001.,1003.])
+    assert np.allclose(lc['time'][5],5001.)
+
+def test_cube_lightcurve_dead_time(screened_exposure,tmp_path):
+    time = np.sort(np.random.default_rng(4).uniform(0,20,400))
+    full_exp_dir,out_dir,_ = screened_exposure('HE',time,np.full(400,20),
+        np.zeros(400,dtype=int),([0.],[20.]))
+    cube_file = count_cube_stage(full_exp_dir,'HE',timedel=1.,out_dir=out_dir)
+
+    # Running counters, detectors dead 25% of the time
+    dead_time = np.arange(-5.,26.)
+    write_events(tmp_path/'dtime.fits',{'TIME':('D',dead_time),
+        'DEADTIME':('18D',np.outer(dead_time+5,np.full(18,0.25)))})
+
+    lc_file = tmp_path/'cube.lc'
+    lc = cube_lightcurve(cube_file,rebin=2,dead_file=tmp_path/'dtime.fits',
+        outfile=lc_file)
+    assert np.allclose(lc['live'],0.75)
+    assert np.allclose(lc['rate'],lc['counts']/1.5)
+    rate = fits.getdata(lc_file,'RATE')
+    assert np.allclose(rate['RATE'],lc['rate'])
+    assert fits.getheader(lc_file,'RATE')['DEADAPP']
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from functions.deadtime_funcs import read_dead_time, dead_time_on_grid, \
+    live_fraction, dead_time_correct
+from conftest import write_events, write_he_dtime
+
+def test_he_counters(tmp_path):
+    time = np.arange(0.,11.)
+    rate = np.full(18,0.1)
+    counter = (time[:,None]-time[0])*rate[None,:]
+    # Counter reset after the 6th sample
+    counter[6:] -= counter[6]
+    # Other dead time related columns are not read as detectors
+    write_events(tmp_path/'dtime.fits',{'TIME':('D',time),'DEADTIME':('18D',counter),
+        'DEAD_CNT':('J',np.arange(11)*1000)})
+
+    edges,dead = read_dead_time(tmp_path/'dtime.fits','HE')
+    assert np.array_equal(edges,time)
+    assert dead.shape == (10,18)
+    assert np.allclose(dead[:5],0.1) and np.allclose(dead[5],0.) and np.allclose(dead[6:],0.1)
+
+def test_me_fractions_on_grid(tmp_path):
+    time = np.arange(0.,10.)
+    fraction = np.zeros((10,54))
+    fraction[:,:27] = 0.2
+    write_events(tmp_path/'me_dtime.fits',{'TIME':('D',time),'DEADTIME':('54D',fraction)})
+
+    edges,dead = read_dead_time(tmp_path/'me_dtime.fits','ME')
+    assert np.allclose(edges,np.arange(0.,11.))
+    # Finer and coarser grids, detector selection
+    assert np.allclose(dead_time_on_grid(edges,dead,[0.,0.25,0.5],det_ids='0-26'),0.05)
+    assert np.allclose(dead_time_on_grid(edges,dead,[0.,4.,10.]),[0.4,0.6])
+    assert np.allclose(dead_time_on_grid(edges,dead,[0.,4.],det_ids='27-53'),0.)
+
+def test_unknown_instrument_or_layout(tmp_path):
+    with pytest.raises(ValueError):
+        read_dead_time(tmp_path/'le_dtime.fits','LE')
+    write_events(tmp_path/'dtime.fits',{'TIME':('D',np.arange(3.)),
+        'DEAD_FRAC':('18D',np.zeros((3,18)))})
+    with pytest.raises(ValueError):
+        read_dead_time(tmp_path/'dtime.fits','ME')
+
+def test_live_fraction_and_correction(tmp_path):
+    rate = np.full(18,0.1)
+    rate[17] = 0.5
+    write_he_dtime(tmp_path/'dtime.fits',np.arange(0.,101.),rate)
+
+    # Non contiguous bins
+    start,stop = np.array([10.,50.5]),np.array([12.,51.])
+    assert np.allclose(live_fraction(tmp_path/'dtime.fits','HE',start,stop,
+        det_ids='0-15'),0.9)
+    assert np.allclose(live_fraction(tmp_path/'dtime.fits','HE',start,stop,
+        det_ids='17'),0.5)
+
+    counts = np.array([[90.,50.,10.],[9.,5.,1.]])
+    rate,error = dead_time_correct(counts,2.,np.array([0.9,0.5,0.01]))
+    assert np.allclose(rate[:,:2],[[50.,50.],[5.,5.]])
+    assert np.allclose(error[0,:2],np.sqrt([90.,50.])/np.array([1.8,1.]))
+    assert np.all(np.isnan(rate[:,2])) and np.all(np.isnan(error[:,2]))
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from functions.fits_funcs import read_columns, open_table, column_views, \
+    update_header_keys, queue_header_keys, apply_header_updates, BLOCK, CARD
+
+def make_spectrum(fits_file,n_cards=0):
+    hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='CHANNEL',format='J',array=np.arange(100)),
+        fits.Column(name='COUNTS',format='J',array=np.arange(100)*3)],name='SPECTRUM')
+    hdu.header['RESPFILE'] = 'none'
+    for k in range(n_cards): hdu.header['KEY{}'.format(k)] = k
+    fits.HDUList([fits.PrimaryHDU(),hdu]).writeto(fits_file)
+    return fits_file
+
+def test_read_columns(tmp_path):
+    fits_file = tmp_path/'events.fits'
+    hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='TIME',format='D',array=np.arange(5.)),
+        fits.Column(name='PHA',format='I',bzero=32768,array=np.array([0,1,40000,65535,7],
+            dtype=np.uint16))],name='EVENTS')
+    fits.HDUList([fits.PrimaryHDU(),hdu]).writeto(fits_file)
+
+    data = read_columns(fits_file,['TIME','PHA'],rows=np.array([1,3]))
+    assert data['PHA'].dtype == np.uint16 and list(data['PHA']) == [1,65535]
+    assert data['TIME'].dtype.isnative and list(data['TIME']) == [1.,3.]
+    with open_table(fits_file) as table:
+        assert list(column_views(table,['TIME'])['TIME']) == list(np.arange(5.))
+        with pytest.raises(ValueError):
+            column_views(table,['PHA'])
+
+def test_update_header_keys_in_place(tmp_path):
+    fits_file = make_spectrum(tmp_path/'spec.pha')
+    size = fits_file.stat().st_size
+    with open(fits_file,'rb') as infile: before = infile.read()
+
+    assert update_header_keys(fits_file,{'RESPFILE':'spec.rsp','BACKFILE':'spec_bkg.pha'},
+        hdus=['SPECTRUM'])
+    assert fits_file.stat().st_size == size
+    with fits.open(fits_file,checksum=False) as hdu_list:
+        assert hdu_list['SPECTRUM'].header['RESPFILE'] == 'spec.rsp'
+        assert hdu_list['SPECTRUM'].header['BACKFILE'] == 'spec_bkg.pha'
+        assert not 'BACKFILE' in hdu_list[0].header
+        assert np.array_equal(hdu_list['SPECTRUM'].data['COUNTS'],np.arange(100)*3)
+    # Only the header of the spectrum changed
+    with open(fits_file,'rb') as infile: after = infile.read()
+    assert after[:BLOCK] == before[:BLOCK] and after[-BLOCK:] == before[-BLOCK:]
+
+def test_update_header_keys_full_block(tmp_path):
+    # Header filling its last block: astropy rewrites the file
+    with fits.open(make_spectrum(tmp_path/'probe.pha')) as hdu_list:
+        n_cards = len(hdu_list['SPECTRUM'].header)
+    fits_file = make_spectrum(tmp_path/'spec.pha',n_cards=BLOCK//CARD-1-n_cards)
+    assert not update_header_keys(fits_file,{'BACKFILE':'spec_bkg.pha'},hdus=['SPECTRUM'])
+    assert fits.getheader(fits_file,'SPECTRUM')['BACKFILE'] == 'spec_bkg.pha'
+
+def test_apply_header_updates(tmp_path):
+    files = [make_spectrum(tmp_path/'spec{}.pha'.format(k)) for k in range(2)]
+    updates = {}
+    queue_header_keys(updates,files[0],{'RESPFILE':'a.rsp'})
+    queue_header_keys(updates,files[0],{'BACKFILE':'a_bkg.pha'})
+    queue_header_keys(updates,files[1],{'RESPFILE':'b.rsp'})
+    queue_header_keys(updates,tmp_path/'missing.pha',{'RESPFILE':'c.rsp'})
+
+    assert apply_header_updates(updates,hdus=['SPECTRUM']) == 2
+    assert updates == {}
+    header = fits.getheader(files[0],'SPECTRUM')
+    assert header['RESPFILE'] == 'a.rsp' and header['BACKFILE'] == 'a_bkg.pha'
+    assert fits.getheader(files[1],'SPECTRUM')['RESPFILE'] == 'b.rsp'
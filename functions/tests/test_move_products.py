@@ -0,0 +1,53 @@
+import os
+import gzip
+
+from scripts.move_products import export_products, file_sha256
+
+def make_products(folder):
+    '''
+    Writes a lightcurve and an energy spectrum
+    '''
+
+    os.makedirs(folder)
+    lc = folder/'src.lc'
+    lc.write_bytes(b'lightcurve'*1000)
+    pi = folder/'src.pi'
+    pi.write_bytes(b'spectrum'*100)
+    return lc,pi
+
+def test_export_products(tmp_path):
+    lc,pi = make_products(tmp_path/'src')
+    destination = tmp_path/'dst'
+    jobs = [(str(lc),'exp1',True),(str(pi),'exp1',False)]
+
+    manifest = export_products(jobs,str(destination),n_workers=2)
+    out = destination/'exp1'
+    assert sorted(os.listdir(out)) == ['src.lc.gz','src.pi']
+    with gzip.open(out/'src.lc.gz','rb') as infile:
+        assert infile.read() == lc.read_bytes()
+    assert (out/'src.pi').read_bytes() == pi.read_bytes()
+    assert manifest[os.path.join('exp1','src.lc.gz')]['sha256'] == file_sha256(lc)
+    assert sorted(os.listdir(destination)) == ['exp1','export_manifest.json']
+
+    # Second run: skipped through the manifest (an export replaces the
+    # file, so a new inode)
+    inode = os.stat(out/'src.lc.gz').st_ino
+    export_products(jobs,str(destination))
+    assert os.stat(out/'src.lc.gz').st_ino == inode
+
+    # Touched source, same checksum: skipped
+    info = os.stat(lc)
+    os.utime(lc,ns=(info.st_atime_ns,info.st_mtime_ns+10**9))
+    manifest = export_products(jobs,str(destination))
+    assert os.stat(out/'src.lc.gz').st_ino == inode
+    # The manifest keeps the new modification time
+    assert manifest[os.path.join('exp1','src.lc.gz')]['mtime_ns'] == info.st_mtime_ns+10**9
+
+    # Changed checksum: exported again
+    lc.write_bytes(b'new lightcurve'*1000)
+    manifest = export_products(jobs,str(destination))
+    assert os.stat(out/'src.lc.gz').st_ino != inode
+    with gzip.open(out/'src.lc.gz','rb') as infile:
+        assert infile.read() == lc.read_bytes()
+    assert manifest[os.path.join('exp1','src.lc.gz')]['sha256'] == file_sha256(lc)
+    assert sorted(os.listdir(out)) == ['src.lc.gz','src.pi']
@@ -0,0 +1,156 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from functions.native_funcs import INSTRUMENTS, compile_det_ids, \
+    gti_mask, screen_events, sidecar_name, exposure_products, \
+    load_screened_columns, iter_event_windows, cache_events, open_event_cache, \
+    cache_name
+from functions.hxmt_funcs import he_screen
+from conftest import write_events, write_gti, EXP_ID
+
+def make_he_events(folder,n_events=5000):
+    '''
+    Small HE calibrated event file (with all the columns cut by the
+    screening) and GTI file
+    '''
+
+    rng = np.random.default_rng(5)
+    columns = {'TIME':('D',np.sort(rng.uniform(0,100,n_events))),
+        'PI':('J',rng.integers(0,256,n_events)),
+        'DET_ID':('B',rng.integers(0,18,n_events)),
+        'EVENT_TYPE':('B',rng.integers(0,2,n_events)),
+        'ACD':('18B',(rng.uniform(size=(n_events,18)) < 0.01).astype(np.uint8))}
+    evt_file = folder/'{}_HE_evt_cal.fits'.format(EXP_ID)
+    write_events(evt_file,columns)
+    gti_file = folder/'{}_HE_gti.fits'.format(EXP_ID)
+    write_gti(gti_file,[5.,40.],[30.,90.])
+    return evt_file,gti_file,{c:a for c,(_,a) in columns.items()}
+
+def expected_he_rows(data,minpi,maxpi):
+    return (data['PI'] >= minpi) & (data['PI'] <= maxpi) & \
+        (data['EVENT_TYPE'] == 0) & (data['DET_ID'] <= 17) & \
+        (data['ACD'].sum(axis=1) == 0) & \
+        (((data['TIME'] >= 5) & (data['TIME'] < 30)) |
+        ((data['TIME'] >= 40) & (data['TIME'] < 90)))
+
+def test_compile_det_ids():
+    mask,groups = compile_det_ids('0-15, 17')
+    assert list(np.flatnonzero(mask)) == list(range(16))+[17]
+    mask,groups = compile_det_ids('0-7;8-15')
+    assert list(groups[:17]) == [0]*8+[1]*8+[-1]
+    assert compile_det_ids('0-15, 17') is compile_det_ids('0-15, 17')
+    for bad in ['0-3;2-5','5-2','a','300']:
+        with pytest.raises(ValueError):
+            compile_det_ids(bad)
+
+def test_gti_mask():
+    time = np.array([0.,5.,10.,29.9,30.,45.])
+    assert list(gti_mask(time,np.array([5.,40.]),np.array([30.,50.]))) == \
+        [False,True,True,True,False,True]
+
+@pytest.mark.parametrize('chunk_rows',[700,100000])
+def test_screen_events(tmp_path,chunk_rows):
+    evt_file,gti_file,data = make_he_events(tmp_path)
+    he = INSTRUMENTS['HE']
+    outfile = screen_events(evt_file,gti_file,tmp_path/'screen.fits','HE',
+        minpi=20,maxpi=200,det_ids=he['det_ids'],event_type=he['event_type'],
+        anticoincidence=True,chunk_rows=chunk_rows)
+
+    keep = expected_he_rows(data,20,200)
+    with fits.open(outfile) as hdu_list:
+        events = hdu_list[1].data
+        assert hdu_list[1].header['NAXIS2'] == keep.sum()
+        assert np.array_equal(events['TIME'],data['TIME'][keep])
+        assert np.array_equal(events['PI'],data['PI'][keep])
+        assert np.array_equal(hdu_list['GTI'].data['START'],[5.,40.])
+
+    # The row-index sidecar selects the same events
+    index_file = screen_events(evt_file,gti_file,tmp_path/'screen.fits','HE',
+        minpi=20,maxpi=200,det_ids=he['det_ids'],event_type=he['event_type'],
+        anticoincidence=True,sidecar=True,chunk_rows=chunk_rows)
+    assert index_file == sidecar_name(tmp_path/'screen.fits')
+    assert np.array_equal(np.load(index_file),np.flatnonzero(keep))
+    columns = load_screened_columns(index_file,['TIME','PI'])
+    assert np.array_equal(columns['TIME'],data['TIME'][keep])
+    windows = list(iter_event_windows(index_file,['PI'],np.array([0.,50.]),
+        np.array([50.,100.]),chunk_rows=chunk_rows))
+    assert np.array_equal(np.concatenate([w['TIME'] for w in windows]),data['TIME'][keep])
+
+def test_exposure_products_sidecar(tmp_path):
+    evt_file,gti_file,_ = make_he_events(tmp_path)
+    destination = tmp_path/'analysis'/EXP_ID/'HE'
+    os.makedirs(destination)
+    screen_events(evt_file,gti_file,destination/'{}_HE_evt_screen.fits'.format(EXP_ID),
+        'HE',sidecar=True)
+    shutil.copy(gti_file,destination)
+    screen_file,gti = exposure_products(destination.parent,EXP_ID,'HE')
+    assert screen_file.suffix == '.npy' and gti.name == gti_file.name
+
+@pytest.mark.skipif(shutil.which('hescreen') is None,reason='HEASoft not available')
+def test_native_screening_matches_hescreen(tmp_path):
+    full_exp_dir = tmp_path/'raw'/EXP_ID
+    os.makedirs(full_exp_dir)
+    evt_file,gti_file,data = make_he_events(tmp_path)
+
+    screens = {}
+    for native in [False,True]:
+        out_dir = tmp_path/('native' if native else 'hescreen')
+        outfile = he_screen(full_exp_dir,cal_evt_file=evt_file,gti_file=gti_file,
+            out_dir=out_dir,minpi=0,maxpi=255,native=native)
+        screens[native] = fits.getdata(outfile,1)['TIME']
+    assert np.array_equal(screens[True],screens[False])
+    assert np.array_equal(screens[True],data['TIME'][expected_he_rows(data,0,255)])
+
+def touch(file_name):
+    '''
+    Moves the modification time of a file one second forward
+    '''
+
+    info = os.stat(file_name)
+    os.utime(file_name,ns=(info.st_atime_ns,info.st_mtime_ns+10**9))
+
+def test_event_cache(tmp_path):
+    rng = np.random.default_rng(8)
+    time = np.sort(rng.uniform(0,100,3000))
+    pi = rng.integers(0,60000,3000).astype(np.uint16)
+    det_id = rng.integers(0,18,3000).astype(np.uint8)
+    # Big-endian table, PI stored as signed with TZERO
+    hdu = fits.BinTableHDU.from_columns([fits.Column(name='TIME',format='D',array=time),
+        fits.Column(name='PI',format='I',bzero=32768,array=pi),
+        fits.Column(name='DET_ID',format='B',array=det_id)],name='EVENTS')
+    evt_file = tmp_path/'screen.fits'
+    fits.HDUList([fits.PrimaryHDU(),hdu]).writeto(evt_file)
+
+    rows = np.flatnonzero(det_id < 9).astype(np.uint32)
+    index_file = sidecar_name(evt_file)
+    np.save(index_file,rows)
+    index_file.with_suffix('.txt').write_text(str(evt_file)+'\n')
+
+    for screen_file,selection in [(evt_file,slice(None)),(index_file,rows)]:
+        assert open_event_cache(screen_file) is None
+        folder = cache_events(screen_file,chunk_rows=700)
+        assert folder == cache_name(screen_file)
+        data = open_event_cache(screen_file)
+        assert sorted(data) == ['DET_ID','PI','TIME']
+        assert data['PI'].dtype == np.uint16 and data['TIME'].dtype == np.float64
+        assert all(data[col].dtype.isnative for col in data)
+        assert np.array_equal(data['TIME'],time[selection])
+        assert np.array_equal(data['PI'],pi[selection])
+        assert np.array_equal(data['DET_ID'],det_id[selection])
+        assert open_event_cache(screen_file,['TIME','ACD']) is None
+        assert list(open_event_cache(screen_file,['PI'])) == ['PI']
+
+    # A stale cache is never read: screened file, sidecar, or the event
+    # file the sidecar refers to changed
+    touch(index_file)
+    assert open_event_cache(index_file) is None
+    cache_events(index_file)
+    touch(evt_file)
+    assert open_event_cache(evt_file) is None
+    assert open_event_cache(index_file) is None
+    cache_events(evt_file)
+    assert not open_event_cache(evt_file) is None
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from functions.product_funcs import write_lightcurve, net_lightcurve, \
+    colour_stage, longterm_stage, read_longterm
+
+EXP_IDS = ['P010131500101-20171031-01-01','P010131500102-20171101-01-01']
+HE_BAND,ME_BAND = 'ch8-162','ch119-546'
+
+def make_lightcurve(out_dir,exp_ID,inst,band,rate,suffix='',t0=0.,n=10):
+    destination = out_dir/'analysis'/exp_ID/inst
+    os.makedirs(destination,exist_ok=True)
+    lc_file = destination/'{}_{}_lc_{}_1s{}.lc'.format(exp_ID,inst,band,suffix)
+    header = fits.Header()
+    header['TIMEDEL'] = 1.
+    write_lightcurve(lc_file,t0+np.arange(n)+0.5,np.full(n,float(rate)),
+        np.full(n,0.1),header=header)
+    return lc_file
+
+def test_net_lightcurve(tmp_path):
+    lc_file = make_lightcurve(tmp_path,EXP_IDS[0],'HE',HE_BAND,10.)
+    # Background covering only the last 6 bins
+    make_lightcurve(tmp_path,EXP_IDS[0],'HE',HE_BAND,3.,suffix='_bkg',t0=4.,n=6)
+    with fits.open(net_lightcurve(lc_file)) as hdu_list:
+        rate = hdu_list['RATE'].data
+        assert np.allclose(rate['TIME'],np.arange(4,10)+0.5)
+        assert np.allclose(rate['RATE'],7.)
+        assert np.allclose(rate['ERROR'],np.hypot(0.1,0.1))
+        assert hdu_list['RATE'].header['BACKFILE'].endswith('_bkg.lc')
+
+def test_colour_stage_kind_and_update(tmp_path):
+    out_dir = tmp_path/'Crab'
+    make_lightcurve(out_dir,EXP_IDS[0],'HE',HE_BAND,30.)
+    make_lightcurve(out_dir,EXP_IDS[0],'ME',ME_BAND,10.)
+    make_lightcurve(out_dir,EXP_IDS[1],'HE',HE_BAND,40.)
+    me_file = make_lightcurve(out_dir,EXP_IDS[1],'ME',ME_BAND,20.)
+    # Net lightcurves are preferred
+    make_lightcurve(out_dir,EXP_IDS[1],'ME',ME_BAND,8.,suffix='_net')
+
+    outfile = colour_stage(out_dir,instruments=['HE','ME'],n_workers=1)
+    rates = fits.getdata(outfile,'RATES')
+    assert list(rates['EXP_ID']) == EXP_IDS
+    assert list(rates['KIND_ME_119_546']) == ['src','net']
+    assert list(rates['KIND_HE_8_162']) == ['src','src']
+    assert np.allclose(rates['COLOUR1'],[3.,5.])
+    assert len(fits.getdata(outfile,'LIGHTCURVES')) == 4
+
+    # Up to date: the table is not written again
+    mtime = os.path.getmtime(outfile)
+    assert colour_stage(out_dir,instruments=['HE','ME'],n_workers=1) == outfile
+    assert os.path.getmtime(outfile) == mtime
+
+    # A modified lightcurve triggers a rebuild
+    make_lightcurve(out_dir,EXP_IDS[0],'HE',HE_BAND,60.)
+    os.utime(out_dir/'analysis'/EXP_IDS[0]/'HE'/'{}_HE_lc_{}_1s.lc'.format(
+        EXP_IDS[0],HE_BAND),(mtime+10,mtime+10))
+    colour_stage(out_dir,instruments=['HE','ME'],n_workers=1)
+    assert np.allclose(fits.getdata(outfile,'RATES')['COLOUR1'],[6.,5.])
+
+    # So does a removed one
+    os.remove(me_file.with_name(me_file.stem+'_net.lc'))
+    colour_stage(out_dir,instruments=['HE','ME'],n_workers=1)
+    rates = fits.getdata(outfile,'RATES')
+    assert list(rates['KIND_ME_119_546']) == ['src','src']
+    assert np.allclose(rates['COLOUR1'],[6.,2.])
+
+def test_longterm_incremental_update(tmp_path):
+    out_dir = tmp_path/'Crab'
+    make_lightcurve(out_dir,EXP_IDS[1],'HE',HE_BAND,2.,t0=100.)
+    lt_file, = longterm_stage(out_dir,instruments=['HE'],n_workers=1)
+    make_lightcurve(out_dir,EXP_IDS[0],'HE',HE_BAND,1.)
+    assert longterm_stage(out_dir,instruments=['HE'],n_workers=1) == [lt_file]
+
+    rows,exposures = read_longterm(lt_file)
+    assert list(exposures['EXP_ID']) == EXP_IDS
+    assert np.all(np.diff(rows['TIME']) > 0)
+    assert np.allclose(rows['RATE'],[1.]*10+[2.]*10)
+    assert list(rows['EXP_INDEX']) == [0]*10+[1]*10
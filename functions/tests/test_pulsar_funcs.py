@@ -0,0 +1,86 @@
+import numpy as np
+from astropy.io import fits
+
+from functions.pulsar_funcs import fold_phases, trial_grid, fold_accumulate, \
+    z2_statistics, fold_stage
+
+def pulsed_events(rng,freq,n_events,tspan,pulsed_fraction=0.3):
+    '''
+    Uniform events plus a fraction of events concentrated around phase
+    0.25 of a pulsar of frequency freq
+    '''
+
+    n_pulsed = int(n_events*pulsed_fraction)
+    time = rng.uniform(0,tspan,n_events-n_pulsed)
+    cycles = rng.integers(0,int(tspan*freq),n_pulsed)
+    phase = (0.25+0.03*rng.standard_normal(n_pulsed))%1.
+    return np.sort(np.concatenate([time,(cycles+phase)/freq]))
+
+def test_fold_phases():
+    time = np.array([0.,0.25,1.5,10.])
+    phase = fold_phases(time,np.array([1.,2.]),epoch=0.)
+    assert phase.shape == (2,4)
+    assert np.allclose(phase[0],[0.,0.25,0.5,0.])
+    assert np.allclose(phase[1],[0.,0.5,0.,0.])
+    # Spin-down: phase = f dt + fdot dt^2/2
+    assert np.allclose(fold_phases(np.array([2.]),1.,fdot=0.1),0.2)
+
+def test_trial_grid():
+    freq,fdot,fddot = trial_grid(1.,100.,n_freq=3,oversample=2,n_fdot=2,
+        fdot_step=1e-6)
+    assert len(freq) == len(fdot) == len(fddot) == 6
+    assert np.allclose(np.unique(freq),[0.995,1.,1.005])
+    assert np.allclose(np.unique(fdot),[-5e-7,5e-7])
+
+def test_z2_matches_direct_sum():
+    rng = np.random.default_rng(3)
+    time = pulsed_events(rng,2.,5000,500.)
+    freq,fdot,fddot = trial_grid(2.,500.,n_freq=5)
+    profiles = np.zeros((5,16),dtype=np.int64)
+    harmonics = np.zeros((5,4),dtype=np.complex128)
+    # Small chunks, the sums do not depend on the chunking
+    fold_accumulate(time,freq,fdot,fddot,0.,16,4,profiles,harmonics,
+        chunk_cells=1000)
+    z2,h,h_harm = z2_statistics(harmonics,len(time))
+
+    phase = fold_phases(time,freq,fdot,fddot)
+    assert np.array_equal(profiles.sum(axis=1),np.full(5,len(time)))
+    assert np.array_equal(profiles[2],np.histogram(phase[2],16,(0,1))[0])
+    k = np.arange(1,5)[:,None,None]
+    direct = np.abs(np.exp(2j*np.pi*k*phase[None]).sum(axis=-1))**2
+    expected = 2./len(time)*np.cumsum(direct,axis=0).T
+    assert np.allclose(z2,expected,rtol=1e-4)
+
+    # The central trial is the true frequency
+    assert np.argmax(z2[:,-1]) == 2
+    assert np.allclose(h,np.max(z2-4*np.arange(1,5)+4,axis=1))
+    # A narrow pulse needs more than one harmonic
+    assert h_harm[2] > 1
+
+def test_z2_of_uniform_events():
+    rng = np.random.default_rng(5)
+    time = np.sort(rng.uniform(0,1000,20000))
+    # Independent Fourier frequencies
+    freq,fdot,fddot = trial_grid(1.3,1000.,n_freq=200,oversample=1)
+    profiles = np.zeros((200,8),dtype=np.int64)
+    harmonics = np.zeros((200,2),dtype=np.complex128)
+    fold_accumulate(time,freq,fdot,fddot,0.,8,2,profiles,harmonics)
+    z2,_,_ = z2_statistics(harmonics,len(time))
+    # Z^2_2 is distributed as chi^2 with 4 degrees of freedom
+    assert abs(z2[:,1].mean()-4.) < 0.6
+
+def test_fold_stage(screened_exposure):
+    rng = np.random.default_rng(7)
+    time = 1000.+pulsed_events(rng,1.7,4000,400.)
+    full_exp_dir,out_dir,_ = screened_exposure('HE',time,np.full(len(time),50),
+        np.zeros(len(time),dtype=int),([1000.],[1400.]))
+
+    outfile = fold_stage(full_exp_dir,'HE',1.7,n_freq=7,n_bins=20,out_dir=out_dir)
+    search = fits.getdata(outfile,'SEARCH')
+    assert len(search) == 7
+    assert np.argmax(search['Z2']) == 3
+    assert np.array_equal(search['PROFILE'].sum(axis=1),np.full(7,len(time)))
+    profile = fits.getdata(outfile,'PROFILE')
+    assert np.array_equal(profile['COUNTS'],search['PROFILE'][3])
+    # Pulse peak at phase 0.25 from the start of the GTI
+    assert np.argmax(profile['COUNTS']) in [4,5]
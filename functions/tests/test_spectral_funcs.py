@@ -0,0 +1,260 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from functions.spectral_funcs import write_pha, read_pha, read_response, \
+    write_response, coadd_stage, coadded_files, group_min_counts, group_stage, \
+    group_min_snr, group_optimal, \
+    slice_intervals, time_resolved_spectra, time_resolved_stage, BKG_FUNCS, \
+    RSP_FUNCS
+from functions.deadtime_funcs import find_dead_time_file
+from functions.native_funcs import read_gti
+from conftest import write_he_dtime
+
+EXP_IDS = ['P010131500101-20171031-01-01','P010131500102-20171101-01-01']
+N_CHAN = 8
+
+def make_response(rsp_file,matrix):
+    ebounds = fits.BinTableHDU.from_columns([
+        fits.Column(name='CHANNEL',format='J',array=np.arange(N_CHAN)),
+        fits.Column(name='E_MIN',format='E',array=np.arange(N_CHAN)*10.),
+        fits.Column(name='E_MAX',format='E',array=np.arange(1,N_CHAN+1)*10.)],
+        name='EBOUNDS')
+    n_energies = matrix.shape[0]
+    rsp = {'energ_lo':np.arange(n_energies)*10.,'energ_hi':np.arange(1,n_energies+1)*10.,
+        'first_chan':0,'ebounds':ebounds,'header':fits.Header()}
+    write_response(rsp_file,rsp,matrix)
+
+def make_spectrum(out_dir,exp_ID,counts,exposure,matrix,minpi=None,maxpi=None):
+    destination = out_dir/'analysis'/exp_ID/'HE'
+    os.makedirs(destination,exist_ok=True)
+    stem = '{}_HE_spec_ch0-{}'.format(exp_ID,N_CHAN-1)
+    make_response(destination/(stem+'.rsp'),matrix)
+    write_pha(destination/(stem+'_bkg.pha'),np.full(N_CHAN,2.),exposure,'HE',
+        error=np.full(N_CHAN,1.),background=True)
+    pha_file = destination/(stem+'.pha')
+    write_pha(pha_file,np.asarray(counts),exposure,'HE',minpi=minpi,maxpi=maxpi,
+        backfile=stem+'_bkg.pha',respfile=stem+'.rsp')
+    return pha_file
+
+def test_response_round_trip(tmp_path):
+    matrix = np.zeros((5,N_CHAN))
+    matrix[1,2:5] = [0.1,0.5,0.2]
+    matrix[3,6] = 1.
+    make_response(tmp_path/'test.rsp',matrix)
+    assert np.allclose(read_response(tmp_path/'test.rsp')['matrix'],matrix)
+
+def test_coadd_spectra(tmp_path):
+    out_dir = tmp_path/'Crab'
+    m1,m2 = np.eye(N_CHAN),np.roll(np.eye(N_CHAN),1,axis=1)
+    make_spectrum(out_dir,EXP_IDS[0],np.arange(N_CHAN),100.,m1)
+    make_spectrum(out_dir,EXP_IDS[1],np.full(N_CHAN,5),300.,m2)
+
+    outfile, = coadd_stage(out_dir,instruments=['HE'])
+    pha = read_pha(outfile)
+    assert pha['exposure'] == 400.
+    assert np.allclose(pha['counts'],np.arange(N_CHAN)+5)
+    assert coadded_files(outfile) == ['{}_HE_spec_ch0-7.pha'.format(e) for e in EXP_IDS]
+
+    bkg = read_pha(outfile.with_name(pha['backfile']))
+    assert np.allclose(bkg['counts'],4.)
+    assert np.allclose(bkg['error'],np.sqrt(2.))
+    # Exposure weighted response
+    rsp = read_response(outfile.with_name(pha['respfile']))
+    assert np.allclose(rsp['matrix'],0.25*m1+0.75*m2)
+
+def test_coadd_rebuilt_when_inputs_change(tmp_path):
+    out_dir = tmp_path/'Crab'
+    make_spectrum(out_dir,EXP_IDS[0],np.full(N_CHAN,1),100.,np.eye(N_CHAN))
+    outfile, = coadd_stage(out_dir,instruments=['HE'])
+    assert np.allclose(read_pha(outfile)['counts'],1.)
+
+    # Up to date
+    mtime = os.path.getmtime(outfile)
+    coadd_stage(out_dir,instruments=['HE'])
+    assert os.path.getmtime(outfile) == mtime
+
+    # New exposure
+    make_spectrum(out_dir,EXP_IDS[1],np.full(N_CHAN,2),100.,np.eye(N_CHAN))
+    os.utime(outfile,(mtime+10,mtime+10))
+    coadd_stage(out_dir,instruments=['HE'])
+    assert np.allclose(read_pha(outfile)['counts'],3.)
+    assert len(coadded_files(outfile)) == 2
+
+    # Modified spectrum
+    mtime = os.path.getmtime(outfile)
+    pha_file = make_spectrum(out_dir,EXP_IDS[1],np.full(N_CHAN,4),100.,np.eye(N_CHAN))
+    os.utime(pha_file,(mtime+10,mtime+10))
+    coadd_stage(out_dir,instruments=['HE'])
+    assert np.allclose(read_pha(outfile)['counts'],5.)
+
+def test_coadd_keeps_grouped_channel_range(tmp_path):
+    out_dir = tmp_path/'Crab'
+    pha_file = make_spectrum(out_dir,EXP_IDS[0],np.full(N_CHAN,1),100.,np.eye(N_CHAN),
+        minpi=1,maxpi=6)
+    # Channels flagged by a previous grouping (QUALITY=2) are in range
+    with fits.open(pha_file,mode='update') as hdu_list:
+        hdu_list['SPECTRUM'].data['QUALITY'][[1,6]] = 2
+    outfile, = coadd_stage(out_dir,instruments=['HE'])
+    quality = fits.getdata(outfile,'SPECTRUM')['QUALITY']
+    assert list(quality) == [5,0,0,0,0,0,0,5]
+
+def test_group_min_counts():
+    counts = np.array([[0,5,30,10,10,10,1,2],[3,3,3,3,3,3,3,3]])
+    grouping,quality = group_min_counts(counts,np.array([1,0]),np.array([7,7]),
+        min_counts=20)
+    assert list(grouping[0]) == [1,1,-1,1,-1,1,-1,-1]
+    assert list(quality[0]) == [5,0,0,0,0,2,2,2]
+    assert list(grouping[1]) == [1,-1,-1,-1,-1,-1,-1,1]
+    assert list(quality[1]) == [0,0,0,0,0,0,0,2]
+
+def group_bounds(grouping,quality,lo,hi):
+    '''
+    First and last channel and quality of the groups of a spectrum
+    '''
+
+    starts = [c for c in range(lo,hi+1) if grouping[c] == 1]
+    stops = starts[1:]+[hi+1]
+    return [(a,b-1,quality[a]) for a,b in zip(starts,stops)]
+
+def test_group_min_snr():
+    rng = np.random.default_rng(9)
+    counts = rng.poisson(np.linspace(40,2,300),(3,300)).astype(float)
+    bkg_counts = rng.poisson(20.,(3,300)).astype(float)
+    bkg_scale = np.array([0.,0.5,0.2])
+    lo,hi = np.array([0,10,50]),np.array([299,280,299])
+
+    for bkg in [None,bkg_counts]:
+        scale = None if bkg is None else bkg_scale
+        grouping,quality = group_min_snr(counts,lo,hi,min_snr=8.,
+            bkg_counts=bkg,bkg_scale=scale)
+        if bkg is None: bkg,scale = np.zeros_like(counts),np.zeros(3)
+        for k in range(3):
+            assert np.all(quality[k,:lo[k]] == 5) and np.all(quality[k,hi[k]+1:] == 5)
+            groups = group_bounds(grouping[k],quality[k],lo[k],hi[k])
+            def snr(a,b):
+                signal = counts[k,a:b+1].sum()-scale[k]*bkg[k,a:b+1].sum()
+                return signal/np.sqrt(counts[k,a:b+1].sum()+scale[k]**2*bkg[k,a:b+1].sum())
+            complete = [g for g in groups if g[2] == 0]
+            assert len(complete) > 5
+            for a,b,_ in complete:
+                # Shortest group reaching min_snr
+                assert snr(a,b) >= 8. and (a == b or snr(a,b-1) < 8.)
+            # Tail group below min_snr, flagged QUALITY=2
+            a,b,q = groups[-1]
+            assert q == 2 and snr(a,b) < 8.
+            assert np.all(quality[k,a:b+1] == 2)
+
+def test_group_optimal():
+    # Flat spectrum, constant resolution
+    n_chan,fwhm = 400,20.
+    counts = np.full((1,n_chan),1e5)
+    grouping,quality = group_optimal(counts,np.array([0]),np.array([n_chan-1]),
+        np.full((1,n_chan),fwhm))
+    assert np.all(quality == 0)
+
+    # Kaastra & Bleeker (2016): counts per resolution element (21
+    # channels centered on each channel) and number of elements
+    x = np.log(21*1e5*(1.+0.2*n_chan/fwhm))
+    ratio = (0.08+7./x+1.8/x**2)/(1.+5.9/x)
+    groups = group_bounds(grouping[0],quality[0],0,n_chan-1)
+    widths = np.array([b-a+1 for a,b,_ in groups if a > 20 and b < n_chan-20])
+    assert np.all(np.abs(widths-ratio*fwhm) < 1.)
+    assert np.isclose(widths.mean(),ratio*fwhm,rtol=0.05)
+
+    # Few counts: one group per FWHM
+    grouping,_ = group_optimal(np.full((1,n_chan),0.001),np.array([0]),
+        np.array([n_chan-1]),np.full((1,n_chan),fwhm))
+    assert np.sum(grouping[0] == 1) == n_chan/fwhm
+
+def test_group_stage_keeps_grouped_spectra(tmp_path):
+    out_dir = tmp_path/'Crab'
+    destination = out_dir/'analysis'/EXP_IDS[0]/'HE'
+    os.makedirs(destination)
+    pha_file = destination/'{}_HE_spec_ch0-255.pha'.format(EXP_IDS[0])
+    write_pha(pha_file,np.full(256,10),100.,'HE',minpi=8,maxpi=162)
+
+    assert group_stage(out_dir,value=20,instruments=['HE']) == [pha_file]
+    grouping = fits.getdata(pha_file,'SPECTRUM')['GROUPING']
+    # 77 pairs and an incomplete group inside 8-162
+    assert np.sum(grouping == 1) == 8+78+93
+
+    # Already grouped spectra are kept unless override
+    assert group_stage(out_dir,value=50,instruments=['HE']) == []
+    assert group_stage(out_dir,value=50,instruments=['HE'],override=True) == [pha_file]
+    spectrum = fits.getdata(pha_file,'SPECTRUM')
+    assert np.sum(spectrum['GROUPING'][8:163] == 1) == 31
+    assert spectrum['QUALITY'][0] == 5 and spectrum['QUALITY'][8] == 0
+
+def test_slice_intervals(tmp_path):
+    gti = (np.array([0.,60.]),np.array([40.,100.]))
+    starts,stops = slice_intervals(gti,'gti')
+    assert list(starts) == [0.,60.] and list(stops) == [40.,100.]
+
+    # Fixed length, the last slice of each GTI is shorter
+    starts,stops = slice_intervals(gti,15.)
+    assert list(starts) == [0.,15.,30.,60.,75.,90.]
+    assert list(stops) == [15.,30.,40.,75.,90.,100.]
+
+    # User slices, the ones without good time are removed
+    user = [(-10.,-5.),(30.,70.),(45.,55.),(200.,300.)]
+    starts,stops = slice_intervals(gti,user)
+    assert list(starts) == [30.] and list(stops) == [70.]
+    np.savetxt(tmp_path/'slices.txt',user)
+    starts,stops = slice_intervals(gti,tmp_path/'slices.txt')
+    assert list(starts) == [30.] and list(stops) == [70.]
+    np.savetxt(tmp_path/'slice.txt',[(10.,20.)])
+    starts,stops = slice_intervals(gti,str(tmp_path/'slice.txt'))
+    assert list(starts) == [10.] and list(stops) == [20.]
+
+def test_time_resolved_spectra_exposure(screened_exposure):
+    time = np.sort(np.random.default_rng(3).uniform(0,100,1000))
+    full_exp_dir,out_dir,destination = screened_exposure('HE',time,
+        np.full(1000,20),np.zeros(1000,dtype=int),([0.,60.],[40.,100.]))
+    os.makedirs(full_exp_dir/'HE')
+    write_he_dtime(full_exp_dir/'HE'/'HXMT_P0101315001_HE-DTime_FFFFFF_V1_L1P.FITS',
+        np.arange(-10.,111.),np.full(18,0.2))
+    assert find_dead_time_file(full_exp_dir,destination.parent,'HE').name.\
+        startswith('HXMT_P0101315001_HE-DTime')
+
+    slices = time_resolved_spectra(full_exp_dir,'HE',intervals=[(0.,50.),(50.,100.)],
+        out_dir=out_dir)
+    exposures = [read_pha(s[0])['exposure'] for s in slices]
+    assert np.allclose(exposures,[40*0.8,40*0.8])
+    assert read_pha(slices[0][0])['counts'].sum() == np.sum(time < 40)
+
+def test_time_resolved_stage_slice_gti(screened_exposure,monkeypatch):
+    time = np.sort(np.random.default_rng(4).uniform(0,100,500))
+    full_exp_dir,out_dir,destination = screened_exposure('HE',time,
+        np.full(500,20),np.zeros(500,dtype=int),([0.,60.],[40.,100.]))
+
+    # Background and response tools (HEASoft) replaced by functions
+    # recording their calls
+    calls = {'bkg':[],'rsp':[]}
+    def fake_bkg(full_exp_dir,spec_file,gti_file=None,out_dir=None,override=False):
+        calls['bkg'] += [(spec_file,gti_file)]
+        bkg_file = spec_file.with_name(spec_file.stem+'_bkg.pha')
+        bkg_file.write_bytes(b'')
+        return bkg_file
+    def fake_rsp(full_exp_dir,spec_file,out_dir=None,override=False):
+        calls['rsp'] += [spec_file]
+        rsp_file = spec_file.with_suffix('.rsp')
+        rsp_file.write_bytes(b'')
+        return rsp_file
+    monkeypatch.setitem(BKG_FUNCS,'HE',fake_bkg)
+    monkeypatch.setitem(RSP_FUNCS,'HE',fake_rsp)
+
+    spec_files = time_resolved_stage(full_exp_dir,'HE',intervals=30.,out_dir=out_dir)
+    assert len(spec_files) == 4
+    assert [c[0] for c in calls['bkg']] == spec_files
+    # Each background uses the GTI of its slice
+    slice_gtis = [read_gti(c[1]) for c in calls['bkg']]
+    assert [(list(g[0]),list(g[1])) for g in slice_gtis] == \
+        [([0.],[30.]),([30.],[40.]),([60.],[90.]),([90.],[100.])]
+    # A single response shared by all the slices
+    assert calls['rsp'] == spec_files[:1]
+    for spec_file in spec_files:
+        pha = read_pha(spec_file)
+        assert pha['backfile'] == spec_file.stem+'_bkg.pha'
+        assert pha['respfile'] == spec_files[0].with_suffix('.rsp').name
@@ -0,0 +1,113 @@
+import os
+import time
+
+from functions.staging_funcs import stage_exposure, publish_exposure, \
+    make_prefetcher, schedule_exposures, fetch_exposure, close_prefetcher, \
+    working_folders, list_exposures, discard_exposure
+
+EXP_ID = 'P010131500101-20171031-01-01'
+
+def make_target(root,n_exp=1,size=100):
+    '''
+    Creates proposal/observation/exposure folders with a fake raw file
+    and a previously computed product
+    '''
+
+    obs = root/'P0101315'/'P0101315001'
+    for folder in ['ACS','AUX']: os.makedirs(obs/folder)
+    (obs/'ACS'/'HXMT_Att.FITS').write_bytes(b'a')
+    exposures = []
+    for i in range(n_exp):
+        exp = obs/'P01013150010{}-20171031-01-01'.format(i+1)
+        os.makedirs(exp/'HE')
+        (exp/'HE'/'HXMT_HE-Evt.FITS').write_bytes(b'e'*size)
+        exposures += [exp]
+    return exposures
+
+def test_stage_and_publish(tmp_path):
+    out_dir = tmp_path/'dst'
+    exp, = make_target(out_dir)
+    products = out_dir/'analysis'/EXP_ID/'HE'
+    os.makedirs(products)
+    (products/'old.lc').write_bytes(b'old')
+    (products/'list.txt').write_text(str(products/'old.lc')+'\n')
+
+    staged = stage_exposure(exp,out_dir,tmp_path/'scratch')
+    scratch_products = staged['out_dir']/'analysis'/EXP_ID/'HE'
+    assert (staged['full_exp_dir']/'HE'/'HXMT_HE-Evt.FITS').is_file()
+    assert (staged['full_exp_dir'].parent/'ACS'/'HXMT_Att.FITS').is_file()
+    assert (scratch_products/'list.txt').read_text().startswith(str(staged['out_dir']))
+
+    (scratch_products/'new.lc').write_bytes(b'new')
+    os.makedirs(scratch_products/'new_cols')
+    (scratch_products/'new_cols'/'TIME.npy').write_bytes(b't')
+    publish_exposure(staged)
+
+    assert (products/'new.lc').read_bytes() == b'new'
+    assert (products/'new_cols'/'TIME.npy').read_bytes() == b't'
+    assert (products/'list.txt').read_text() == str(products/'old.lc')+'\n'
+    assert not staged['out_dir'].exists()
+    assert not any('.tmp' in f.name for f in products.iterdir())
+
+def test_discard_failed_exposure(tmp_path):
+    out_dir = tmp_path/'dst'
+    exp, = make_target(out_dir)
+    products = out_dir/'analysis'/EXP_ID/'HE'
+    os.makedirs(products)
+    (products/'old.lc').write_bytes(b'old')
+
+    staged = stage_exposure(exp,out_dir,tmp_path/'scratch')
+    scratch_products = staged['out_dir']/'analysis'/EXP_ID/'HE'
+    # Half-written product of a failed stage
+    (scratch_products/'old.lc').write_bytes(b'partial')
+    (scratch_products/'new.lc').write_bytes(b'partial')
+    discard_exposure(staged)
+
+    assert not staged['out_dir'].exists()
+    assert (products/'old.lc').read_bytes() == b'old'
+    assert not (products/'new.lc').exists()
+
+def test_prefetch_publishes_new_products(tmp_path):
+    # Regression: with prefetch, stages must run on the scratch copy,
+    # otherwise the stale scratch products overwrite the new ones
+    out_dir = tmp_path/'dst'
+    exposures = make_target(out_dir,n_exp=2)
+    products = out_dir/'analysis'/exposures[0].name/'HE'
+    os.makedirs(products)
+    (products/'src.lc').write_bytes(b'stale')
+
+    prefetcher = make_prefetcher(out_dir,tmp_path/'scratch',lookahead=1)
+    schedule_exposures(prefetcher,list_exposures([exposures[0].parent]))
+    staged,wf,exp_out = working_folders(exposures[0],out_dir,prefetcher=prefetcher)
+    assert wf == staged['full_exp_dir'] and exp_out == staged['out_dir']
+    assert str(exp_out).startswith(str((tmp_path/'scratch').resolve()))
+
+    # Stage writing a product
+    time.sleep(0.01)
+    (exp_out/'analysis'/wf.name/'HE'/'src.lc').write_bytes(b'fresh')
+    publish_exposure(staged)
+    close_prefetcher(prefetcher)
+
+    assert (products/'src.lc').read_bytes() == b'fresh'
+    assert os.listdir(tmp_path/'scratch') == []
+
+def test_working_folders_without_staging(tmp_path):
+    out_dir = tmp_path/'dst'
+    exp, = make_target(out_dir)
+    staged,wf,exp_out = working_folders(exp,out_dir)
+    assert staged is None and wf == exp and exp_out == out_dir
+
+def test_prefetch_disk_cap(tmp_path):
+    out_dir = tmp_path/'dst'
+    exposures = make_target(out_dir,n_exp=3,size=1000)
+
+    prefetcher = make_prefetcher(out_dir,tmp_path/'scratch',lookahead=2,
+        max_bytes=2500)
+    schedule_exposures(prefetcher,exposures)
+    staged = fetch_exposure(prefetcher,exposures[0])
+    for future in prefetcher['futures'].values(): future.result()
+    # The current exposure and only one prefetched exposure fit
+    assert len(prefetcher['futures']) == 1
+    publish_exposure(staged)
+    close_prefetcher(prefetcher)
+    assert os.listdir(tmp_path/'scratch') == []
@@ -0,0 +1,183 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from functions.timing_funcs import segment_indices, log_bin_edges, log_rebin, \
+    average_pds, lightcurve_pds, read_pds, gti_segments, segment_counts, \
+    cross_spectra, spectrogram_stage
+from functions.product_funcs import write_lightcurve
+from conftest import EXP_ID
+
+def sine_counts(n_seg,n_bins,timedel,rate,amplitude,freq):
+    '''
+    Noiseless counts of a sinusoid with fractional amplitude amplitude
+    '''
+
+    time = np.arange(n_bins)*timedel
+    counts = rate*timedel*(1.+amplitude*np.sin(2*np.pi*freq*time))
+    return np.tile(counts,(n_seg,1))
+
+def test_segment_indices():
+    time = np.concatenate([np.arange(0,10),np.arange(20,27)])+0.5
+    index = segment_indices(time,1.,(np.array([0.,20.]),np.array([10.,30.])),4.)
+    # Two segments in the first run, one in the second
+    assert index.shape == (3,4)
+    assert list(index[:,0]) == [0,4,10]
+    # A bad bin splits the run
+    good = np.ones(len(time),dtype=bool)
+    good[2] = False
+    assert list(segment_indices(time,1.,None,4.,good=good,starts_only=True)) == [3,10]
+
+def test_leahy_poisson_level():
+    counts = np.random.default_rng(1).poisson(10.,(400,256)).astype(float)
+    pds = average_pds(counts,0.01)
+    assert pds['n_seg'] == 400
+    assert np.isclose(pds['mean_rate'],1000.,rtol=0.01)
+    assert abs(pds['power'].mean()-2.) < 0.02
+    assert np.allclose(pds['error'],pds['power']/20.)
+
+def test_rms_normalization():
+    timedel,tseg = 1/256.,16.
+    n_bins = int(tseg/timedel)
+    counts = sine_counts(4,n_bins,timedel,1000.,0.2,4.)
+    pds = average_pds(counts,timedel,norm='rms')
+    df = pds['freq'][1]-pds['freq'][0]
+    # Fractional rms squared of a sinusoid: amplitude^2/2
+    assert np.isclose(pds['power'].sum()*df,0.02)
+    assert pds['freq'][np.argmax(pds['power'])] == 4.
+
+    # Half of the rate is background
+    bkg = average_pds(counts,timedel,norm='rms',bkg_rate=500.)
+    assert np.allclose(bkg['power'],4*pds['power'])
+
+    counts = np.random.default_rng(2).poisson(5.,(400,n_bins)).astype(float)
+    pds = average_pds(counts,timedel,norm='rms')
+    assert np.isclose(pds['power'].mean(),2./pds['mean_rate'],rtol=0.01)
+
+    with pytest.raises(ValueError):
+        average_pds(counts,timedel,norm='abs')
+
+def test_log_rebin():
+    freq = np.arange(1,1001)*0.1
+    edges = log_bin_edges(freq,0.05)
+    assert np.all(np.diff(np.diff(edges)[:-1]) >= 0)
+    assert edges[0] <= freq[0] and edges[-1] >= freq[-1]
+
+    power = np.full(len(freq),2.)
+    error = np.full(len(freq),0.5)
+    new_freq,new_power,new_error,freq_error,n_avg = log_rebin(freq,power,error,0.05)
+    assert n_avg.sum() == len(freq)
+    assert np.allclose(new_power,2.)
+    assert np.allclose(new_error,0.5/np.sqrt(n_avg))
+
+def test_lightcurve_pds(tmp_path):
+    timedel = 1/64.
+    time = np.concatenate([np.arange(0,4096),np.arange(5000,5640)])*timedel+timedel/2
+    rate = np.random.default_rng(3).poisson(2.,len(time))/timedel
+    lc_file = tmp_path/'src.lc'
+    write_lightcurve(lc_file,time,rate,np.sqrt(rate/timedel),
+        header=fits.Header({'TIMEDEL':timedel}),gti=(np.array([0.,5000*timedel]),
+        np.array([4096*timedel,5640*timedel])))
+
+    outfile = lightcurve_pds(lc_file,8.)
+    pds = read_pds(outfile)
+    # 8 segments in the first GTI, one in the second
+    assert pds['n_seg'] == 9
+    assert len(pds['freq']) == 256
+    assert abs(pds['power'].mean()-2.) < 0.1
+    assert lightcurve_pds(lc_file,100.) is None
+
+def test_gti_segments_and_counts():
+    seg_starts = gti_segments((np.array([0.,100.]),np.array([25.,110.])),10.)
+    assert list(seg_starts) == [0.,10.,100.]
+    time = np.array([0.5,9.99,10.,24.,100.2,109.9,115.])
+    counts = segment_counts(time,seg_starts,10.,1.)
+    assert counts.shape == (3,10)
+    assert list(counts.sum(axis=1)) == [2,1,2]
+    assert counts[0,9] == 1 and counts[2,9] == 1
+
+def test_cross_spectra_lag():
+    timedel,n_bins = 1/128.,1024
+    counts = np.stack([sine_counts(8,n_bins,timedel,1000.,0.3,2.),
+        sine_counts(8,n_bins,timedel,1000.,0.3,2.)])
+    # Band 2 lags band 1 by 8 bins
+    counts[1] = np.roll(counts[1],8,axis=-1)
+    cross = cross_spectra(counts,timedel)
+    assert list(cross['pairs'][0]) == [0,1]
+    peak = np.argmax(cross['power'][0])
+    assert cross['freq'][peak] == 2.
+    assert np.isclose(cross['lag'][0,peak],8*timedel)
+    assert np.isclose(cross['coherence'][0,peak],1.)
+    assert np.isclose(cross['lag_error'][0,peak],0.,atol=1e-9)
+
+def test_cross_spectra_errors():
+    # Poisson noise on a common white signal: intrinsic coherence
+    # (var/(var+mean))^2 at all the frequencies, so the scatter over
+    # frequencies checks the errors
+    rng = np.random.default_rng(4)
+    n_seg,n_bins = 64,1024
+    signal = 20.+3.*rng.standard_normal((n_seg,n_bins))
+    counts = rng.poisson(np.stack([signal,signal])).astype(float)
+    cross = cross_spectra(counts,1/128.)
+    # The Nyquist frequency has no phase
+    freq = cross['freq'][:-1]
+    coherence = cross['coherence'][0,:-1]
+    phase = cross['lag'][0,:-1]*2*np.pi*freq
+    phase_error = cross['lag_error'][0,:-1]*2*np.pi*freq
+
+    # Raw coherence is biased by 1/n_seg
+    assert np.isclose(coherence.mean(),(9./29.)**2+1./n_seg,rtol=0.1)
+    assert np.isclose(phase.std(),phase_error.mean(),rtol=0.15)
+    assert np.isclose(coherence.std(),cross['coherence_error'][0,:-1].mean(),rtol=0.25)
+
+    # Rebinning averages frequencies and shrinks the errors
+    rebinned = cross_spectra(counts,1/128.,rebin=0.1)
+    assert rebinned['n_avg'].sum() == len(cross['freq'])
+    assert np.all(np.diff(rebinned['freq']) > 0)
+    wide = rebinned['n_avg'] > 20
+    assert np.all(rebinned['lag_error'][0,wide]*2*np.pi*rebinned['freq'][wide] <
+        phase_error.mean()/3.)
+
+def test_spectrogram_stage(screened_exposure):
+    rng = np.random.default_rng(1)
+    gti = (np.array([0.,150.]),np.array([100.,230.]))
+    time = np.concatenate([rng.uniform(0,100,20000),rng.uniform(150,230,16000),
+        rng.uniform(100,150,5000)])
+    full_exp_dir,out_dir,destination = screened_exposure('HE',time,
+        np.full(len(time),20),np.zeros(len(time),dtype=int),gti)
+
+    # Small batches, windows of the two GTIs in the same batch
+    outfile = spectrogram_stage(full_exp_dir,'HE',twin=16.,timedel=1/64.,
+        rebin=0.,batch=4,out_dir=out_dir)
+    with fits.open(outfile) as hdu_list:
+        image = hdu_list[0].data
+        windows = hdu_list['WINDOWS'].data
+        freq = hdu_list['FREQ'].data
+
+    # 6 windows in the first GTI, 5 in the second, none across the gap
+    assert list(windows['TSTART']) == [0.,16.,32.,48.,64.,80.,150.,166.,182.,198.,214.]
+    assert np.all((windows['TSTOP'] <= 100.) | (windows['TSTART'] >= 150.))
+    assert image.shape == (len(windows),len(freq)) == (11,512)
+    assert np.allclose(windows['MEANRATE'],200.,rtol=0.1)
+    # Poisson level, 11x512 powers
+    assert abs(image.mean()-2.) < 0.1
+
+    rebinned = spectrogram_stage(full_exp_dir,'HE',twin=16.,timedel=1/64.,
+        rebin=0.1,out_dir=out_dir,override=True)
+    assert fits.getdata(rebinned,0).shape == (11,len(fits.getdata(rebinned,'FREQ')))
+
+    # Same windows from a lightcurve with the same gap
+    timedel = 1/64.
+    bins = np.concatenate([np.arange(0,6400),np.arange(9600,14720)])
+    counts = rng.poisson(200*timedel,len(bins))
+    lc_file = destination/'{}_HE_lc_ch8-162_0.015625s.lc'.format(EXP_ID)
+    write_lightcurve(lc_file,(bins+0.5)*timedel,counts/timedel,
+        np.sqrt(counts)/timedel,header=fits.Header({'TIMEDEL':timedel}),gti=gti)
+    outfile = spectrogram_stage(full_exp_dir,'HE',twin=16.,rebin=0.,
+        from_lc=lc_file,out_dir=out_dir)
+    assert outfile.name == lc_file.stem+'_spgram_16.0s.fits'
+    windows = fits.getdata(outfile,'WINDOWS')
+    assert np.allclose(windows['TSTART'],[0.,16.,32.,48.,64.,80.,150.,166.,182.,198.,214.])
+    image = fits.getdata(outfile,0)
+    assert image.shape == (11,512)
+    assert abs(image.mean()-2.) < 0.1
@@ -0,0 +1,1022 @@
+import os
+import re
+import pathlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from .hxmt_funcs import check_exp_format
+from .native_funcs import INSTRUMENTS, merge_gti, gti_intersection, read_gti, \
+    exposure_products, select_events, iter_event_chunks, iter_event_windows, \
+    write_hdu_stream
+from .fits_funcs import hdu_columns, table_names
+from .product_funcs import read_lightcurve, find_lightcurves, target_dir
+
+def segment_indices(time,timedel,gti,tseg,good=None,timepixr=0.5,
+    starts_only=False):
+    '''
+    Indices of fixed-length GTI-contiguous segments of a lightcurve
+
+    DESCRIPTION
+    -----------
+    A segment is made of consecutive bins (no gaps) all included in the
+    same GTI. Each contiguous run of bins is split into as many
+    segments of tseg seconds as possible, the remaining bins are
+    discarded.
+
+    PARAMETERS
+    ----------
+    time: numpy.ndarray
+        Time of the lightcurve bins
+    timedel: float
+        Bin size
+    gti: tuple or None
+        (start, stop) arrays. If None, only gaps in the lightcurve are
+        considered
+    tseg: float
+        Segment length [s]
+    good: numpy.ndarray or None, optional
+        Boolean mask of usable bins (ex. finite rates)
+    timepixr: float, optional
+        Position of TIME within the bin (0.5, default, bin center)
+    starts_only: boolean, optional
+        If True, only the index of the first bin of each segment is
+        returned (default is False)
+
+    RETURNS
+    -------
+    index: numpy.ndarray
+        Integer array (n_seg, n_bins) of lightcurve indices, or (n_seg,)
+        if starts_only is True
+    '''
+
+    n_bins = int(round(tseg/timedel))
+    tol = timedel*1e-3
+
+    bin_start = time-timepixr*timedel
+    bin_stop = bin_start+timedel
+
+    if good is None: good = np.ones(len(time),dtype=bool)
+    else: good = good.copy()
+
+    if not gti is None:
+        start,stop = merge_gti(*gti)
+        gti_index = np.searchsorted(start,bin_start+tol,side='right')-1
+        inside = gti_index >= 0
+        inside[inside] = bin_stop[inside] <= stop[gti_index[inside]]+tol
+        good &= inside
+    else:
+        gti_index = np.zeros(len(time),dtype=np.int64)
+
+    # A new run starts after a gap, a bad bin, or a GTI change
+    new_run = np.ones(len(time),dtype=bool)
+    new_run[1:] = (np.abs(np.diff(time)-timedel) > tol) | \
+        (np.diff(gti_index) != 0) | ~good[:-1]
+    new_run &= good
+    run_id = np.cumsum(new_run)-1
+    run_id[~good] = -1
+
+    valid = run_id >= 0
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.bincount(run_id[valid],minlength=len(run_starts))
+
+    n_seg = run_lengths//n_bins
+    seg_starts = np.repeat(run_starts,n_seg)+n_bins*(np.arange(n_seg.sum())-
+        np.repeat(np.cumsum(n_seg)-n_seg,n_seg))
+
+    if starts_only: return seg_starts
+    return seg_starts[:,None]+np.arange(n_bins)[None,:]
+
+def leahy_power(counts,axis=-1):
+    '''
+    Leahy normalized power spectra of a batch of segments
+
+    PARAMETERS
+    ----------
+    counts: numpy.ndarray
+        Counts per bin (..., n_bins), all segments are transformed at
+        once with a real FFT along axis
+
+    RETURNS
+    -------
+    power: numpy.ndarray
+        Leahy power without the zero frequency (..., n_bins//2)
+    '''
+
+    ft = np.fft.rfft(counts,axis=axis)
+    ft = np.delete(ft,0,axis=axis)
+    n_phot = counts.sum(axis=axis,keepdims=True)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return 2.*(ft.real**2+ft.imag**2)/n_phot
+
+def log_bin_edges(freq,rebin):
+    '''
+    Boundaries of logarithmic frequency bins
+
+    DESCRIPTION
+    -----------
+    Each frequency bin is (1+rebin) times wider than the previous one,
+    the first one being as wide as the original frequency resolution.
+    Bins are never narrower than the frequency resolution, so they are
+    never empty.
+    '''
+
+    df = freq[1]-freq[0]
+    fmin = freq[0]-df/2.
+    fmax = freq[-1]+df/2.
+
+    # Bin k spans [fmin+df*((1+r)^k-1)/r, fmin+df*((1+r)^(k+1)-1)/r]
+    n_edges = int(np.ceil(np.log(1.+rebin*(fmax-fmin)/df)/np.log(1.+rebin)))+1
+    edges = fmin+df*((1.+rebin)**np.arange(n_edges)-1.)/rebin
+    edges[-1] = max(edges[-1],fmax)
+
+    return edges
+
+def log_rebin(freq,power,error,rebin=0.02):
+    '''
+    Logarithmic rebinning of a power spectrum
+
+    DESCRIPTION
+    -----------
+    Frequency bins are defined by log_bin_edges. Powers are averaged 
+    within each bin and errors are propagated.
+
+    RETURNS
+    -------
+    freq, power, error, freq_error, n_avg: numpy.ndarray
+        Rebinned frequency, power, error, half bin width, and number of
+        averaged frequencies
+    '''
+
+    edges = log_bin_edges(freq,rebin)
+
+    index = np.searchsorted(edges,freq,side='right')-1
+    n_bins = len(edges)-1
+    n_avg = np.bincount(index,minlength=n_bins)
+    sum_power = np.bincount(index,weights=power,minlength=n_bins)
+    sum_error2 = np.bincount(index,weights=error**2,minlength=n_bins)
+    sum_freq = np.bincount(index,weights=freq,minlength=n_bins)
+
+    full = n_avg > 0
+    n_avg = n_avg[full]
+    new_freq = sum_freq[full]/n_avg
+    new_power = sum_power[full]/n_avg
+    new_error = np.sqrt(sum_error2[full])/n_avg
+    freq_error = (edges[1:]-edges[:-1])[full]/2.
+
+    return new_freq,new_power,new_error,freq_error,n_avg
+
+def lightcurve_segments(lc_file,tseg):
+    '''
+    Reads a lightcurve and splits it into GTI-contiguous segments
+
+    RETURNS
+    -------
+    counts: numpy.ndarray
+        Counts per bin (n_seg, n_bins)
+    times: numpy.ndarray
+        Start time of each segment (n_seg,)
+    lc: dictionary
+        Lightcurve (see product_funcs.read_lightcurve)
+    '''
+
+    lc = read_lightcurve(lc_file)
+    timepixr = lc['header'].get('TIMEPIXR',0.5)
+    index = segment_indices(lc['time'],lc['timedel'],lc['gti'],tseg,
+        good=np.isfinite(lc['rate']),timepixr=timepixr)
+    counts = lc['rate'][index]*lc['timedel']
+    times = lc['time'][index[:,0]]-timepixr*lc['timedel'] if len(index) > 0 \
+        else np.zeros(0)
+
+    return counts,times,lc
+
+def average_pds(counts,timedel,norm='leahy',bkg_rate=0.):
+    '''
+    Segment averaged power density spectrum
+
+    PARAMETERS
+    ----------
+    counts: numpy.ndarray
+        Counts per bin (n_seg, n_bins)
+    timedel: float
+        Bin size
+    norm: string, optional
+        'leahy' (default) or 'rms' (fractional rms squared per Hz)
+    bkg_rate: float, optional
+        Background rate included in the lightcurve, used for the rms
+        normalization (default is 0)
+
+    RETURNS
+    -------
+    pds: dictionary
+        freq, power, error, n_seg, mean_rate
+    '''
+
+    n_seg,n_bins = counts.shape
+    freq = np.fft.rfftfreq(n_bins,d=timedel)[1:]
+    power = leahy_power(counts)
+
+    mean_rate = counts.sum()/(n_seg*n_bins*timedel)
+    if norm == 'rms':
+        src_rate = mean_rate-bkg_rate
+        power = power*mean_rate/src_rate**2
+    elif norm != 'leahy':
+        raise ValueError('Unknown normalization {}'.format(norm))
+
+    avg_power = power.mean(axis=0)
+    error = avg_power/np.sqrt(n_seg)
+
+    return {'freq':freq,'power':avg_power,'error':error,'n_seg':n_seg,
+        'mean_rate':mean_rate}
+
+def write_pds(outfile,pds,tseg,timedel,norm,rebin=0.,header=None):
+    '''
+    Writes a power density spectrum (PDS extension) and, if rebin > 0,
+    its logarithmically rebinned version (PDS_REBIN extension)
+    '''
+
+    pds_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='FREQ',format='D',unit='Hz',array=pds['freq']),
+        fits.Column(name='POWER',format='D',array=pds['power']),
+        fits.Column(name='ERROR',format='D',array=pds['error'])],name='PDS')
+    hdu_list = [fits.PrimaryHDU(),pds_hdu]
+
+    if rebin > 0:
+        freq,power,error,freq_error,n_avg = log_rebin(pds['freq'],
+            pds['power'],pds['error'],rebin=rebin)
+        hdu_list += [fits.BinTableHDU.from_columns([
+            fits.Column(name='FREQ',format='D',unit='Hz',array=freq),
+            fits.Column(name='XAX_E',format='D',unit='Hz',array=freq_error),
+            fits.Column(name='POWER',format='D',array=power),
+            fits.Column(name='ERROR',format='D',array=error),
+            fits.Column(name='NAVG',format='J',array=n_avg)],name='PDS_REBIN')]
+
+    for hdu in hdu_list[1:]:
+        if not header is None:
+            for key in ['OBJECT','INSTRUME','OBS_ID','TSTART','TSTOP','MJDREFI','MJDREFF']:
+                if key in header: hdu.header[key] = header[key]
+        hdu.header['NSEG'] = (pds['n_seg'],'Number of averaged segments')
+        hdu.header['TSEG'] = (tseg,'Segment length [s]')
+        hdu.header['TIMEDEL'] = (timedel,'Time resolution [s]')
+        hdu.header['NORM'] = (norm,'Power normalization')
+        hdu.header['MEANRATE'] = (pds['mean_rate'],'Mean count rate [c/s]')
+        hdu.header['REBIN'] = (rebin,'Logarithmic rebinning factor')
+
+    fits.HDUList(hdu_list).writeto(outfile,overwrite=True)
+
+def read_pds(pds_file):
+    '''
+    Reads the unbinned PDS extension of a power spectrum file
+    '''
+
+    with fits.open(pds_file) as hdu_list:
+        hdu = hdu_list['PDS']
+        pds = {'freq':np.array(hdu.data['FREQ']),
+            'power':np.array(hdu.data['POWER']),
+            'error':np.array(hdu.data['ERROR']),
+            'n_seg':hdu.header['NSEG'],'mean_rate':hdu.header['MEANRATE'],
+            'tseg':hdu.header['TSEG'],'timedel':hdu.header['TIMEDEL'],
+            'norm':hdu.header['NORM']}
+    return pds
+
+def pds_name(lc_file,tseg,norm):
+    '''
+    Returns the name of the PDS file computed from a lightcurve
+    '''
+
+    lc_file = pathlib.Path(lc_file)
+    return lc_file.with_name('{}_pds_{}s_{}.fits'.format(lc_file.stem,tseg,norm))
+
+def lightcurve_pds(lc_file,tseg,norm='leahy',rebin=0.02,bkg_rate=0.,
+    override=False):
+    '''
+    Computes and writes the segment averaged PDS of a lightcurve
+
+    PARAMETERS
+    ----------
+    lc_file: string or pathlib.Path
+        Lightcurve file
+    tseg: float
+        Segment length [s]
+    norm: string, optional
+        'leahy' (default) or 'rms'
+    rebin: float, optional
+        Logarithmic rebinning factor (default is 0.02, 0 for no rebinning)
+    bkg_rate: float, optional
+        Background rate for the rms normalization
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    outfile: pathlib.Path or None
+        PDS file (<lc stem>_pds_<tseg>s_<norm>.fits). None if the
+        lightcurve does not contain any full segment
+    '''
+
+    outfile = pds_name(lc_file,tseg,norm)
+    if outfile.is_file() and not override:
+        logging.info('{} already exists'.format(outfile.name))
+        return outfile
+
+    counts,_,lc = lightcurve_segments(lc_file,tseg)
+    if len(counts) == 0:
+        logging.info('No {} s segment in {}'.format(tseg,pathlib.Path(lc_file).name))
+        return
+
+    pds = average_pds(counts,lc['timedel'],norm=norm,bkg_rate=bkg_rate)
+    write_pds(outfile,pds,tseg,lc['timedel'],norm,rebin=rebin,header=lc['header'])
+
+    return outfile
+
+def band_key(lc_file):
+    '''
+    Lightcurve name without the exposure ID (ex. HE_lc_ch8-162_1s_g0_0-17)
+    '''
+
+    return re.sub(r'^P\d{12}-\d{8}-\d{2}-\d{2}_','',pathlib.Path(lc_file).stem)
+
+def average_pds_files(pds_files,outfile,rebin=0.02):
+    '''
+    Averages PDS files with the same frequency grid, weighting each of
+    them by its number of segments
+    '''
+
+    pds_list = [read_pds(f) for f in pds_files]
+    n_seg = np.array([p['n_seg'] for p in pds_list])
+    power = np.vstack([p['power'] for p in pds_list])
+    mean_rate = np.array([p['mean_rate'] for p in pds_list])
+
+    tot_seg = n_seg.sum()
+    avg_power = (power*n_seg[:,None]).sum(axis=0)/tot_seg
+    pds = {'freq':pds_list[0]['freq'],'power':avg_power,
+        'error':avg_power/np.sqrt(tot_seg),'n_seg':int(tot_seg),
+        'mean_rate':float((mean_rate*n_seg).sum()/tot_seg)}
+
+    write_pds(outfile,pds,pds_list[0]['tseg'],pds_list[0]['timedel'],
+        pds_list[0]['norm'],rebin=rebin)
+
+    return outfile
+
+def pds_stage(out_dir,instruments=['HE','ME','LE'],tseg=128.,norm='leahy',
+    rebin=0.02,kind='src',n_workers=None,override=False):
+    '''
+    Computes per-exposure and per-target averaged PDS
+
+    DESCRIPTION
+    -----------
+    For each instrument, a PDS is computed for every lightcurve of the
+    target (in parallel). PDS of lightcurves with the same band and
+    binsize are then averaged over all the exposures and saved in the
+    target folder as <target>_<band key>_pds_<tseg>s_<norm>.fits
+
+    PARAMETERS
+    ----------
+    out_dir: string or pathlib.Path
+        Target folder (containing the analysis folder)
+    instruments: list, optional
+        Instruments to process (default is HE, ME, and LE)
+    tseg: float, optional
+        Segment length [s] (default is 128)
+    norm: string, optional
+        'leahy' (default) or 'rms'
+    rebin: float, optional
+        Logarithmic rebinning factor (default is 0.02)
+    kind: string, optional
+        Lightcurves to use, 'src' (default) or 'net'
+    n_workers: integer or None, optional
+        Number of processes (default is the number of CPUs)
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    outfiles: list
+        Target averaged PDS files
+    '''
+
+    logging.info('===>>> Running pds_stage <<<===')
+
+    out_dir = pathlib.Path(out_dir)
+    lc_files = []
+    for inst in instruments:
+        lc_files += find_lightcurves(out_dir,inst,kind=kind)
+    logging.info('Computing PDS of {} lightcurves'.format(len(lc_files)))
+    if len(lc_files) == 0: return []
+
+    n = len(lc_files)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pds_files = list(executor.map(lightcurve_pds,lc_files,[tseg]*n,
+            [norm]*n,[rebin]*n,[0.]*n,[override]*n))
+
+    # Grouping per band and binsize
+    groups = {}
+    for lc_file,pds_file in zip(lc_files,pds_files):
+        if pds_file is None: continue
+        groups.setdefault(band_key(lc_file),[]).append(pds_file)
+
+    destination = target_dir(out_dir)
+    outfiles = []
+    for key,files in groups.items():
+        outfile = destination/'{}_{}_pds_{}s_{}.fits'.format(out_dir.name,key,tseg,norm)
+        logging.info('Averaging {} PDS into {}'.format(len(files),outfile.name))
+        outfiles += [average_pds_files(files,outfile,rebin=rebin)]
+
+    return outfiles
+
+def gti_segments(gti,tseg):
+    '''
+    Start times of all the fixed-length segments fitting in the GTIs
+
+    PARAMETERS
+    ----------
+    gti: tuple
+        (start, stop) arrays, sorted and merged
+    tseg: float
+        Segment length [s]
+
+    RETURNS
+    -------
+    seg_starts: numpy.ndarray
+    '''
+
+    start,stop = gti
+    n_seg = np.floor((stop-start)/tseg+1e-9).astype(np.int64)
+    n_seg[n_seg < 0] = 0
+    offsets = np.arange(n_seg.sum())-np.repeat(np.cumsum(n_seg)-n_seg,n_seg)
+
+    return np.repeat(start,n_seg)+tseg*offsets
+
+def segment_counts(time,seg_starts,tseg,timedel):
+    '''
+    Bins events directly into fixed-length segments
+
+    PARAMETERS
+    ----------
+    time: numpy.ndarray
+        Sorted event times
+    seg_starts: numpy.ndarray
+        Sorted segment start times (see gti_segments)
+    tseg: float
+        Segment length [s]
+    timedel: float
+        Bin size
+
+    RETURNS
+    -------
+    counts: numpy.ndarray
+        Counts per bin (n_seg, n_bins)
+    '''
+
+    n_bins = int(round(tseg/timedel))
+    n_seg = len(seg_starts)
+
+    seg = np.searchsorted(seg_starts,time,side='right')-1
+    inside = seg >= 0
+    seg,time = seg[inside],time[inside]
+    offset = time-seg_starts[seg]
+    inside = offset < tseg
+    seg,offset = seg[inside],offset[inside]
+    bins = np.minimum((offset/timedel).astype(np.int64),n_bins-1)
+
+    counts = np.bincount(seg*n_bins+bins,minlength=n_seg*n_bins)
+
+    return counts.reshape(n_seg,n_bins).astype(np.float64)
+
+def _rebin_last_axis(values,starts):
+    '''
+    Averages values along the last axis within contiguous bins starting
+    at the indices starts
+    '''
+
+    n_avg = np.diff(np.append(starts,values.shape[-1]))
+    return np.add.reduceat(values,starts,axis=-1)/n_avg
+
+def cross_spectra(counts,timedel,rebin=0.):
+    '''
+    Cross spectra, coherence, and time lags of all the pairs of bands
+
+    DESCRIPTION
+    -----------
+    Fourier transforms of all the bands and segments are computed with
+    a single real FFT. Cross spectra of all the pairs (i < j), defined
+    as F_i conj(F_j), are computed at once with fancy indexing, averaged over segments and,
+    if rebin > 0, over logarithmic frequency bins. Coherence is the raw
+    coherence (not corrected for Poisson noise), errors follow Bendat
+    & Piersol (2010). Positive lags mean band j lagging band i.
+
+    PARAMETERS
+    ----------
+    counts: numpy.ndarray
+        Counts per bin (n_band, n_seg, n_bins) of strictly simultaneous
+        segments
+    timedel: float
+        Bin size
+    rebin: float, optional
+        Logarithmic rebinning factor (default is 0, no rebinning)
+
+    RETURNS
+    -------
+    cross: dictionary
+        freq, freq_error, n_avg (n_freq,)
+        pairs (n_pair, 2)
+        cross (n_pair, n_freq) complex, averaged cross spectrum
+        power (n_band, n_freq), averaged (unnormalized) powers
+        coherence, coherence_error, lag, lag_error (n_pair, n_freq)
+    '''
+
+    n_band,n_seg,n_bins = counts.shape
+    freq = np.fft.rfftfreq(n_bins,d=timedel)[1:]
+
+    ft = np.fft.rfft(counts,axis=-1)[...,1:]
+    power = (ft.real**2+ft.imag**2).mean(axis=1)
+
+    pairs = np.column_stack(np.triu_indices(n_band,k=1))
+    cross = (ft[pairs[:,0]]*np.conj(ft[pairs[:,1]])).mean(axis=1)
+
+    if rebin > 0:
+        edges = log_bin_edges(freq,rebin)
+        index = np.searchsorted(edges,freq,side='right')-1
+        starts = np.flatnonzero(np.diff(np.append(-1,index)))
+        n_avg = np.diff(np.append(starts,len(freq)))
+        freq_error = (edges[1:]-edges[:-1])[index[starts]]/2.
+        freq = _rebin_last_axis(freq,starts)
+        power = _rebin_last_axis(power,starts)
+        cross = _rebin_last_axis(cross,starts)
+    else:
+        n_avg = np.ones(len(freq),dtype=np.int64)
+        freq_error = np.full(len(freq),(freq[1]-freq[0])/2.)
+
+    n_eff = n_seg*n_avg
+    with np.errstate(divide='ignore',invalid='ignore'):
+        coherence = np.abs(cross)**2/(power[pairs[:,0]]*power[pairs[:,1]])
+        coherence_error = np.sqrt(2./n_eff)*np.sqrt(coherence)*(1.-coherence)
+        phase = np.angle(cross)
+        phase_error = np.sqrt((1.-coherence)/(2.*coherence*n_eff))
+    lag = phase/(2.*np.pi*freq)
+    lag_error = phase_error/(2.*np.pi*freq)
+
+    return {'freq':freq,'freq_error':freq_error,'n_avg':n_avg,
+        'pairs':pairs,'cross':cross,'power':power,
+        'coherence':coherence,'coherence_error':coherence_error,
+        'lag':lag,'lag_error':lag_error,'n_seg':n_seg}
+
+def write_cross_spectra(outfile,cross,bands,tseg,timedel,gti):
+    '''
+    Writes cross spectra products: BANDS (band definitions), CROSS (one
+    row per frequency, one vector element per pair), POWER and GTI
+    extensions
+    '''
+
+    n_pair = len(cross['pairs'])
+    n_band = len(bands)
+
+    band_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='INSTRUME',format='2A',array=[b['inst'] for b in bands]),
+        fits.Column(name='MINPI',format='J',array=[b['minpi'] for b in bands]),
+        fits.Column(name='MAXPI',format='J',array=[b['maxpi'] for b in bands]),
+        fits.Column(name='MEANRATE',format='D',array=[b['mean_rate'] for b in bands])],
+        name='BANDS')
+
+    def vector(name,values,unit=None):
+        return fits.Column(name=name,format='{}D'.format(n_pair),unit=unit,
+            array=np.ascontiguousarray(values.T))
+
+    cross_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='FREQ',format='D',unit='Hz',array=cross['freq']),
+        fits.Column(name='XAX_E',format='D',unit='Hz',array=cross['freq_error']),
+        fits.Column(name='NAVG',format='J',array=cross['n_avg']),
+        vector('CROSS_RE',cross['cross'].real),
+        vector('CROSS_IM',cross['cross'].imag),
+        vector('COHER',cross['coherence']),
+        vector('COHER_E',cross['coherence_error']),
+        vector('LAG',cross['lag'],unit='s'),
+        vector('LAG_E',cross['lag_error'],unit='s')],name='CROSS')
+    cross_hdu.header['NSEG'] = (cross['n_seg'],'Number of averaged segments')
+    cross_hdu.header['TSEG'] = (tseg,'Segment length [s]')
+    cross_hdu.header['TIMEDEL'] = (timedel,'Time resolution [s]')
+    for k,(i,j) in enumerate(cross['pairs']):
+        cross_hdu.header['PAIR{}'.format(k)] = ('{}-{}'.format(i,j),
+            'Band indices (BANDS rows) of vector element {}'.format(k))
+
+    power_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='FREQ',format='D',unit='Hz',array=cross['freq']),
+        fits.Column(name='POWER',format='{}D'.format(n_band),
+            array=np.ascontiguousarray(cross['power'].T))],name='POWER')
+
+    gti_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='START',format='D',unit='s',array=gti[0]),
+        fits.Column(name='STOP',format='D',unit='s',array=gti[1])],name='GTI')
+
+    fits.HDUList([fits.PrimaryHDU(),band_hdu,cross_hdu,power_hdu,gti_hdu]).\
+        writeto(outfile,overwrite=True)
+
+def cross_stage(full_exp_dir,bands=[('HE',8,162),('ME',119,546),('LE',106,1169)],
+    timedel=1/128.,tseg=64.,rebin=0.05,out_dir=pathlib.Path.cwd(),override=False):
+    '''
+    Computes cross spectra, coherence, and time lags between energy
+    bands of HE, ME, and LE
+
+    DESCRIPTION
+    -----------
+    Strictly simultaneous lightcurves are built directly from the 
+    screened event files on the intersection of the GTIs of all the 
+    involved instruments. Events are binned into fixed-length segments 
+    on a common time grid and all the pairs of bands are processed at
+    once (see cross_spectra).
+
+    PARAMETERS
+    ----------
+    full_exp_dir: string or pathlib.Path
+        Full path of the esposure folder
+    bands: list, optional
+        List of (instrument, minpi, maxpi) or (instrument, minpi, maxpi,
+        det_ids) tuples. Default is the pipeline broad band of each 
+        instrument
+    timedel: float, optional
+        Time resolution [s] (default is 1/128)
+    tseg: float, optional
+        Segment length [s] (default is 64)
+    rebin: float, optional
+        Logarithmic rebinning factor (default is 0.05)
+    out_dir: string or pathlib.Path(), optional
+        Name of the output products folder (containing the analysis
+        folder). Default is current working directory.
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    outfile: pathlib.Path or None
+        Cross spectra file, in the form:
+        <out_dir>/analysis/<exp_ID>/<exp_ID>_cross_<timedel>s_<tseg>s.fits
+    '''
+
+    logging.info('===>>> Running cross_stage <<<===')
+
+    if type(full_exp_dir) == str: full_exp_dir = pathlib.Path(full_exp_dir)
+    if type(out_dir) == str: out_dir = pathlib.Path(out_dir)
+
+    # Checking exposure folder format
+    if not check_exp_format(full_exp_dir):
+        logging.info('Something is wrong in the exposure folder name, check:')
+        logging.info(full_exp_dir)
+        return
+
+    # Defining obs_ID as proposal_ID-obs_ID-exp_ID
+    exp_ID = str(full_exp_dir.name)
+    exp_dir = out_dir/'analysis'/exp_ID
+    if not exp_dir.is_dir(): os.makedirs(exp_dir)
+
+    outfile = exp_dir/'{}_cross_{}s_{}s.fits'.format(exp_ID,timedel,tseg)
+    if outfile.is_file() and not override:
+        logging.info('Cross spectra file already exists')
+        return outfile
+
+    # Input files and common GTI
+    # -----------------------------------------------------------------
+    bands = [{'inst':b[0],'minpi':b[1],'maxpi':b[2],
+        'det_ids':b[3] if len(b) > 3 else INSTRUMENTS[b[0]]['lc_det_ids']}
+        for b in bands]
+    inputs = {}
+    for inst in set([b['inst'] for b in bands]):
+        screen_file,gti_file = exposure_products(exp_dir,exp_ID,inst)
+        if screen_file is None or gti_file is None:
+            logging.error('{} screened event file or GTI missing'.format(inst))
+            return
+        inputs[inst] = (screen_file,gti_file)
+
+    gti = None
+    for inst,(_,gti_file) in inputs.items():
+        inst_gti = read_gti(gti_file)
+        gti = inst_gti if gti is None else gti_intersection(*gti,*inst_gti)
+    seg_starts = gti_segments(gti,tseg)
+    if len(seg_starts) == 0:
+        logging.error('No simultaneous segment of {} s'.format(tseg))
+        return
+    logging.info('{} simultaneous segments of {} s'.format(len(seg_starts),tseg))
+    # -----------------------------------------------------------------
+
+    # Binning events, each event file is read only once, chunk by chunk
+    counts = np.zeros((len(bands),len(seg_starts),int(round(tseg/timedel))))
+    for inst,(screen_file,_) in inputs.items():
+        cols = INSTRUMENTS[inst]
+        for data in iter_event_chunks(screen_file,
+            [cols['time_col'],cols['pi_col'],cols['det_col']]):
+            for k,band in enumerate(bands):
+                if band['inst'] != inst: continue
+                time = select_events(data,inst,minpi=band['minpi'],
+                    maxpi=band['maxpi'],det_ids=band['det_ids'])
+                counts[k] += segment_counts(time,seg_starts,tseg,timedel)
+    for k,band in enumerate(bands):
+        band['mean_rate'] = counts[k].sum()/(len(seg_starts)*tseg)
+
+    cross = cross_spectra(counts,timedel,rebin=rebin)
+    write_cross_spectra(outfile,cross,bands,tseg,timedel,gti)
+
+    return outfile
+
+def event_window_counts(screen_file,inst,win_starts,twin,timedel,minpi=None,
+    maxpi=None,det_ids=None,batch=64):
+    '''
+    Yields binned events of consecutive time windows, batch by batch
+
+    DESCRIPTION
+    -----------
+    Only the events of the current batch of windows are read from the
+    (memory mapped) screened event file.
+
+    PARAMETERS
+    ----------
+    screen_file: string or pathlib.Path
+        Screened event file or row-index sidecar
+    inst: string
+        Instrument (HE, ME, or LE)
+    win_starts: numpy.ndarray
+        Sorted window start times (see gti_segments)
+    twin: float
+        Window length [s]
+    timedel: float
+        Bin size
+    minpi, maxpi: integer or None, optional
+        Energy channel range
+    det_ids: string or None, optional
+        Detector selection string
+    batch: integer, optional
+        Number of windows per batch (default is 64)
+
+    YIELDS
+    ------
+    counts: numpy.ndarray
+        Counts per bin (n_win_batch, n_bins)
+    '''
+
+    cols = INSTRUMENTS[inst]
+    batches = [win_starts[k:k+batch] for k in range(0,len(win_starts),batch)]
+    windows = iter_event_windows(screen_file,[cols['pi_col'],cols['det_col']],
+        [b[0] for b in batches],[b[-1]+twin for b in batches])
+    for starts,data in zip(batches,windows):
+        time = select_events(data,inst,minpi=minpi,maxpi=maxpi,det_ids=det_ids)
+        yield segment_counts(time,starts,twin,timedel)
+
+def lightcurve_window_counts(lc_file,twin,batch=64):
+    '''
+    Splits a lightcurve into GTI-contiguous windows, batch by batch
+
+    DESCRIPTION
+    -----------
+    Only the TIME column is loaded, rates of each batch of windows are
+    read from the memory mapped file.
+
+    RETURNS
+    -------
+    win_starts: numpy.ndarray
+        Start time of each window
+    timedel: float
+        Bin size
+    header: astropy.io.fits.Header
+        Header of the RATE extension
+    batches: generator
+        Counts per bin (n_win_batch, n_bins) of each batch
+    '''
+
+    lc_file = pathlib.Path(lc_file)
+    with fits.open(lc_file,memmap=True) as hdu_list:
+        hdu = [h for h in hdu_list[1:] if h.name.upper() == 'RATE']
+        hdu = hdu[0] if len(hdu) > 0 else hdu_list[1]
+        header = hdu.header.copy()
+        time = hdu_columns(hdu,['TIME'])['TIME'].astype(np.float64)
+        gti = None
+        for gti_hdu in hdu_list[1:]:
+            if gti_hdu.name.upper().startswith('GTI'):
+                data = hdu_columns(gti_hdu,['START','STOP'])
+                gti = (data['START'].astype(np.float64),data['STOP'].astype(np.float64))
+                break
+    timedel = float(header.get('TIMEDEL',np.median(np.diff(time))))
+    timepixr = header.get('TIMEPIXR',0.5)
+    n_bins = int(round(twin/timedel))
+
+    starts = segment_indices(time,timedel,gti,twin,timepixr=timepixr,
+        starts_only=True)
+    win_starts = time[starts]-timepixr*timedel
+    del time
+
+    def batches():
+        with fits.open(lc_file,memmap=True) as hdu_list:
+            hdu = [h for h in hdu_list[1:] if h.name.upper() == 'RATE']
+            hdu = hdu[0] if len(hdu) > 0 else hdu_list[1]
+            col = 'RATE' if 'RATE' in table_names(hdu) else 'COUNTS'
+            factor = timedel if col == 'RATE' else 1.
+            for k in range(0,len(starts),batch):
+                index = starts[k:k+batch,None]+np.arange(n_bins)[None,:]
+                counts = hdu_columns(hdu,[col],index)[col].astype(np.float64)*factor
+                counts[~np.isfinite(counts)] = 0.
+                yield counts
+
+    return win_starts,timedel,header,batches()
+
+def write_spectrogram(outfile,win_starts,batches,twin,timedel,rebin=0.,
+    header=None,history=None):
+    '''
+    Computes and writes a dynamic power spectrum, batch by batch
+
+    DESCRIPTION
+    -----------
+    Leahy power spectra of each batch of windows are computed with a
+    single real FFT, optionally averaged over logarithmic frequency
+    bins, and appended to the primary image (time x frequency, float32)
+    as soon as they are computed, so memory usage is bounded by the 
+    batch size. Window start times and mean rates (WINDOWS extension)
+    and frequency bins (FREQ extension) are appended afterwards.
+
+    PARAMETERS
+    ----------
+    outfile: string or pathlib.Path
+        Output file
+    win_starts: numpy.ndarray
+        Start time of each window
+    batches: iterable
+        Counts per bin (n_win_batch, n_bins), in the order of win_starts
+    twin: float
+        Window length [s]
+    timedel: float
+        Bin size
+    rebin: float, optional
+        Logarithmic rebinning factor (default is 0, no rebinning)
+    header: astropy.io.fits.Header or None, optional
+        Keywords (OBJECT, INSTRUME, ...) to copy into the product
+    history: string or list or None, optional
+        HISTORY records
+    '''
+
+    outfile = pathlib.Path(outfile)
+    n_bins = int(round(twin/timedel))
+    freq = np.fft.rfftfreq(n_bins,d=timedel)[1:]
+    if rebin > 0:
+        edges = log_bin_edges(freq,rebin)
+        index = np.searchsorted(edges,freq,side='right')-1
+        starts = np.flatnonzero(np.diff(np.append(-1,index)))
+        freq_lo = edges[index[starts]]
+        freq_hi = edges[index[starts]+1]
+    else:
+        starts = None
+        freq_lo = freq-freq[0]/2.
+        freq_hi = freq+freq[0]/2.
+    n_freq = len(freq_lo)
+
+    image = fits.PrimaryHDU().header
+    image['BITPIX'] = -32
+    image['NAXIS'] = 2
+    image.insert('NAXIS',('NAXIS1',n_freq,'Number of frequencies'),after=True)
+    image.insert('NAXIS1',('NAXIS2',len(win_starts),'Number of windows'),after=True)
+    image['BUNIT'] = ('Leahy power','')
+    if not header is None:
+        for key in ['OBJECT','INSTRUME','OBS_ID','MJDREFI','MJDREFF']:
+            if key in header: image[key] = header[key]
+    image['TWIN'] = (twin,'Window length [s]')
+    image['TIMEDEL'] = (timedel,'Time resolution [s]')
+    image['REBIN'] = (rebin,'Logarithmic rebinning factor')
+    if not history is None:
+        if type(history) == str: history = [history]
+        for line in history: image['HISTORY'] = line
+
+    mean_rate = []
+    def blocks():
+        for counts in batches:
+            mean_rate.append(counts.sum(axis=1)/twin)
+            power = leahy_power(counts)
+            if not starts is None: power = _rebin_last_axis(power,starts)
+            yield power.astype('>f4')
+
+    tmp_file = outfile.with_name(outfile.name+'.tmp')
+    with open(tmp_file,'wb') as out:
+        write_hdu_stream(out,image,blocks())
+
+    mean_rate = np.concatenate(mean_rate) if len(mean_rate) > 0 else np.zeros(0)
+    windows = fits.BinTableHDU.from_columns([
+        fits.Column(name='TSTART',format='D',unit='s',array=win_starts),
+        fits.Column(name='TSTOP',format='D',unit='s',array=win_starts+twin),
+        fits.Column(name='MEANRATE',format='E',unit='counts/s',array=mean_rate)],
+        name='WINDOWS')
+    freqs = fits.BinTableHDU.from_columns([
+        fits.Column(name='FREQ_LO',format='D',unit='Hz',array=freq_lo),
+        fits.Column(name='FREQ_HI',format='D',unit='Hz',array=freq_hi)],
+        name='FREQ')
+    with fits.open(tmp_file,mode='append') as hdu_list:
+        hdu_list.append(windows)
+        hdu_list.append(freqs)
+    os.replace(tmp_file,outfile)
+
+def spectrogram_stage(full_exp_dir,inst,twin=64.,timedel=1/128.,minpi=None,
+    maxpi=None,det_ids=None,rebin=0.05,from_lc=False,batch=64,
+    out_dir=pathlib.Path.cwd(),override=False):
+    '''
+    Computes the dynamic power spectrum (spectrogram) of an exposure
+
+    DESCRIPTION
+    -----------
+    Leahy power spectra of consecutive GTI-contiguous windows of twin
+    seconds are stacked into a time x frequency image (see 
+    write_spectrogram). Windows are processed in batches, reading only
+    the corresponding events (or lightcurve bins), so memory usage does
+    not depend on the exposure length.
+
+    PARAMETERS
+    ----------
+    full_exp_dir: string or pathlib.Path
+        Full path of the esposure folder
+    inst: string
+        Instrument (HE, ME, or LE)
+    twin: float, optional
+        Window length [s] (default is 64)
+    timedel: float, optional
+        Time resolution [s] (default is 1/128). Ignored if from_lc is
+        True
+    minpi, maxpi: integer or None, optional
+        Energy channel range. If None, the pipeline broad band of the
+        instrument is used
+    det_ids: string or None, optional
+        Detector selection string. If None, the lightcurve detectors of
+        the instrument are used
+    rebin: float, optional
+        Logarithmic rebinning factor (default is 0.05, 0 for no rebinning)
+    from_lc: boolean or string or pathlib.Path, optional
+        If a lightcurve file is given, windows are taken from it instead
+        of the screened event file (default is False)
+    batch: integer, optional
+        Number of windows processed at once (default is 64)
+    out_dir: string or pathlib.Path(), optional
+        Name of the output products folder (containing the analysis
+        folder). Default is current working directory.
+    override: boolean, optional
+        If True, existing files will be overwritten
+
+    RETURNS
+    -------
+    outfile: pathlib.Path or None
+        Spectrogram file, in the form:
+        <out_dir>/analysis/<exp_ID>/<INST>/
+            <exp_ID>_<INST>_spgram_ch<minpi>-<maxpi>_<timedel>s_<twin>s.fits
+        (<lc stem>_spgram_<twin>s.fits if from_lc is given)
+    '''
+
+    logging.info('===>>> Running spectrogram_stage <<<===')
+
+    if type(full_exp_dir) == str: full_exp_dir = pathlib.Path(full_exp_dir)
+    if type(out_dir) == str: out_dir = pathlib.Path(out_dir)
+
+    # Checking exposure folder format
+    if not check_exp_format(full_exp_dir):
+        logging.info('Something is wrong in the exposure folder name, check:')
+        logging.info(full_exp_dir)
+        return
+
+    exp_ID = str(full_exp_dir.name)
+    exp_dir = out_dir/'analysis'/exp_ID
+    destination = exp_dir/inst
+    if not destination.is_dir(): os.makedirs(destination)
+
+    if minpi is None: minpi = INSTRUMENTS[inst]['band'][0]
+    if maxpi is None: maxpi = INSTRUMENTS[inst]['band'][1]
+    if det_ids is None: det_ids = INSTRUMENTS[inst]['lc_det_ids']
+
+    if from_lc:
+        lc_file = pathlib.Path(from_lc)
+        outfile = lc_file.with_name('{}_spgram_{}s.fits'.format(lc_file.stem,twin))
+    else:
+        outfile = destination/'{}_{}_spgram_ch{}-{}_{}s_{}s.fits'.\
+            format(exp_ID,inst,minpi,maxpi,timedel,twin)
+    if outfile.is_file() and not override:
+        logging.info('Spectrogram file already exists')
+        return outfile
+
+    if from_lc:
+        if not lc_file.is_file():
+            logging.error('Lightcurve {} does not exist'.format(lc_file.name))
+            return
+        win_starts,timedel,header,batches = lightcurve_window_counts(lc_file,
+            twin,batch=batch)
+        history = 'Computed from {}'.format(lc_file.name)
+    else:
+        screen_file,gti_file = exposure_products(exp_dir,exp_ID,inst)
+        if screen_file is None or gti_file is None:
+            logging.error('{} screened event file or GTI missing'.format(inst))
+            return
+        win_starts = gti_segments(read_gti(gti_file),twin)
+        batches = event_window_counts(screen_file,inst,win_starts,twin,timedel,
+            minpi=minpi,maxpi=maxpi,det_ids=det_ids,batch=batch)
+        header = fits.getheader(gti_file,1)
+        history = 'Computed from {} (PI {}-{}, DET_ID {})'.format(
+            pathlib.Path(screen_file).name,minpi,maxpi,det_ids)
+
+    if len(win_starts) == 0:
+        logging.error('No window of {} s'.format(twin))
+        return
+    logging.info('Computing {} windows of {} s'.format(len(win_starts),twin))
+
+    write_spectrogram(outfile,win_starts,batches,twin,timedel,rebin=rebin,
+        header=header,history=history)
+
+    return outfile
@@ -1,90 +1,236 @@
 import os
+import sys
 import glob
+import gzip
+import json
+import shutil
+import hashlib
 import logging
-
-parent_data_dir = '/media/QNAP_40T_HD/HXMTdata_version20200927'
-folders = next(os.walk(parent_data_dir))[1]
-happy = False
-while not happy:
-    for i,folder in enumerate(folders):
-        print('{}) {}'.format(i+1,folder))
-    index = int(input('Choose a directory ====> '))-1
-    target = folders[index]
-    ans=input('You chose {}, are you happy?'.format(target))
-    if not ('N' in ans.upper() or 'O' in ans.upper()):
-        happy = True
-df = os.path.join(parent_data_dir,target)
-
-
-# Destination and log folder
-
-there = '/media/3HD/common_files'
-rdf = os.path.join(there,target)
-
-limbo = '/media/3HD/stefano/climbo/Cygnus_X1'
-
-# At this point data should be organized in proposal-observation-exposure folders inside rdf
-proposals = sorted(next(os.walk(rdf))[1])
-if 'logs' in proposals: proposals.remove('logs')
-
-for proposal in proposals:
-
-    prop_folder = os.path.join(rdf,proposal)
-    observations = sorted(next(os.walk(prop_folder))[1])
-
-    logging.info(f'There are {len(observations)} observations.\n')
-    for observation in observations:
-
-        logging.info(f'Processing observation {observation}')
-        logging.info('-'*80)
-
-        obs_folder = os.path.join(prop_folder,observation)
-        exposures = sorted(next(os.walk(obs_folder))[1])
-
-        # Checking ACS and AUX folders
-        flag_acs = True
-        if 'ACS' in exposures:
-            exposures.remove('ACS')
-        else:
-            logging.info('ACS folder does not exists, response matrix cannot be computed.')
-            logging.info('Energy spectrum will not be computed')
-            flag_acs = False
-        if 'AUX' in exposures:
-            exposures.remove('AUX')
-        else:
-            logging.info('AUX folder does not exists. Skipping obs.')
-            logging.info('-'*80+'\n')
+from concurrent.futures import ThreadPoolExecutor
+
+# Exports the reduced products (HE/reduced_products) of all the
+# exposures of a target to a destination folder, one folder per
+# exposure. Lightcurves (.lc) are compressed (.lc.gz), energy spectra
+# (.pi) are copied. Each product is streamed from the source (through
+# gzip, if compressed) into a temporary file in the destination folder
+# and renamed when complete. A manifest (export_manifest.json in the
+# destination folder) records the sha256 of the exported products, so
+# products already exported with the same checksum are skipped.
+#
+# Calling sequence:
+# python move_products.py [target=<target name>] [nproc=<n threads>]
+#     [destination=<folder>] [override]
+
+BUFFER = 1024*1024
+
+def file_sha256(file_name):
+    '''
+    Returns the sha256 hex digest of a file, read in blocks
+    '''
+
+    sha = hashlib.sha256()
+    with open(file_name,'rb') as infile:
+        for block in iter(lambda: infile.read(BUFFER),b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def export_file(source,destination,compress=False,exported=None,override=False):
+    '''
+    Exports a file to a destination folder
+
+    DESCRIPTION
+    -----------
+    The file is streamed into a temporary file in the destination
+    folder, compressing it on the fly if compress is True (the
+    exported file has the .gz extension), and renamed when complete.
+    No uncompressed copy is written.
+
+    PARAMETERS
+    ----------
+    source: string
+        File to export
+    destination: string
+        Destination folder
+    compress: boolean, optional
+        If True, the file is compressed with gzip
+    exported: dictionary or None, optional
+        Previous manifest entry of the file (sha256, size, mtime_ns). If
+        the source has not changed, the file is not exported again
+    override: boolean, optional
+        If True, the file is exported in any case
+
+    RETURNS
+    -------
+    entry: dictionary
+        Manifest entry (sha256, size, mtime_ns, status)
+    '''
+
+    out_file = os.path.join(destination,os.path.basename(source))
+    if compress: out_file += '.gz'
+
+    info = os.stat(source)
+    entry = {'size':info.st_size,'mtime_ns':info.st_mtime_ns}
+    if not override and not exported is None and os.path.isfile(out_file):
+        # Unchanged size and modification time, the checksum is not
+        # computed again
+        if exported['size'] == entry['size'] and \
+            exported['mtime_ns'] == entry['mtime_ns']:
+            return {**exported,'status':'skipped'}
+        entry['sha256'] = file_sha256(source)
+        if entry['sha256'] == exported['sha256']:
+            return {**entry,'status':'skipped'}
+
+    sha = hashlib.sha256()
+    tmp_file = out_file+'.tmp'
+    with open(source,'rb') as infile, open(tmp_file,'wb') as raw_out:
+        out = gzip.GzipFile(filename=os.path.basename(source),mode='wb',
+            fileobj=raw_out,mtime=int(info.st_mtime)) if compress else raw_out
+        try:
+            for block in iter(lambda: infile.read(BUFFER),b''):
+                sha.update(block)
+                out.write(block)
+        finally:
+            if compress: out.close()
+    shutil.copystat(source,tmp_file)
+    os.replace(tmp_file,out_file)
+
+    entry['sha256'] = sha.hexdigest()
+    entry['status'] = 'exported'
+    return entry
+
+def export_products(jobs,destination,n_workers=4,override=False):
+    '''
+    Exports products in parallel (thread pool)
+
+    PARAMETERS
+    ----------
+    jobs: list
+        List of (source file, destination sub-folder, compress)
+    destination: string
+        Destination folder (containing the manifest)
+    n_workers: integer, optional
+        Number of threads
+    override: boolean, optional
+        If True, products are exported again
+
+    RETURNS
+    -------
+    manifest: dictionary
+        Exported file (relative to destination): manifest entry
+    '''
+
+    manifest_file = os.path.join(destination,'export_manifest.json')
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file,'r') as infile:
+            manifest = json.load(infile)
+
+    def run(job):
+        source,sub_folder,compress = job
+        out_dir = os.path.join(destination,sub_folder)
+        os.makedirs(out_dir,exist_ok=True)
+        key = os.path.join(sub_folder,os.path.basename(source)+('.gz' if compress else ''))
+        try:
+            entry = export_file(source,out_dir,compress=compress,
+                exported=manifest.get(key),override=override)
+        except OSError as e:
+            logging.error('Could not export {} ({})'.format(source,e))
+            return key,None
+        return key,entry
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(run,jobs))
+
+    n_exported,n_skipped,n_failed = 0,0,0
+    for key,entry in results:
+        if entry is None:
+            n_failed += 1
             continue
-
-        logging.info(f'There are {len(exposures)} exposures\n')
-        for exposure in exposures:
-
-            logging.info(f'Processing exposure {exposure}')
-            logging.info('*'*80)
-            wf = os.path.join(obs_folder,exposure)
-
-            # Targeting destination folder
-            target = os.path.join(wf,'HE/reduced_products')
-            
-            # Creating destination folder
-            destination = os.path.join(limbo,exposure)
-            os.system('mkdir {}'.format(destination))
-
-            # Compying and zipping lc files
-            lc_files = glob.glob('{}/*.lc'.format(target))
-            for lc in lc_files:
-                # Transfering lightcurves
-                cmd = 'cp {} {}'.format(lc,destination)
-                os.system(cmd)
-                
-                # Zipping the file
-                cmd = 'gzip {}'.format(os.path.join(destination,lc))
-                os.system(cmd)
-                
-            # Compying .pi files
-            pi_files = glob.glob('{}/*.pi'.format(target))
-            for pi in pi_files:
-                cmd = 'cp {} {}'.format(pi,destination)
-                os.system(cmd)
-                
-                
+        if entry.pop('status') == 'exported':
+            n_exported += 1
+        else:
+            n_skipped += 1
+        manifest[key] = entry
+
+    tmp_file = manifest_file+'.tmp'
+    with open(tmp_file,'w') as outfile:
+        json.dump(manifest,outfile,indent=1)
+    os.replace(tmp_file,manifest_file)
+
+    logging.info('{} products exported, {} already exported, {} failed'.\
+        format(n_exported,n_skipped,n_failed))
+
+    return manifest
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO,format='%(message)s')
+
+    # Reading arguments (key or key=value)
+    arg_dict = {}
+    for arg in sys.argv[1:]:
+        div = arg.split('=',1)
+        arg_dict[div[0]] = True if len(div) == 1 else div[1]
+
+    parent_data_dir = '/media/QNAP_40T_HD/HXMTdata_version20200927'
+    if 'target' in arg_dict.keys():
+        target = arg_dict['target']
+    else:
+        folders = next(os.walk(parent_data_dir))[1]
+        happy = False
+        while not happy:
+            for i,folder in enumerate(folders):
+                print('{}) {}'.format(i+1,folder))
+            index = int(input('Choose a directory ====> '))-1
+            target = folders[index]
+            ans=input('You chose {}, are you happy?'.format(target))
+            if not ('N' in ans.upper() or 'O' in ans.upper()):
+                happy = True
+
+    # Source and destination folders
+    there = '/media/3HD/common_files'
+    rdf = os.path.join(there,target)
+
+    limbo = '/media/3HD/stefano/climbo/Cygnus_X1'
+    if 'destination' in arg_dict.keys(): limbo = arg_dict['destination']
+
+    n_workers = 4
+    if 'nproc' in arg_dict.keys(): n_workers = int(arg_dict['nproc'])
+
+    # At this point data should be organized in proposal-observation-exposure folders inside rdf
+    proposals = sorted(next(os.walk(rdf))[1])
+    if 'logs' in proposals: proposals.remove('logs')
+
+    jobs = []
+    for proposal in proposals:
+
+        prop_folder = os.path.join(rdf,proposal)
+        observations = sorted(next(os.walk(prop_folder))[1])
+
+        logging.info(f'There are {len(observations)} observations in {proposal}.')
+        for observation in observations:
+
+            obs_folder = os.path.join(prop_folder,observation)
+            exposures = sorted(next(os.walk(obs_folder))[1])
+
+            # Checking ACS and AUX folders
+            if 'ACS' in exposures: exposures.remove('ACS')
+            if 'AUX' in exposures:
+                exposures.remove('AUX')
+            else:
+                logging.info(f'AUX folder of {observation} does not exists. Skipping obs.')
+                continue
+
+            for exposure in exposures:
+
+                # Products of the exposure
+                wf = os.path.join(obs_folder,exposure)
+                products = os.path.join(wf,'HE/reduced_products')
+
+                # Lightcurves are compressed, .pi files copied
+                jobs += [(lc,exposure,True) for lc in sorted(glob.glob('{}/*.lc'.format(products)))]
+                jobs += [(pi,exposure,False) for pi in sorted(glob.glob('{}/*.pi'.format(products)))]
+
+    logging.info(f'Exporting {len(jobs)} products to {limbo}')
+    os.makedirs(limbo,exist_ok=True)
+    export_products(jobs,limbo,n_workers=n_workers,override='override' in arg_dict.keys())